@@ -1,44 +1,44 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
-from app.models import User
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import get_db
 from app.schemas.user import UserCreate, UserResponse, UserLogin
-from app.crud.user import create_user
-from app.crud.chat import add_to_chat
-from app.core.security import verify_password
+from app.crud.user import create_user, get_user_by_username, update_password_hash
+from app.core.security import password_hasher, create_access_token
+from app.core.config import settings
+from app.core.manager import manager
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # Creates new users
 @router.post("/register", response_model=UserResponse)
-def register(user_in: UserCreate, db: Session = Depends(get_db)):
-    user = create_user(db, user_in)
-    # 7 and 8 are the Chat IDs for the two public chat rooms
-    # Automatically adds new users to public chat rooms
-    add_to_chat([user.id], 7, db)
-    add_to_chat([user.id], 8, db)
+async def register(user_in: UserCreate, db: AsyncSession = Depends(get_db)):
+    # Automatically adds new users to the public chat rooms
+    user = await create_user(db, user_in, settings.PUBLIC_CHAT_IDS)
+    await manager.membership_changed(settings.PUBLIC_CHAT_IDS, [user.id])
     return user
 
 # Authenticates new user and returns user data
 @router.post("/login")
-def login(user_in: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == user_in.username).first()
+async def login(user_in: UserLogin, db: AsyncSession = Depends(get_db)):
+    user = await get_user_by_username(db, user_in.username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
         )
-    if not verify_password(user_in.password, user.hashed_password):
+    valid, new_hash = await password_hasher.verify(user.username, user_in.password, user.hashed_password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
         )
-    userDetails = { "username": user.username, "id": user.id }
-    return userDetails
\ No newline at end of file
+    # Stored hash was made with different rounds, upgrade it while we have the password
+    if new_hash:
+        await update_password_hash(db, user, new_hash)
+    userDetails = {
+        "username": user.username,
+        "id": user.id,
+        "access_token": create_access_token(user.id, user.username),
+        "token_type": "bearer",
+    }
+    return userDetails
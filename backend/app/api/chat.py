@@ -1,46 +1,112 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
+import json
+import logging
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, Response, status
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import get_db
+from app.api.deps import get_current_user, websocket_user
 from pydantic import BaseModel
-from app.crud.chat import create_chat, add_to_chat
+from app.crud.chat import create_chat, add_to_chat, get_user_chat_ids
+from app.crud.message import get_chat_messages, search_messages
 from app.schemas.chats import ChatCreate, ChatResponse, UpdateChat
+from app.schemas.messages import MessageHistory, MessageSearchResult
+from app.core.config import settings
+from app.core.history import page_from_tail, tail_entry_to_row
 from app.core.manager import manager
+from app.core.persistence import message_writer
+from app.core.archive import message_archive
+from app.core.envelope import Envelope, decode_client_frame
+from app.core.coalescer import coalescing_enabled
+from app.core.message_search import encode_cursor, decode_cursor
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/chat", tags=["Chat"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 class MessageRequest(BaseModel):
     sender: str
     recipient: str
     content: str
 
+# Client frame types passed on to the rest of the chat
+# They are rebuilt from the type alone, the sender comes from the token
+RELAYED_FRAME_TYPES = ("connect", "disconnect")
+
+# Chat messages get an id, are published and then queued for the database writer
+# {"type": "read", "message_id": N} acknowledges reading up to N (everything without it)
+# connect and disconnect are relayed as new envelopes, any other frame is dropped
+async def handle_message(data: str, chat_id: str, user_id: int, username: str):
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return
+    if not isinstance(payload, dict):
+        return
+    frame_type = payload.get("type")
+    if frame_type in RELAYED_FRAME_TYPES:
+        await manager.broadcast(Envelope(frame_type, chat=chat_id, sender=user_id, payload={ "username": username }).encode(), chat_id)
+        return
+    if frame_type == "read":
+        message_id = payload.get("message_id", 0)
+        if isinstance(message_id, int) and await manager.can_access(chat_id, user_id):
+            await manager.mark_read(chat_id, user_id, message_id)
+        return
+    if frame_type != "chat_message":
+        return
+    content = payload.get("content")
+    if not isinstance(content, str) or not content:
+        return
+    # Answered from the local membership cache, costs nothing per message
+    if not await manager.can_access(chat_id, user_id):
+        return
+    if coalescing_enabled(chat_id):
+        # Don't hold the socket's receive loop for the coalescing window
+        # Tasks start in order, so a sender's messages keep their order in the batch
+        manager.spawn(publish_and_store(chat_id, user_id, username, content))
+    else:
+        await publish_and_store(chat_id, user_id, username, content)
+
+async def publish_and_store(chat_id: str, user_id: int, username: str, content: str):
+    try:
+        message = await manager.publish_chat_message(chat_id, user_id, username, content)
+    except Exception:
+        logger.exception("Error publishing chat message", extra={ "chat_id": chat_id, "user_id": user_id })
+        return
+    await message_writer.enqueue(message)
+
 # Handles connections and listens for messages
+# The handshake needs ?token=<access token> issued to the user in the path
+# In streams delivery mode, ?last_id=<stream id> replays what the client missed
 @router.websocket("/ws/{chat_id}/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: str, user_id: int):
-    await manager.connect(websocket, chat_id, user_id)
+async def websocket_endpoint(websocket: WebSocket, chat_id: str, user_id: int, last_id: Optional[str] = None):
+    claims = websocket_user(websocket, user_id)
+    if claims is None or not await manager.can_access(chat_id, user_id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    connection = await manager.connect(websocket, chat_id, user_id, last_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            await manager.broadcast(data, chat_id)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            data = decode_client_frame(message, connection.wire_format)
+            if data is not None and await manager.admit_frame(connection):
+                await handle_message(data, chat_id, user_id, claims["username"])
     except WebSocketDisconnect:
-        manager.disconnect(websocket, chat_id, user_id)
-        await manager.broadcast_user_event(chat_id, user_id, "user_left")
+        pass
     except Exception as e:
-        manager.disconnect(websocket, chat_id, user_id)
-        await manager.broadcast_user_event(chat_id, user_id, "user_left")
+        logger.warning("Error in WebSocket connection", extra={ "chat_id": chat_id, "user_id": user_id, "error": str(e) })
+    finally:
+        manager.disconnect(connection)
 
-# Creates a new chat
+# Creates a new chat, the caller has to be one of its members
 @router.post("/create-chat", response_model=ChatResponse)
-async def create(chat_in: ChatCreate, db: Session = Depends(get_db)):
-    chat = create_chat(db, chat_in)
+async def create(chat_in: ChatCreate, db: AsyncSession = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    if current_user["id"] not in chat_in.user_ids:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Chats can only be created with yourself as a member")
+    chat = await create_chat(db, chat_in)
     member_ids = [m.user_id for m in chat.memberships]
+    await manager.membership_changed([chat.id], member_ids)
     return ChatResponse(
         id=chat.id,
         name=chat.name,
@@ -48,12 +114,83 @@ async def create(chat_in: ChatCreate, db: Session = Depends(get_db)):
         members=member_ids
     )
 
-# Adds users to existing chat
+# Adds users to existing chat, only its members can add others
 @router.post("/update-chat")
-async def update(chat_in: UpdateChat, db: Session = Depends(get_db)):
+async def update(chat_in: UpdateChat, db: AsyncSession = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    if not await manager.can_access(str(chat_in.id), current_user["id"]):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member of this chat")
     try:
-        add_to_chat(chat_in.members, chat_in.id, db)
+        await add_to_chat(chat_in.members, chat_in.id, db)
+        await manager.membership_changed([chat_in.id], chat_in.members)
         return "Successfully added members to chat"
     except Exception as e:
-        print(f"Error updating chat: {e}")
-        return f"Error adding members to chat: {e}"
\ No newline at end of file
+        logger.error("Error updating chat", extra={ "chat_id": chat_in.id, "error": str(e) })
+        return f"Error adding members to chat: {e}"
+
+# Returns a page of chat history, newest page first, messages oldest first
+# Pages are keyed by message id: pass next_before_id back as before_id to scroll up
+# The newest messages come from the broker's tail cache, Postgres is only read
+# past it and the archive only past the retention window
+@router.get("/{chat_id}/messages", response_model=MessageHistory)
+async def get_messages(
+    chat_id: int,
+    before_id: Optional[int] = Query(None, ge=1),
+    limit: int = Query(settings.HISTORY_PAGE_LIMIT, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+):
+    if not await manager.can_access(str(chat_id), current_user["id"]):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member of this chat")
+    tail = await manager.broker.read_tail(str(chat_id))
+    cached, continue_below = page_from_tail(tail, before_id, limit)
+    rows = [tail_entry_to_row(entry) for entry in cached]
+
+    if len(rows) < limit:
+        older = await get_chat_messages(db, chat_id, continue_below, limit - len(rows))
+        rows = list(reversed(older)) + rows
+
+    if len(rows) < limit:
+        archived = await message_archive.read(chat_id, rows[0]["id"] if rows else continue_below, limit - len(rows))
+        rows = list(reversed(archived)) + rows
+
+    next_before_id = rows[0]["id"] if len(rows) == limit else None
+    return MessageHistory(messages=rows, next_before_id=next_before_id)
+
+# One page of search results, X-Next-Cursor holds the cursor for the next page
+async def search_page(db: AsyncSession, response: Response, q: str, chat_ids: List[int], cursor: Optional[str], limit: int) -> List[dict]:
+    if not chat_ids:
+        return []
+    # One extra row tells whether there is a next page
+    rows = await search_messages(db, q, chat_ids, limit + 1, decode_cursor(cursor))
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[limit - 1]["rank"], rows[limit - 1]["id"])
+    return rows[:limit]
+
+# Searches every chat the caller is in, best match first
+@router.get("/search", response_model=List[MessageSearchResult])
+async def search_all(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: Optional[str] = None,
+    limit: int = Query(settings.MESSAGE_SEARCH_PAGE_LIMIT, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+):
+    chat_ids = await get_user_chat_ids(current_user["id"], db)
+    return await search_page(db, response, q, chat_ids, cursor, limit)
+
+# Searches one chat's messages, best match first
+# Words are matched whole; "quoted phrases", OR and -word work on Postgres
+@router.get("/{chat_id}/search", response_model=List[MessageSearchResult])
+async def search_chat(
+    chat_id: int,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: Optional[str] = None,
+    limit: int = Query(settings.MESSAGE_SEARCH_PAGE_LIMIT, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+):
+    if not await manager.can_access(str(chat_id), current_user["id"]):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member of this chat")
+    return await search_page(db, response, q, [chat_id], cursor, limit)
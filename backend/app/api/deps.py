@@ -0,0 +1,51 @@
+import hmac
+from typing import Optional
+from fastapi import Depends, HTTPException, WebSocket, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from app.core.config import settings
+from app.core.security import decode_access_token
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+# Claims of the caller's access token, { id, username, exp }
+# Verified in-process from the signature, no database lookup
+def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> dict:
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={ "WWW-Authenticate": "Bearer" },
+        )
+    return decode_access_token(credentials.credentials)
+
+# Rejects requests made on behalf of another user
+def require_self(user_id: int, current_user: dict = Depends(get_current_user)) -> dict:
+    if current_user["id"] != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+    return current_user
+
+# Claims for a WebSocket handshake, browsers can't set headers so the token comes as ?token=
+# Returns None when the token is missing, invalid or for another user than the path's
+def websocket_user(websocket: WebSocket, user_id: int) -> Optional[dict]:
+    token = websocket.query_params.get("token")
+    if not token:
+        return None
+    try:
+        claims = decode_access_token(token)
+    except HTTPException:
+        return None
+    return claims if claims["id"] == user_id else None
+
+# Guards the monitoring endpoints with MONITORING_TOKEN
+# They answer 404 while no token is configured, so an unset token exposes nothing
+def require_monitoring(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> None:
+    if not settings.MONITORING_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(
+        credentials.credentials.encode(), settings.MONITORING_TOKEN.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={ "WWW-Authenticate": "Bearer" },
+        )
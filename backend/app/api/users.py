@@ -1,45 +1,113 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query
-from typing import List
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
-from app.crud.chat import get_user_chats
-from app.schemas.chats import ChatCreate, ChatResponse
+import json
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query, Request, Response
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import get_db
+from app.api.deps import get_current_user, require_self
+from app.crud.chat import get_user_chats, get_user_chat_ids, chat_cursor
+from app.schemas.chats import ChatCreate, ChatResponse, UnreadCount
 from app.schemas.user import SearchUsers
 from app.crud.user import search_users, get_users_by_id
+from app.core.chat_cache import (
+    get_cached_chats,
+    store_chats,
+    read_chat_versions,
+    make_etag,
+    encode_chat_cursor,
+    decode_chat_cursor,
+)
+from app.core.config import settings
+from app.core.manager import manager
+from app.core.user_search import encode_cursor, decode_cursor, get_cached_page, store_page
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# One page of a user's chats and the cursor of the next page, if there is one
+async def chat_page(user_id: int, db: AsyncSession, limit: int, cursor: Optional[str]) -> tuple[List[dict], Optional[str]]:
+    # One extra row tells whether there is a next page
+    chats = await get_user_chats(user_id, db, limit + 1, decode_chat_cursor(cursor))
+    next_cursor = encode_chat_cursor(*chat_cursor(chats[limit - 1])) if len(chats) > limit else None
+    return chats[:limit], next_cursor
 
-# Returns chat data for user
+# Returns chat data for user, most recently active first, with each chat's newest message
+# When more chats exist, X-Next-Cursor holds the cursor for the next page
+# The first page is served from a per-user cache; clients sending the last ETag
+# as If-None-Match get an empty 304 when nothing changed
 @router.get("/chats/{user_id}", response_model=List[ChatResponse])
-async def get_chats(user_id: int, db: Session = Depends(get_db)):
-    print(user_id)
-    chats = get_user_chats(user_id, db)
-    response = []
-    for chat in chats:
-        members = [membership.user_id for membership in chat.memberships]
-        response.append(
-            ChatResponse(
-                id=chat.id,
-                name=chat.name,
-                is_group=chat.is_group,
-                members=members
-            )
-        )
-    return response
+async def get_chats(
+    user_id: int,
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(settings.USER_CHATS_PAGE_LIMIT, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(require_self),
+):
+    redis_client = await manager.get_redis()
+    cached = None
+    first_page = cursor is None and limit == settings.USER_CHATS_PAGE_LIMIT
+    if redis_client is not None and first_page:
+        cached, user_version = await get_cached_chats(redis_client, user_id)
+    if cached:
+        etag, body, next_cursor = cached
+    elif redis_client is not None and first_page:
+        chat_versions = await read_chat_versions(redis_client, await get_user_chat_ids(user_id, db))
+        chats, next_cursor = await chat_page(user_id, db, limit, cursor)
+        etag, body = await store_chats(redis_client, user_id, user_version, chat_versions, chats, next_cursor)
+    else:
+        # Later pages and runs without Redis skip the shared cache, the ETag still saves the transfer
+        chats, next_cursor = await chat_page(user_id, db, limit, cursor)
+        body = json.dumps(chats, separators=(",", ":")).encode()
+        etag = make_etag(body)
+
+    # no-cache makes browsers revalidate every time instead of reusing a stale list
+    headers = { "ETag": etag, "Cache-Control": "private, no-cache" }
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# Unread message counts and read positions of a user's chats
+# Pass the chats as repeated ?chat_id=, chats the user isn't a member of are left out
+@router.get("/unread/{user_id}", response_model=List[UnreadCount])
+async def get_unread(user_id: int, chat_id: List[int] = Query(...), current_user: dict = Depends(require_self)):
+    await manager.get_redis()
+    counts = await manager.unread.counts(user_id, list(dict.fromkeys(chat_id)))
+    return [
+        UnreadCount(chat_id=chat, unread=unread, last_read_message_id=read_id)
+        for chat, (unread, read_id) in counts.items()
+    ]
 
 # Returns list of all requested user data by username
+# Usernames starting with q come first, then other usernames containing it
+# When more results exist, X-Next-Cursor holds the cursor for the next page
 @router.get("/search_users/", response_model=List[SearchUsers])
-async def get_users(q: str = Query(..., min_length=2, max_length=50), db: Session = Depends(get_db)):
-    return search_users(db, q)
+async def get_users(
+    response: Response,
+    q: str = Query(..., min_length=2, max_length=50),
+    cursor: Optional[str] = None,
+    limit: int = Query(settings.USER_SEARCH_PAGE_LIMIT, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user),
+):
+    redis_client = await manager.get_redis()
+    page = await get_cached_page(redis_client, q, cursor, limit) if redis_client else None
+    if page is None:
+        # One extra row tells whether there is a next page
+        rows = await search_users(db, q, limit + 1, decode_cursor(cursor))
+        next_cursor = encode_cursor(*rows[limit - 1][:3]) if len(rows) > limit else None
+        page = {
+            "users": [{ "id": user_id, "username": username } for _, _, user_id, username in rows[:limit]],
+            "next_cursor": next_cursor,
+        }
+        if redis_client:
+            await store_page(redis_client, q, cursor, limit, page)
+
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
+    return page["users"]
 
 # Returns list of all requested user data by id
 @router.post("/get_users_by_id", response_model=List[SearchUsers])
-async def get_users(user_ids: List[int], db: Session = Depends(get_db)):
-    return get_users_by_id(db, user_ids)
+async def get_users(user_ids: List[int], db: AsyncSession = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    return await get_users_by_id(db, user_ids)
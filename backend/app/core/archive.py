@@ -0,0 +1,202 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Compressed archive of messages past the retention window
+# One month per file pair in MESSAGE_ARCHIVE_DIR:
+#   messages_YYYY_MM.ndjson.gz  one JSON message per line, ordered by (chat_id, id),
+#                               written as one gzip member per block of at most
+#                               MESSAGE_ARCHIVE_BLOCK_SIZE messages of one chat
+#   messages_YYYY_MM.index.json [chat_id, first id, last id, offset, length] per block
+# The data file is still a plain .ndjson.gz (zcat reads concatenated members),
+# while the index lets a history page decompress only the block it needs.
+# The index is written last, a data file without one is an unfinished export.
+# Files are never overwritten: exporting a month again (rows that reached the
+# database after it was archived) writes a numbered part, messages_YYYY_MM.1.
+INDEX_SUFFIX = ".index.json"
+DATA_SUFFIX = ".ndjson.gz"
+# Seconds between checks of the archive directory for files other workers wrote
+RESCAN_INTERVAL = 60.0
+# Decompressed blocks kept per worker
+BLOCK_CACHE_SIZE = 32
+
+# Monthly partitions (see app.core.retention) are named the same way
+def archive_name(year: int, month: int) -> str:
+    return f"messages_{year:04d}_{month:02d}"
+
+# Writes one month of messages, fed in (chat_id, id) order
+# Blocking file IO runs in a thread so the event loop keeps serving
+class ArchiveWriter:
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.path = None
+        self.partial_path = None
+        self.file = None
+        self.offset = 0
+        self.blocks: list[list[int]] = []
+        self.block: list[dict] = []
+        self.rows = 0
+
+    async def open(self):
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        self.name = await asyncio.to_thread(self._free_name)
+        self.path = os.path.join(self.directory, self.name + DATA_SUFFIX)
+        self.partial_path = self.path + ".partial"
+        self.file = await asyncio.to_thread(open, self.partial_path, "wb")
+
+    # The month's name, or its first numbered part whose files don't exist yet
+    def _free_name(self) -> str:
+        name = self.name
+        part = 0
+        while any(os.path.exists(os.path.join(self.directory, name + suffix)) for suffix in (DATA_SUFFIX, INDEX_SUFFIX)):
+            part += 1
+            name = f"{self.name}.{part}"
+        return name
+
+    # rows: dicts with id, chat_id, sender_id, username, content, created_at
+    async def write(self, rows: list[dict]):
+        for row in rows:
+            if self.block and (row["chat_id"] != self.block[0]["chat_id"] or len(self.block) >= settings.MESSAGE_ARCHIVE_BLOCK_SIZE):
+                await self._write_block()
+            self.block.append(row)
+
+    async def _write_block(self):
+        block, self.block = self.block, []
+        lines = "".join(json.dumps(row, default=datetime.isoformat, separators=(",", ":")) + "\n" for row in block)
+        data = await asyncio.to_thread(gzip.compress, lines.encode(), 6)
+        await asyncio.to_thread(self.file.write, data)
+        self.blocks.append([block[0]["chat_id"], block[0]["id"], block[-1]["id"], self.offset, len(data)])
+        self.offset += len(data)
+        self.rows += len(block)
+
+    # Makes the month durable and visible to readers, returns the number of messages
+    # A month without messages leaves no files behind
+    async def close(self) -> int:
+        if self.block:
+            await self._write_block()
+        if not self.rows:
+            await self.abort()
+            return 0
+        await asyncio.to_thread(self._finish)
+        return self.rows
+
+    def _finish(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+        index_path = os.path.join(self.directory, self.name + INDEX_SUFFIX)
+        with open(index_path + ".partial", "w") as index:
+            json.dump({ "rows": self.rows, "blocks": self.blocks }, index, separators=(",", ":"))
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(index_path + ".partial", index_path)
+
+    # Drops an unfinished export
+    async def abort(self):
+        if self.file and not self.file.closed:
+            await asyncio.to_thread(self.file.close)
+        if self.partial_path is None:
+            return
+        try:
+            await asyncio.to_thread(os.remove, self.partial_path)
+        except FileNotFoundError:
+            pass
+
+# Serves history older than the database from the archive files
+class MessageArchive:
+    def __init__(self, directory: str):
+        self.directory = directory
+        # { ChatId: [(first id, last id, path, offset, length)] }, ordered by last id
+        # Blocks of one file never overlap, a later part of a month can overlap an earlier one
+        self.blocks: dict[int, list[tuple]] = {}
+        # Index files already loaded
+        self.indexed: set[str] = set()
+        self.scanned_at = None
+        # { (path, offset): messages oldest first }, least recently used first
+        self.cache: OrderedDict[tuple[str, int], list[dict]] = OrderedDict()
+        self.lock = asyncio.Lock()
+        self.reads = 0
+
+    # Up to limit archived messages of a chat older than before_id, newest first
+    async def read(self, chat_id: int, before_id: int | None, limit: int) -> list[dict]:
+        await self._refresh()
+        rows = []
+        for first_id, last_id, path, offset, length in reversed(self.blocks.get(chat_id, ())):
+            if before_id is not None and first_id >= before_id:
+                continue
+            # Every block left ends below the page already found
+            if len(rows) >= limit and last_id < rows[limit - 1]["id"]:
+                break
+            rows.extend(
+                message for message in await self._load(path, offset, length)
+                if before_id is None or message["id"] < before_id
+            )
+            rows.sort(key=lambda message: message["id"], reverse=True)
+        return rows[:limit]
+
+    # Picks up index files written since the last scan
+    async def _refresh(self):
+        if self.scanned_at is not None and time.monotonic() - self.scanned_at < RESCAN_INTERVAL:
+            return
+        async with self.lock:
+            if self.scanned_at is not None and time.monotonic() - self.scanned_at < RESCAN_INTERVAL:
+                return
+            try:
+                names = await asyncio.to_thread(os.listdir, self.directory)
+            except FileNotFoundError:
+                names = []
+            for name in sorted(names):
+                if name.endswith(INDEX_SUFFIX) and name not in self.indexed:
+                    await self._load_index(name)
+            self.scanned_at = time.monotonic()
+
+    async def _load_index(self, name: str):
+        path = os.path.join(self.directory, name[:-len(INDEX_SUFFIX)] + DATA_SUFFIX)
+        try:
+            index = json.loads(await asyncio.to_thread(_read_file, os.path.join(self.directory, name)))
+        except (OSError, ValueError) as e:
+            logger.error("Error loading archive index", extra={ "file": name, "error": str(e) })
+            return
+        for chat_id, first_id, last_id, offset, length in index["blocks"]:
+            self.blocks.setdefault(chat_id, []).append((first_id, last_id, path, offset, length))
+        for blocks in self.blocks.values():
+            blocks.sort(key=lambda block: block[1])
+        self.indexed.add(name)
+
+    async def _load(self, path: str, offset: int, length: int) -> list[dict]:
+        key = (path, offset)
+        messages = self.cache.get(key)
+        if messages is not None:
+            self.cache.move_to_end(key)
+            return messages
+        self.reads += 1
+        messages = await asyncio.to_thread(_read_block, path, offset, length)
+        self.cache[key] = messages
+        if len(self.cache) > BLOCK_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return messages
+
+    def stats(self) -> dict:
+        return { "files": len(self.indexed), "chats": len(self.blocks), "block_reads": self.reads }
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _read_block(path: str, offset: int, length: int) -> list[dict]:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    return [json.loads(line) for line in data.splitlines()]
+
+message_archive = MessageArchive(settings.MESSAGE_ARCHIVE_DIR)
@@ -0,0 +1,470 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+import redis.asyncio as redis
+from app.core.config import settings
+from app.core.history import tail_key, read_tail
+from app.core.unread import read_state_key
+from app.core.subscriptions import (
+    ShardedPubSub,
+    LISTENER_RETRY_MIN,
+    LISTENER_RETRY_MAX,
+    LISTENER_YIELD_EVERY,
+)
+from app.core.metrics import LISTENER_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Assigns the next message id, publishes the message, appends it to the chat's
+# capped tail list and counts it in the chat's read state in one atomic round
+# trip, so ids, the live stream, the history cache and unread counts always agree
+# KEYS: id counter, tail list, chat stream, read state hash
+# ARGV: channel, message JSON without its opening brace, tail size, tail TTL, id floor,
+#       delivery mode, stream max length, origin prefix (see RedisBroker.origin),
+#       read state TTL
+PUBLISH_MESSAGE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local floor = tonumber(ARGV[5])
+if current < floor then
+    redis.call('SET', KEYS[1], floor)
+end
+local id = redis.call('INCR', KEYS[1])
+local message = '{"message_id":' .. id .. ',' .. ARGV[2]
+if ARGV[6] == 'streams' then
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[7], '*', 'data', message)
+else
+    redis.call('PUBLISH', ARGV[1], ARGV[8] .. message)
+end
+redis.call('RPUSH', KEYS[2], message)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[3]), -1)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('HINCRBY', KEYS[4], 'total', 1)
+redis.call('HSET', KEYS[4], 'last_id', id)
+redis.call('EXPIRE', KEYS[4], ARGV[9])
+return id
+"""
+# Same as PUBLISH_MESSAGE_SCRIPT for several messages of one chat
+# Delivered as a single {"type":"batch","chat_id":..,"messages":[..]} frame,
+# while the tail cache still gets one entry per message
+# KEYS: id counter, tail list, chat stream, read state hash
+# ARGV: channel, tail size, tail TTL, id floor, delivery mode, stream max length,
+#       chat id, origin prefix, read state TTL, then each message JSON without its
+#       opening brace
+PUBLISH_BATCH_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local floor = tonumber(ARGV[4])
+if current < floor then
+    redis.call('SET', KEYS[1], floor)
+end
+local count = #ARGV - 9
+local first = redis.call('INCRBY', KEYS[1], count) - count + 1
+local messages = {}
+for i = 1, count do
+    messages[i] = '{"message_id":' .. (first + i - 1) .. ',' .. ARGV[9 + i]
+end
+local batch = '{"type":"batch","chat_id":' .. ARGV[7] .. ',"messages":[' .. table.concat(messages, ',') .. ']}'
+if ARGV[5] == 'streams' then
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[6], '*', 'data', batch)
+else
+    redis.call('PUBLISH', ARGV[1], ARGV[8] .. batch)
+end
+redis.call('RPUSH', KEYS[2], unpack(messages))
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('HINCRBY', KEYS[4], 'total', count)
+redis.call('HSET', KEYS[4], 'last_id', first + count - 1)
+redis.call('EXPIRE', KEYS[4], ARGV[9])
+return first
+"""
+MESSAGE_ID_KEY = "messages:last_id"
+# Milliseconds a stream read blocks before checking for newly opened chats
+STREAM_BLOCK_MS = 5000
+STREAM_ID_PREFIX = '{"stream_id":"'
+# Ends the "<worker id> <publish time>" prefix of a pub/sub payload
+# JSON never contains it unescaped, so it can't be confused with the message
+ORIGIN_SEPARATOR = "\x1f"
+
+def stream_key(chat_id: str) -> str:
+    return f"chat:{chat_id}:stream"
+
+# Stream ids are "<milliseconds>-<sequence>"
+def parse_stream_id(stream_id: str) -> tuple[int, int]:
+    ms, _, seq = stream_id.partition("-")
+    return int(ms), int(seq or 0)
+
+# Puts the stream id at the front of a JSON object message so clients can resume from it
+def with_stream_id(data: str, stream_id: str) -> str:
+    if not data.startswith("{"):
+        return data
+    if data == "{}":
+        return STREAM_ID_PREFIX + stream_id + '"}'
+    return STREAM_ID_PREFIX + stream_id + '",' + data[1:]
+
+# Reads back the id added by with_stream_id
+def stream_id_of(data: str) -> str | None:
+    if not data.startswith(STREAM_ID_PREFIX):
+        return None
+    start = len(STREAM_ID_PREFIX)
+    return data[start:data.index('"', start)]
+
+# The chat message a publish script builds, for delivering it locally
+# body: the message JSON without its opening brace
+def message_with_id(message_id: int, body: str) -> str:
+    return '{"message_id":' + str(message_id) + ',' + body
+
+# The batch frame PUBLISH_BATCH_SCRIPT builds
+def batch_with_ids(chat_id: str, first_id: int, bodies: list[str]) -> str:
+    messages = ",".join(message_with_id(first_id + offset, body) for offset, body in enumerate(bodies))
+    return '{"type":"batch","chat_id":' + str(int(chat_id)) + ',"messages":[' + messages + ']}'
+
+# Carries messages between the workers serving a chat
+# The manager subscribes a chat while it has local connections there and gets
+# every message other workers publish to it through handle_message. When
+# local_delivery is set the publisher hands its own sockets the message
+# directly and the broker drops it on the way back, so it is never delivered
+# twice. Chat messages also get their id and a place in the chat's history
+# tail here. Subclasses have to implement every abstract method to be created.
+class Broker(ABC):
+    # Whether the publishing worker delivers to its own connections
+    local_delivery = True
+    # Redis connection other caches can share, None when there is no Redis
+    redis_client = None
+
+    # handle_message(data, chat_id) is awaited for every message from another worker
+    @abstractmethod
+    async def start(self, worker_id: str, handle_message):
+        ...
+
+    @abstractmethod
+    async def subscribe(self, chat_id: str):
+        ...
+
+    @abstractmethod
+    async def unsubscribe(self, chat_id: str):
+        ...
+
+    # Sends an already encoded event (presence, relayed frames) to the chat
+    @abstractmethod
+    async def publish(self, chat_id: str, data: str):
+        ...
+
+    # Publishes a chat message and returns its id, never below floor + 1
+    @abstractmethod
+    async def publish_message(self, chat_id: str, body: str, floor: int) -> int:
+        ...
+
+    # Publishes messages of one chat as one batch frame, returns the first id
+    @abstractmethod
+    async def publish_batch(self, chat_id: str, bodies: list[str], floor: int) -> int:
+        ...
+
+    # The chat's most recent messages, oldest first
+    @abstractmethod
+    async def read_tail(self, chat_id: str) -> list[dict]:
+        ...
+
+    # Messages published after last_id, oldest first, and whether some were left out
+    # Only brokers that keep a log (Redis streams) can replay
+    async def replay(self, chat_id: str, last_id: str) -> tuple[list[str], bool]:
+        return [], False
+
+    def stats(self) -> dict:
+        return {}
+
+    async def close(self):
+        pass
+
+# Connects workers through Redis pub/sub, or Redis Streams in streams delivery mode
+# Streams are the replay log, so every worker (the publisher included) delivers
+# from the stream and local_delivery is off in that mode.
+class RedisBroker(Broker):
+    def __init__(self):
+        self.redis_client = None
+        self.worker_id = None
+        self.handle_message = None
+        # Pub/sub connections, one listener task each (pubsub delivery mode)
+        self.pubsub = None
+        self.publish_script = None
+        self.publish_batch_script = None
+        # Streams mode: last entry id this worker has delivered, per chat stream key
+        self.stream_cursors: dict[str, str] = {}
+        # Streams mode listener, and the event that wakes it when the set of streams changes
+        self.listener_task = None
+        self.streams_changed = asyncio.Event()
+
+    @property
+    def local_delivery(self) -> bool:
+        return settings.DELIVERY_MODE != "streams"
+
+    async def start(self, worker_id: str, handle_message):
+        self.worker_id = worker_id
+        self.handle_message = handle_message
+        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.redis_client = await redis.from_url(
+            redis_url,
+            encoding="utf-8",
+            decode_responses=True
+        )
+        self.pubsub = ShardedPubSub(self.redis_client, self._handle_pubsub_message, settings.PUBSUB_SHARDS)
+        self.publish_script = self.redis_client.register_script(PUBLISH_MESSAGE_SCRIPT)
+        self.publish_batch_script = self.redis_client.register_script(PUBLISH_BATCH_SCRIPT)
+        logger.info("Redis connection initialized")
+
+    # Prefix of a pub/sub payload: who published it, so they can skip it, and
+    # when, for the listener lag metric
+    def origin(self) -> str:
+        return f"{self.worker_id} {time.time():.6f}{ORIGIN_SEPARATOR}"
+
+    async def subscribe(self, chat_id: str):
+        if settings.DELIVERY_MODE != "streams":
+            await self.pubsub.subscribe(f"chat:{chat_id}")
+            return
+        key = stream_key(chat_id)
+        # Start from the current end so nothing published from here on is missed
+        latest = await self.redis_client.xrevrange(key, count=1)
+        self.stream_cursors[key] = latest[0][0] if latest else "0-0"
+        # A blocked XREAD only sees the streams it was started with, the listener starts a new one
+        self.streams_changed.set()
+        if self.listener_task is None or self.listener_task.done():
+            self.listener_task = asyncio.create_task(self._stream_listener())
+
+    async def unsubscribe(self, chat_id: str):
+        if settings.DELIVERY_MODE != "streams":
+            await self.pubsub.unsubscribe(f"chat:{chat_id}")
+            return
+        # The listener drops the stream from its next XREAD
+        self.stream_cursors.pop(stream_key(chat_id), None)
+
+    async def publish(self, chat_id: str, data: str):
+        if settings.DELIVERY_MODE == "streams":
+            await self.redis_client.xadd(stream_key(chat_id), { "data": data }, maxlen=settings.STREAM_MAXLEN, approximate=True)
+        else:
+            await self.redis_client.publish(f"chat:{chat_id}", self.origin() + data)
+
+    async def publish_message(self, chat_id: str, body: str, floor: int) -> int:
+        return await self.publish_script(
+            keys=[MESSAGE_ID_KEY, tail_key(chat_id), stream_key(chat_id), read_state_key(chat_id)],
+            args=[
+                f"chat:{chat_id}",
+                body,
+                settings.HISTORY_CACHE_SIZE,
+                settings.HISTORY_CACHE_TTL,
+                floor,
+                settings.DELIVERY_MODE,
+                settings.STREAM_MAXLEN,
+                self.origin(),
+                settings.UNREAD_STATE_TTL,
+            ],
+        )
+
+    async def publish_batch(self, chat_id: str, bodies: list[str], floor: int) -> int:
+        return await self.publish_batch_script(
+            keys=[MESSAGE_ID_KEY, tail_key(chat_id), stream_key(chat_id), read_state_key(chat_id)],
+            args=[
+                f"chat:{chat_id}",
+                settings.HISTORY_CACHE_SIZE,
+                settings.HISTORY_CACHE_TTL,
+                floor,
+                settings.DELIVERY_MODE,
+                settings.STREAM_MAXLEN,
+                int(chat_id),
+                self.origin(),
+                settings.UNREAD_STATE_TTL,
+                *bodies,
+            ],
+        )
+
+    async def read_tail(self, chat_id: str) -> list[dict]:
+        return await read_tail(self.redis_client, chat_id)
+
+    async def replay(self, chat_id: str, last_id: str) -> tuple[list[str], bool]:
+        key = stream_key(chat_id)
+        start = "(" + last_id
+        replayed = []
+        while len(replayed) < settings.STREAM_REPLAY_LIMIT:
+            count = min(settings.STREAM_BATCH_SIZE, settings.STREAM_REPLAY_LIMIT - len(replayed))
+            entries = await self.redis_client.xrange(key, min=start, count=count)
+            replayed.extend(with_stream_id(fields["data"], entry_id) for entry_id, fields in entries)
+            if len(entries) < count:
+                return replayed, False
+            start = "(" + entries[-1][0]
+        # Too far behind if anything is left
+        return replayed, bool(await self.redis_client.xrange(key, min=start, count=1))
+
+    async def _handle_pubsub_message(self, message: dict):
+        if message["type"] != "message":
+            return
+        chat_id = message["channel"].split(":", 1)[1]
+        origin, separator, data = message["data"].partition(ORIGIN_SEPARATOR)
+        if not separator:
+            # Published without an origin, e.g. by redis-cli
+            data = origin
+        else:
+            worker_id, _, published_at = origin.partition(" ")
+            if worker_id == self.worker_id:
+                # Already delivered by this worker when it published
+                return
+            if published_at:
+                LISTENER_LAG_SECONDS.observe(max(0.0, time.time() - float(published_at)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received from Redis", extra={ "chat_id": chat_id, "bytes": len(data) })
+        await self.handle_message(data, chat_id)
+
+    # Streams mode listener
+    # Blocks on XREAD across every chat stream this worker serves, resuming from
+    # the last delivered entry of each, so a restart never skips messages. One
+    # task for the worker's lifetime: a new subscription only restarts the read.
+    async def _stream_listener(self):
+        logger.info("Starting Redis stream listener")
+        retry_delay = LISTENER_RETRY_MIN
+        while True:
+            self.streams_changed.clear()
+            if not self.stream_cursors:
+                await self.streams_changed.wait()
+                continue
+            try:
+                response = await self._read_streams()
+                retry_delay = LISTENER_RETRY_MIN
+                delivered = 0
+                for key, entries in response or []:
+                    # Closed while the read was blocked
+                    if key not in self.stream_cursors:
+                        continue
+                    chat_id = key.split(":")[1]
+                    for entry_id, fields in entries:
+                        self.stream_cursors[key] = entry_id
+                        # Entry ids start with the time Redis appended them, in milliseconds
+                        LISTENER_LAG_SECONDS.observe(max(0.0, time.time() - parse_stream_id(entry_id)[0] / 1000))
+                        await self.handle_message(with_stream_id(fields["data"], entry_id), chat_id)
+                        delivered += 1
+                        if delivered % LISTENER_YIELD_EVERY == 0:
+                            await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error in Redis stream listener, restarting", extra={ "error": str(e), "retry_in": retry_delay })
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, LISTENER_RETRY_MAX)
+
+    # One blocking XREAD, abandoned (None) as soon as the set of streams changes
+    # Cursors only move as entries are dispatched, so an abandoned read loses nothing
+    async def _read_streams(self) -> list | None:
+        read = asyncio.ensure_future(self.redis_client.xread(
+            dict(self.stream_cursors),
+            count=settings.STREAM_BATCH_SIZE,
+            block=STREAM_BLOCK_MS,
+        ))
+        changed = asyncio.ensure_future(self.streams_changed.wait())
+        try:
+            await asyncio.wait({ read, changed }, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            changed.cancel()
+            if not read.done():
+                read.cancel()
+        return read.result() if read.done() and not read.cancelled() else None
+
+    def stats(self) -> dict:
+        return {
+            "type": "redis",
+            "delivery_mode": settings.DELIVERY_MODE,
+            "pubsub_shards": self.pubsub.stats() if self.pubsub else [],
+            "streams": len(self.stream_cursors),
+        }
+
+    async def close(self):
+        if self.listener_task:
+            self.listener_task.cancel()
+        if self.pubsub:
+            await self.pubsub.close()
+        if self.redis_client:
+            await self.redis_client.aclose()
+
+# What MemoryBrokers in one process share: subscriptions, the id counter and tails
+# Managers sharing a hub behave like workers sharing a Redis server.
+class MemoryHub:
+    def __init__(self):
+        # { ChatId: { WorkerId: handle_message } }
+        self.subscribers: dict[str, dict[str, object]] = {}
+        self.last_message_id = 0
+        # { ChatId: newest messages as published }
+        self.tails: dict[str, deque] = {}
+
+memory_hub = MemoryHub()
+
+# Keeps delivery in process, for a single worker or several managers in one test
+class MemoryBroker(Broker):
+    def __init__(self, hub: MemoryHub | None = None):
+        self.hub = hub or memory_hub
+        self.worker_id = None
+        self.handle_message = None
+        self.published = 0
+
+    async def start(self, worker_id: str, handle_message):
+        self.worker_id = worker_id
+        self.handle_message = handle_message
+        logger.info("In-memory broker initialized")
+
+    async def subscribe(self, chat_id: str):
+        self.hub.subscribers.setdefault(chat_id, {})[self.worker_id] = self.handle_message
+
+    async def unsubscribe(self, chat_id: str):
+        subscribers = self.hub.subscribers.get(chat_id)
+        if subscribers is None:
+            return
+        subscribers.pop(self.worker_id, None)
+        if not subscribers:
+            del self.hub.subscribers[chat_id]
+
+    async def publish(self, chat_id: str, data: str):
+        self.published += 1
+        for worker_id, handle_message in list(self.hub.subscribers.get(chat_id, {}).items()):
+            if worker_id != self.worker_id:
+                await handle_message(data, chat_id)
+
+    def _next_ids(self, count: int, floor: int) -> int:
+        first = max(self.hub.last_message_id, floor) + 1
+        self.hub.last_message_id = first + count - 1
+        return first
+
+    def _append_tail(self, chat_id: str, messages: list[str]):
+        tail = self.hub.tails.get(chat_id)
+        if tail is None or tail.maxlen != settings.HISTORY_CACHE_SIZE:
+            tail = self.hub.tails[chat_id] = deque(tail or (), maxlen=settings.HISTORY_CACHE_SIZE)
+        tail.extend(messages)
+
+    async def publish_message(self, chat_id: str, body: str, floor: int) -> int:
+        message_id = self._next_ids(1, floor)
+        message = message_with_id(message_id, body)
+        self._append_tail(chat_id, [message])
+        await self.publish(chat_id, message)
+        return message_id
+
+    async def publish_batch(self, chat_id: str, bodies: list[str], floor: int) -> int:
+        first_id = self._next_ids(len(bodies), floor)
+        self._append_tail(chat_id, [message_with_id(first_id + offset, body) for offset, body in enumerate(bodies)])
+        await self.publish(chat_id, batch_with_ids(chat_id, first_id, bodies))
+        return first_id
+
+    async def read_tail(self, chat_id: str) -> list[dict]:
+        return [json.loads(entry) for entry in self.hub.tails.get(chat_id, ())]
+
+    def stats(self) -> dict:
+        return {
+            "type": "memory",
+            "chats": sum(1 for s in self.hub.subscribers.values() if self.worker_id in s),
+            "published": self.published,
+        }
+
+    async def close(self):
+        for chat_id in [c for c, s in self.hub.subscribers.items() if self.worker_id in s]:
+            await self.unsubscribe(chat_id)
+
+# The broker BROKER selects
+def create_broker() -> Broker:
+    if settings.BROKER == "memory":
+        return MemoryBroker()
+    return RedisBroker()
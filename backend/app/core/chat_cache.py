@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import json
+import time
+from typing import Optional
+from app.core.config import settings
+
+# Per-user cache of the first page of GET /users/chats
+# An entry stores the serialized body, its ETag, the next page's cursor and the
+# versions it was built from: the user's own chat-set version and, for every
+# chat the user is in, its member version and activity version. create_chat /
+# add_to_chat only bump those counters and the message writer bumps a chat's
+# activity once per flushed batch, so invalidating a public room with thousands
+# of members is one INCR instead of thousands of deletes. Every chat counts, not
+# only those on the page, because a new message moves its chat to the top.
+# A busy public room would make every member's entry stale on every batch, so
+# activity only counts once an entry is USER_CHATS_ACTIVITY_DEBOUNCE seconds
+# old: each user's list is rebuilt at most that often while messages flow,
+# and the messages themselves reach the client over its socket meanwhile.
+
+def entry_key(user_id: int) -> str:
+    return f"user:{user_id}:chats"
+
+def user_version_key(user_id: int) -> str:
+    return f"user:{user_id}:chats_version"
+
+def chat_version_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:members_version"
+
+def chat_activity_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:activity_version"
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+# Chat list pages are keyed by (newest message id, chat id) of the last chat returned
+def encode_chat_cursor(activity: int, chat_id: int) -> str:
+    raw = json.dumps([activity, chat_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Returns (newest message id, chat id), or None for a missing or malformed cursor
+def decode_chat_cursor(cursor: Optional[str]) -> Optional[tuple[int, int]]:
+    if not cursor:
+        return None
+    try:
+        activity, chat_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(activity), int(chat_id)
+    except (ValueError, TypeError):
+        return None
+
+# Current "<member version>:<activity version>" of each chat, or only the member version
+async def _chat_versions(redis_client, chat_ids: list[int], activity: bool = True) -> list[str]:
+    if not chat_ids:
+        return []
+    keys = [chat_version_key(c) for c in chat_ids]
+    if not activity:
+        return [str(m or 0) for m in await redis_client.mget(keys)]
+    values = await redis_client.mget(keys + [chat_activity_key(c) for c in chat_ids])
+    return [f"{m or 0}:{a or 0}" for m, a in zip(values[:len(chat_ids)], values[len(chat_ids):])]
+
+# Returns (etag, body, next cursor) when the cached page is still current, plus the user's version
+async def get_cached_chats(redis_client, user_id: int) -> tuple[tuple[str, bytes, Optional[str]] | None, str]:
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(entry_key(user_id))
+    pipe.get(user_version_key(user_id))
+    raw, user_version = await pipe.execute()
+    user_version = user_version or "0"
+    if raw is None:
+        return None, user_version
+
+    entry = json.loads(raw)
+    if entry["user_version"] != user_version:
+        return None, user_version
+    chat_ids = list(entry["chat_versions"])
+    stored = [entry["chat_versions"][c] for c in chat_ids]
+    debounced = time.time() - entry.get("stored_at", 0) < settings.USER_CHATS_ACTIVITY_DEBOUNCE
+    if debounced:
+        stored = [version.split(":")[0] for version in stored]
+    if await _chat_versions(redis_client, [int(c) for c in chat_ids], activity=not debounced) != stored:
+        return None, user_version
+    return (entry["etag"], entry["body"].encode(), entry["next_cursor"]), user_version
+
+# Serializes a freshly queried first page, caches it and returns (etag, body)
+# Pass the user version and the read_chat_versions() of every chat the user is
+# in, both read before the query, so a change made meanwhile leaves the entry
+# stale rather than wrong
+async def store_chats(redis_client, user_id: int, user_version: str, chat_versions: dict[str, str],
+                      chats: list[dict], next_cursor: Optional[str]) -> tuple[str, bytes]:
+    body = json.dumps(chats, separators=(",", ":")).encode()
+    etag = make_etag(body)
+    entry = {
+        "user_version": user_version,
+        "chat_versions": chat_versions,
+        "etag": etag,
+        "body": body.decode(),
+        "next_cursor": next_cursor,
+        "stored_at": time.time(),
+    }
+    await redis_client.set(entry_key(user_id), json.dumps(entry), ex=settings.USER_CHATS_CACHE_TTL)
+    return etag, body
+
+# Versions to pass to store_chats, read before querying the chats
+async def read_chat_versions(redis_client, chat_ids: list[int]) -> dict[str, str]:
+    return { str(c): v for c, v in zip(chat_ids, await _chat_versions(redis_client, chat_ids)) }
+
+# Marks chat lists stale after a membership change
+# chat_ids: chats whose member list changed, user_ids: users whose set of chats changed
+async def invalidate_chats(redis_client, chat_ids: list[int], user_ids: list[int]):
+    pipe = redis_client.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipe.incr(chat_version_key(chat_id))
+    for user_id in user_ids:
+        pipe.incr(user_version_key(user_id))
+    await pipe.execute()
+
+# Marks the chat lists of these chats' members stale after new messages were stored
+async def touch_chats(redis_client, chat_ids: list[int]):
+    pipe = redis_client.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipe.incr(chat_activity_key(chat_id))
+    await pipe.execute()
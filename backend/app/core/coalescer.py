@@ -0,0 +1,116 @@
+import asyncio
+from app.core.config import settings
+from app.core.envelope import Envelope
+
+# Chats tracked for quiet detection before idle ones are pruned
+MAX_TRACKED_CHATS = 10000
+
+# Micro-batches chat messages per chat
+# A message for a chat that sent nothing in the last window goes out right
+# away, so quiet chats see no added latency. Messages that follow within the
+# window are held and published together when it closes (or once max_batch
+# are waiting): one Redis round trip and PUBLISH for the whole batch, one
+# listener wakeup on every worker and one socket write per recipient.
+class MessageCoalescer:
+    def __init__(self, publish_one, publish_batch, window: float, max_batch: int):
+        # async publish_one(chat_id, envelope) -> message id
+        self.publish_one = publish_one
+        # async publish_batch(chat_id, envelopes) -> first message id, the rest are consecutive
+        self.publish_batch = publish_batch
+        self.window = window
+        self.max_batch = max_batch
+        # { ChatId: loop time of the last publish }
+        self.last_sent: dict[str, float] = {}
+        # { ChatId: [(envelope, future)] } waiting for the window to close
+        self.pending: dict[str, list[tuple[Envelope, asyncio.Future]]] = {}
+        # { ChatId: task that flushes the chat when its window closes }
+        self.timers: dict[str, asyncio.Task] = {}
+        # Chats with a publish in flight, the next one waits so ids and delivery stay in order
+        self.inflight: set[str] = set()
+        self.batches = 0
+        self.batched_messages = 0
+        self.immediate = 0
+
+    # Publishes a message, possibly batched with others, and returns its id
+    async def submit(self, chat_id: str, envelope: Envelope) -> int:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        quiet = now - self.last_sent.get(chat_id, float("-inf")) >= self.window
+        if quiet and chat_id not in self.pending and chat_id not in self.inflight:
+            self._mark_sent(chat_id, now)
+            self.immediate += 1
+            self.inflight.add(chat_id)
+            try:
+                return await self.publish_one(chat_id, envelope)
+            finally:
+                self.inflight.discard(chat_id)
+
+        future = loop.create_future()
+        batch = self.pending.setdefault(chat_id, [])
+        batch.append((envelope, future))
+        if len(batch) >= self.max_batch:
+            timer = self.timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            self.timers[chat_id] = asyncio.create_task(self._flush_after(chat_id, 0))
+        elif chat_id not in self.timers:
+            delay = max(0.0, self.last_sent.get(chat_id, now) + self.window - now)
+            self.timers[chat_id] = asyncio.create_task(self._flush_after(chat_id, delay))
+        return await future
+
+    async def _flush_after(self, chat_id: str, delay: float):
+        await asyncio.sleep(delay)
+        while chat_id in self.inflight:
+            await asyncio.sleep(self.window)
+        if self.timers.get(chat_id) is asyncio.current_task():
+            del self.timers[chat_id]
+        await self._flush(chat_id)
+
+    async def _flush(self, chat_id: str):
+        batch = self.pending.pop(chat_id, None)
+        if not batch:
+            return
+        self._mark_sent(chat_id, asyncio.get_running_loop().time())
+        self.inflight.add(chat_id)
+        try:
+            first_id = await self.publish_batch(chat_id, [envelope for envelope, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.inflight.discard(chat_id)
+        self.batches += 1
+        self.batched_messages += len(batch)
+        for offset, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(first_id + offset)
+
+    def _mark_sent(self, chat_id: str, now: float):
+        self.last_sent[chat_id] = now
+        if len(self.last_sent) > MAX_TRACKED_CHATS:
+            cutoff = now - self.window
+            self.last_sent = { c: t for c, t in self.last_sent.items() if t >= cutoff }
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window * 1000,
+            "immediate": self.immediate,
+            "batches": self.batches,
+            "batched_messages": self.batched_messages,
+        }
+
+    # Publishes whatever is still waiting
+    async def close(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for chat_id in list(self.pending):
+            await self._flush(chat_id)
+
+# Whether messages to this chat may be coalesced
+def coalescing_enabled(chat_id: str) -> bool:
+    if settings.COALESCE_WINDOW_MS <= 0:
+        return False
+    return not settings.COALESCE_CHAT_IDS or chat_id in settings.COALESCE_CHAT_IDS
@@ -5,6 +5,179 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # Decoded tokens kept per worker so repeat requests skip signature checks
+    TOKEN_CACHE_SIZE: int = 4096
+
+    # Database connection pool, per worker process
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    # Seconds a request waits for a free connection
+    DB_POOL_TIMEOUT: float = 30.0
+
+    # Logging
+    # DEBUG logs every connect, publish and received message, keep it off in production
+    LOG_LEVEL: str = "INFO"
+    # "json" writes one JSON object per line, "text" is for reading in a terminal
+    LOG_FORMAT: str = "json"
+
+    # Monitoring
+    # Bearer token required by /stats and /metrics, both expose queue depths, connection
+    # counts and broker state. Empty turns the two endpoints off (404)
+    MONITORING_TOKEN: str = ""
+
+    # Write-behind message persistence
+    # Max messages held in memory waiting for the database
+    MESSAGE_QUEUE_SIZE: int = 10000
+    # Max rows written per INSERT
+    MESSAGE_BATCH_SIZE: int = 500
+    # Seconds a partial batch may wait before it is flushed
+    MESSAGE_FLUSH_INTERVAL: float = 0.25
+    # Seconds a sender is held back when the queue is full before the message is dropped
+    MESSAGE_ENQUEUE_TIMEOUT: float = 0.05
+
+    # Message history
+    # Newest messages kept in each chat's Redis tail list
+    HISTORY_CACHE_SIZE: int = 100
+    # Seconds an idle chat's tail list is kept
+    HISTORY_CACHE_TTL: int = 86400
+    HISTORY_PAGE_LIMIT: int = 50
+
+    # Message retention
+    # Messages older than this many days are moved to compressed archive files
+    # and dropped from the database, 0 keeps everything in the database
+    MESSAGE_RETENTION_DAYS: int = 0
+    # Directory of the archive files, every worker needs to read it
+    MESSAGE_ARCHIVE_DIR: str = "archive"
+    # Seconds between runs of the retention job
+    MESSAGE_RETENTION_INTERVAL: float = 3600.0
+    # Monthly partitions created ahead of time (PostgreSQL)
+    MESSAGE_PARTITIONS_AHEAD: int = 2
+    # Messages per compressed block in an archive file, a history page past the
+    # database decompresses one block
+    MESSAGE_ARCHIVE_BLOCK_SIZE: int = 5000
+
+    # Message search
+    MESSAGE_SEARCH_PAGE_LIMIT: int = 20
+
+    # Outbound WebSocket delivery
+    # Messages buffered per connection before the slow consumer policy applies
+    WS_SEND_QUEUE_SIZE: int = 256
+    # Seconds a single send may take before the client is evicted
+    WS_SEND_TIMEOUT: float = 5.0
+    # "disconnect" evicts clients whose queue overflows, "drop_oldest" skips their oldest messages
+    WS_SLOW_CONSUMER_POLICY: str = "disconnect"
+    # Wire formats clients may negotiate as a subprotocol, JSON is always available
+    WS_WIRE_FORMATS: list[str] = ["json", "msgpack", "json+deflate", "msgpack+deflate"]
+    # Messages smaller than this go out uncompressed in the +deflate formats
+    WS_COMPRESSION_MIN_BYTES: int = 512
+    # zlib level 1-9, compression runs once per message per worker
+    WS_COMPRESSION_LEVEL: int = 6
+
+    # Rate limits on frames clients send, token buckets per connection, user and chat
+    # Tokens per second each bucket refills at, 0 turns the scope off
+    RATE_LIMIT_CONNECTION_RATE: float = 10.0
+    RATE_LIMIT_USER_RATE: float = 20.0
+    RATE_LIMIT_CHAT_RATE: float = 200.0
+    # Most tokens a bucket holds, the size of a burst after a quiet period
+    RATE_LIMIT_CONNECTION_BURST: int = 20
+    RATE_LIMIT_USER_BURST: int = 40
+    RATE_LIMIT_CHAT_BURST: int = 400
+    # Tokens a worker takes from a shared user or chat bucket per Redis call
+    # Higher means fewer round trips but more tokens idle on workers that don't need them
+    RATE_LIMIT_LEASE: int = 5
+    # Milliseconds a frame over a limit may be held back before it is dropped
+    RATE_LIMIT_MAX_DELAY_MS: float = 250.0
+
+    # Chat message coalescing, off unless a window is set
+    # Messages following another in the same chat within this many milliseconds
+    # are published and delivered together as one "batch" frame (5-20 works well)
+    COALESCE_WINDOW_MS: float = 0.0
+    # A batch is sent early once this many messages are waiting
+    COALESCE_MAX_BATCH: int = 64
+    # Only coalesce these chats, empty means every chat
+    COALESCE_CHAT_IDS: list[str] = []
+
+    # Delivery between workers
+    # "redis" connects workers through Redis, "memory" keeps delivery, message ids
+    # and the history tail in this process (single worker runs, tests and
+    # benchmarks without a Redis server)
+    BROKER: str = "redis"
+    # "pubsub" is fire-and-forget, "streams" uses capped Redis Streams per chat so
+    # clients can reconnect with ?last_id= and have missed messages replayed
+    DELIVERY_MODE: str = "pubsub"
+    # Approximate number of entries kept in each chat's stream
+    STREAM_MAXLEN: int = 10000
+    # Max messages replayed to one reconnecting client
+    STREAM_REPLAY_LIMIT: int = 1000
+    # Entries fetched per XRANGE / XREAD call
+    STREAM_BATCH_SIZE: int = 200
+
+    # Redis subscriptions
+    # Pub/sub connections per worker, each with its own listener task
+    PUBSUB_SHARDS: int = 4
+    # Seconds a chat stays subscribed after its last local connection closes
+    SUBSCRIPTION_GRACE_SECONDS: float = 30.0
+
+    # Presence
+    # Seconds a worker's presence entries live without a heartbeat
+    PRESENCE_TTL: int = 30
+    PRESENCE_HEARTBEAT_INTERVAL: float = 10.0
+    # Seconds join/leave events are collected before one diff per chat is published
+    PRESENCE_DIFF_INTERVAL: float = 1.0
+
+    # Chats
+    # Public rooms every new user is added to
+    PUBLIC_CHAT_IDS: list[int] = [7, 8]
+    # Membership rows per INSERT when adding many at once
+    MEMBERSHIP_BATCH_SIZE: int = 1000
+
+    # Unread counters and read receipts
+    # Seconds between batched writes of read positions to the database
+    UNREAD_FLUSH_INTERVAL: float = 5.0
+    # Read positions written per UPDATE
+    UNREAD_FLUSH_BATCH_SIZE: int = 500
+    # Seconds an idle chat's read state stays in Redis, it is rebuilt from the database after
+    UNREAD_STATE_TTL: int = 604800
+    # Unread counts rebuilt from the database stop at this many
+    UNREAD_MAX_COUNT: int = 999
+    # Read receipts are broadcast only in chats with at most this many members
+    READ_RECEIPT_MAX_MEMBERS: int = 50
+
+    # Chat list
+    # Chats per page, most recently active first
+    USER_CHATS_PAGE_LIMIT: int = 50
+    # Characters of the newest message kept on the chat as its preview
+    CHAT_PREVIEW_LENGTH: int = 100
+    # Seconds a user's cached first page lives, invalidation is explicit so this only bounds memory
+    USER_CHATS_CACHE_TTL: int = 300
+    # Seconds a cached first page is still served after new messages in its chats,
+    # membership changes make it stale at once. 0 makes every new message count
+    USER_CHATS_ACTIVITY_DEBOUNCE: float = 5.0
+
+    # Chat membership cache
+    # Chats whose member sets each worker keeps in memory
+    MEMBERSHIP_CACHE_SIZE: int = 2048
+    # Seconds a local member set is trusted, a backstop for missed invalidations
+    MEMBERSHIP_LOCAL_TTL: float = 60.0
+    # Seconds the shared member set lives in Redis
+    MEMBERSHIP_CACHE_TTL: int = 3600
+
+    # User search
+    USER_SEARCH_PAGE_LIMIT: int = 20
+    # Seconds a result page is cached, new signups show up in searches after at most this long
+    USER_SEARCH_CACHE_TTL: int = 30
+
+    # Password hashing
+    # Cost factor for new hashes, existing hashes are upgraded on the user's next login
+    BCRYPT_ROUNDS: int = 12
+    # Processes in each worker's hashing pool
+    PASSWORD_HASH_WORKERS: int = 2
+    # Hashes running or queued before new ones are refused with 503
+    PASSWORD_HASH_MAX_PENDING: int = 32
+    # Hashes one username may have running or queued before 429
+    PASSWORD_HASH_MAX_PER_USER: int = 2
+    # Seconds sent in Retry-After when refusing
+    PASSWORD_HASH_RETRY_AFTER: int = 1
 
     class Config:
         env_file = ".env"
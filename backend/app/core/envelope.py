@@ -0,0 +1,133 @@
+import json
+import zlib
+from datetime import datetime, timezone
+import msgpack
+from app.core.config import settings
+
+# Everything the server sends over a WebSocket is an Envelope
+# On the wire the envelope is one flat object: its header fields under the
+# names clients and the history cache already use (message_id, chat_id,
+# sender_id, created_at) followed by the payload's own fields. The JSON form is
+# built once per publish and is what travels through Redis; each worker then
+# derives any other wire format at most once per message, however many local
+# sockets receive it.
+# Coalesced chat messages arrive as one {"type": "batch", "chat_id", "messages": [...]}
+# envelope whose messages are regular chat_message objects.
+class Envelope:
+    __slots__ = ("type", "id", "chat", "sender", "ts", "payload")
+
+    def __init__(self, type: str, chat: int | str | None = None, payload: dict | None = None,
+                 sender: int | None = None, id: int | None = None, ts: str | None = None):
+        self.type = type
+        self.id = id
+        self.chat = chat
+        self.sender = sender
+        self.ts = ts
+        self.payload = payload or {}
+
+    # Envelope for a new chat message, timestamped now, id assigned when published
+    @classmethod
+    def chat_message(cls, chat_id: int | str, sender_id: int, username: str, content: str) -> "Envelope":
+        return cls(
+            "chat_message",
+            chat=chat_id,
+            sender=sender_id,
+            ts=datetime.now(timezone.utc).isoformat(),
+            payload={ "username": username, "content": content },
+        )
+
+    def to_dict(self) -> dict:
+        data = { "type": self.type }
+        if self.id is not None:
+            data["message_id"] = self.id
+        if self.chat is not None:
+            # Connections carry chat ids as path strings, clients get the number
+            data["chat_id"] = int(self.chat) if isinstance(self.chat, str) else self.chat
+        if self.sender is not None:
+            data["sender_id"] = self.sender
+        if self.ts is not None:
+            data["created_at"] = self.ts
+        data.update(self.payload)
+        return data
+
+    def encode(self) -> str:
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    def frame(self) -> "Frame":
+        return Frame(self.encode())
+
+# Wire formats a client can ask for as its WebSocket subprotocol
+# JSON goes out as text frames; the others as binary frames, where the +deflate
+# formats start with one byte saying whether the rest is raw (0) or zlib
+# deflated (1), only messages of at least WS_COMPRESSION_MIN_BYTES are deflated
+WIRE_FORMATS = ("json", "msgpack", "json+deflate", "msgpack+deflate")
+DEFAULT_WIRE_FORMAT = "json"
+RAW_FLAG = b"\x00"
+DEFLATED_FLAG = b"\x01"
+# Largest client frame accepted once inflated
+MAX_INFLATED_BYTES = 1 << 20
+
+# Picks the first offered subprotocol we support, None means plain JSON without a subprotocol
+def negotiate_wire_format(offered: list[str]) -> str | None:
+    for subprotocol in offered:
+        if subprotocol in WIRE_FORMATS and subprotocol in settings.WS_WIRE_FORMATS:
+            return subprotocol
+    return None
+
+def deflate_frame(body: bytes) -> bytes:
+    if len(body) < settings.WS_COMPRESSION_MIN_BYTES:
+        return RAW_FLAG + body
+    return DEFLATED_FLAG + zlib.compress(body, settings.WS_COMPRESSION_LEVEL)
+
+# One outgoing message, shared by every local socket it is fanned out to
+# Holds the JSON text and caches each other encoding the first time a socket needs it
+class Frame:
+    __slots__ = ("text", "encoded")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.encoded = None
+
+    def render(self, wire_format: str) -> str | bytes:
+        if wire_format == "json":
+            return self.text
+        if self.encoded is None:
+            self.encoded = {}
+        data = self.encoded.get(wire_format)
+        if data is None:
+            data = self._encode(wire_format)
+            self.encoded[wire_format] = data
+        return data
+
+    def _encode(self, wire_format: str) -> str | bytes:
+        if wire_format == "msgpack":
+            return msgpack.packb(json.loads(self.text))
+        if wire_format == "json+deflate":
+            return deflate_frame(self.text.encode())
+        return deflate_frame(self.render("msgpack"))
+
+# Turns a frame received from a client into the JSON text the rest of the server handles
+# msgpack clients send binary frames, everyone else text
+def decode_client_frame(message: dict, wire_format: str) -> str | None:
+    if message.get("text") is not None:
+        return message["text"]
+    data = message.get("bytes")
+    if data is None:
+        return None
+    if wire_format.endswith("+deflate"):
+        if data[:1] == DEFLATED_FLAG:
+            inflater = zlib.decompressobj()
+            try:
+                data = inflater.decompress(data[1:], MAX_INFLATED_BYTES)
+            except zlib.error:
+                return None
+            if inflater.unconsumed_tail:
+                return None
+        else:
+            data = data[1:]
+    if wire_format.startswith("msgpack"):
+        try:
+            return json.dumps(msgpack.unpackb(data))
+        except (ValueError, TypeError, msgpack.ExtraData):
+            return None
+    return data.decode("utf-8", errors="replace")
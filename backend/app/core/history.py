@@ -0,0 +1,36 @@
+import json
+
+# Hot-tail cache of recent messages per chat
+# Each chat keeps its newest messages in a capped Redis list. The list is
+# appended by the same script that assigns the message id and publishes it
+# (see RedisBroker.publish_message), so it is always an exact,
+# id-ordered suffix of the chat's history.
+
+def tail_key(chat_id: str) -> str:
+    return f"chat:{chat_id}:tail"
+
+# Reads the cached tail of a chat, oldest first
+async def read_tail(redis_client, chat_id: str) -> list[dict]:
+    raw = await redis_client.lrange(tail_key(chat_id), 0, -1)
+    return [json.loads(entry) for entry in raw]
+
+# Returns up to `limit` cached messages older than before_id, oldest first,
+# and the id the database should continue below when the cache runs out
+def page_from_tail(tail: list[dict], before_id: int | None, limit: int) -> tuple[list[dict], int | None]:
+    if before_id is not None:
+        tail = [m for m in tail if m["message_id"] < before_id]
+    page = tail[-limit:]
+    if page:
+        return page, page[0]["message_id"]
+    return page, before_id
+
+# Cache entries use the wire format, history responses use the column names
+def tail_entry_to_row(entry: dict) -> dict:
+    return {
+        "id": entry["message_id"],
+        "chat_id": entry["chat_id"],
+        "sender_id": entry["sender_id"],
+        "username": entry.get("username"),
+        "content": entry["content"],
+        "created_at": entry["created_at"],
+    }
@@ -0,0 +1,59 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from app.core.config import settings
+
+# Structured logging for everything under the "app" logger
+# Modules log through logging.getLogger(__name__) and pass context with
+# extra={...}. Records are handed to a queue and written by a background
+# thread, so the event loop never waits on stdout; below LOG_LEVEL a call costs
+# one level check.
+
+# Attributes every LogRecord has, anything else came in through extra=
+RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | { "message", "asctime", "taskName" }
+
+# One JSON object per line: time, level, logger, message and the extra= fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Message followed by the extra= fields as key=value
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(f"{k}={v}" for k, v in vars(record).items() if k not in RECORD_FIELDS)
+        return f"{line} {fields}" if fields else line
+
+# Sets up the "app" logger, returns the listener writing records out
+# The listener flushes what is left when the process exits
+def configure_logging() -> QueueListener:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else TextFormatter())
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+
+    logger = logging.getLogger("app")
+    logger.handlers[:] = [QueueHandler(records)]
+    logger.setLevel(settings.LOG_LEVEL.upper())
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,151 +1,409 @@
 import asyncio
-import os
-import json
+import logging
+import time
+import uuid
 from typing import List, Dict
 from fastapi import WebSocket
-import redis.asyncio as redis
+from app.core.config import settings
+from app.core.registry import ClientConnection, ConnectionRegistry
+from app.core.presence import PresenceService
+from app.core.membership import MembershipCache
+from app.core.chat_cache import invalidate_chats
+from app.core.envelope import Envelope, Frame, DEFAULT_WIRE_FORMAT, negotiate_wire_format
+from app.core.coalescer import MessageCoalescer, coalescing_enabled
+from app.core.subscriptions import SubscriptionManager
+from app.core.unread import UnreadTracker
+from app.core.rate_limit import RateLimiter
+from app.core.metrics import (
+    PUBLISH_SECONDS,
+    PUBLISH_ERRORS,
+    FANOUT_SECONDS,
+    FANOUT_CONNECTIONS,
+    SEND_FAILURES,
+)
+from app.core.broker import (
+    create_broker,
+    message_with_id,
+    batch_with_ids,
+    parse_stream_id,
+    stream_id_of,
+)
+
+logger = logging.getLogger(__name__)
 
 # Manages all of the WebSocket connections
-# Utilizes Redis to transmit messages between all workers
+# Utilizes a broker (Redis unless BROKER says otherwise) to transmit messages between all workers
 class ConnectionManager:
-    def __init__(self):
-        # Stores all connected chats and users
-        # Keeps user ids and WebSockets in a tuple to update chat on user activity
-        # { ChatId: [(user1id, user1WebSocket), (user2id, user2WebSocket)] }
-        self.active_connections: dict[str, list[tuple[int, WebSocket]]] = {}
+    def __init__(self, broker=None):
+        # Indexes every local socket by chat and by user
+        self.registry = ConnectionRegistry()
+        self.worker_id = uuid.uuid4().hex[:12]
+        # Who is online in each chat across all workers
+        self.presence = PresenceService(self.worker_id, self.registry, self.broadcast)
+        # Who belongs to each chat, for authorizing connects and publishes
+        self.membership = MembershipCache(settings.MEMBERSHIP_CACHE_SIZE)
+        # Carries messages to the other workers
+        self.broker = broker or create_broker()
+        # Unread counts and read positions of every member
+        self.unread = UnreadTracker(self.broker.read_tail)
+        # Token buckets every frame a client sends has to pass
+        self.rate_limiter = RateLimiter()
+        self.started = False
+        # The broker's Redis connection, shared with the caches (None without Redis)
         self.redis_client = None
-        self.pubsub = None
-        self.subscribed_chats = set()
-        self.listener_task = None
-    
-    # Starts redis client
-    async def initialize_redis(self):
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-        self.redis_client = await redis.from_url(
-            redis_url,
-            encoding="utf-8",
-            decode_responses=True
+        # Which chats this worker listens to, unsubscribed after a grace period once unused
+        self.subscriptions = SubscriptionManager(self._open_chat, self._close_chat, settings.SUBSCRIPTION_GRACE_SECONDS)
+        # Opt-in micro-batching of chat messages, see COALESCE_WINDOW_MS
+        self.coalescer = MessageCoalescer(
+            self._publish_one,
+            self._publish_batch,
+            settings.COALESCE_WINDOW_MS / 1000,
+            settings.COALESCE_MAX_BATCH,
         )
-        self.pubsub = self.redis_client.pubsub()
-        print("Redis connection initialized")
+        # Fire-and-forget tasks started through spawn()
+        self.background_tasks: set[asyncio.Task] = set()
+        # Highest message id known to exist, keeps the Redis id counter from
+        # reusing ids if Redis loses its data
+        self.last_message_id = 0
     
+    # Starts the broker and the services sharing its connection
+    async def initialize_broker(self):
+        await self.broker.start(self.worker_id, self._send_to_local_connections)
+        self.redis_client = self.broker.redis_client
+        self.presence.start(self.redis_client)
+        self.membership.start(self.redis_client)
+        self.unread.start(self.redis_client)
+        self.rate_limiter.start(self.redis_client)
+        self.started = True
+    
+    # Shared Redis client, None with the in-memory broker
+    # Starts the broker on first use
+    async def get_redis(self):
+        if not self.started:
+            await self.initialize_broker()
+        return self.redis_client
+
+    # Whether a user may connect and publish to a chat
+    # Only stored chats exist, an id that isn't a number is refused
+    async def can_access(self, chat_id: str, user_id: int) -> bool:
+        if not (chat_id.isascii() and chat_id.isdigit()):
+            return False
+        await self.get_redis()
+        return await self.membership.is_member(int(chat_id), user_id)
+
+    # Call after committing membership changes
+    # chat_ids: chats whose member list changed, user_ids: users who joined them
+    async def membership_changed(self, chat_ids: list[int], user_ids: list[int]):
+        redis_client = await self.get_redis()
+        await self.membership.invalidate(chat_ids)
+        # Bumping the chats' member versions above already stales cached chat lists
+        if redis_client is not None:
+            await invalidate_chats(redis_client, [], user_ids)
+
     # Handles when users connect
-    async def connect(self, websocket: WebSocket, chat_id: str, user_id: int):
-        # Ensures redis is initialized
-        if self.redis_client is None:
-            await self.initialize_redis()
+    # In streams mode a client passing last_id first gets everything it missed
+    # Returns the connection record, which is what disconnect() takes
+    async def connect(self, websocket: WebSocket, chat_id: str, user_id: int, last_id: str | None = None) -> ClientConnection:
+        # Ensures the broker is started
+        await self.get_redis()
 
-        await websocket.accept()
+        # Clients pick a wire format by offering it as a subprotocol, JSON otherwise
+        wire_format = negotiate_wire_format(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=wire_format)
 
-        connected_user_ids = []
+        # If first user in chat room, subscribe through the broker
+        # Taken before the connection is registered, so removing it always has a subscription to release
+        await self.subscriptions.acquire(chat_id)
 
-        # Grabbing all currently connected user ids to send to user
-        if chat_id in self.active_connections:
-            connected_user_ids = [uid for uid, _ in self.active_connections[chat_id]]
-        else:
-            self.active_connections[chat_id] = []
-        
         # Adding this user to connection list
-        self.active_connections[chat_id].append((user_id, websocket))
-
-        # Sends list of all active connections back to the user
-        await websocket.send_json({
-            "type": "connected_users",
-            "user_ids": connected_user_ids
-        })
-
-        # If first user in chat room, subscribe to redis server
-        if chat_id not in self.subscribed_chats:
-            await self.pubsub.subscribe(f"chat:{chat_id}")
-            self.subscribed_chats.add(chat_id)
-        
-        # Start up redis listener
-        if self.listener_task is None or self.listener_task.done():
-            self.listener_task = asyncio.create_task(self._redis_listener())
-        
-        # Tells entire chat room that this user has joined
-        await self.broadcast_user_event(chat_id, user_id, "user_joined")
-                
-        print(f"Client connected to chat {chat_id}. Total connections: {len(self.active_connections[chat_id])}")
+        # Messages fanned out before the writer starts wait in its queue
+        first_connection = not self.registry.is_user_in_chat(chat_id, user_id)
+        connection = self.registry.add(websocket, chat_id, user_id, wire_format or DEFAULT_WIRE_FORMAT)
+        try:
+            # Grabbing all user ids online in the chat on any worker to send to user
+            # Joining also queues a user_joined for the room's next presence diff
+            if first_connection:
+                connected_user_ids = await self.presence.join(chat_id, user_id)
+            else:
+                connected_user_ids = await self.presence.snapshot(chat_id)
+
+            # Sends list of all active connections back to the user, ahead of anything already queued
+            pending = []
+            while not connection.queue.empty():
+                pending.append(connection.queue.get_nowait())
+            connection.queue.put_nowait(Envelope("connected_users", chat=chat_id, payload={ "user_ids": connected_user_ids }).frame())
+            for frame in pending:
+                connection.queue.put_nowait(frame)
+
+            if settings.DELIVERY_MODE == "streams" and last_id:
+                await self._replay(connection, last_id)
+            self.start_writer(connection)
+        except BaseException:
+            # The endpoint only disconnects connections it got back, so a connect
+            # failing half way (socket closed during the replay, Redis errors)
+            # gives back its registry entry, subscription and presence here
+            self._remove_connection(connection)
+            raise
+
+        logger.debug("Client connected", extra={ "chat_id": chat_id, "user_id": user_id, "room_size": self.registry.room_size(chat_id) })
+        return connection
+
+    # Starts delivering a chat's messages to this worker
+    async def _open_chat(self, chat_id: str):
+        await self.broker.subscribe(chat_id)
+
+    # Stops delivering a chat nobody on this worker has open anymore
+    async def _close_chat(self, chat_id: str):
+        await self.broker.unsubscribe(chat_id)
+
+    # Sends a reconnecting client the stream entries after last_id, oldest first
+    # Runs before the connection's writer starts, live messages that arrive
+    # meanwhile wait in its queue and are de-duplicated against the replay
+    async def _replay(self, connection: ClientConnection, last_id: str):
+        try:
+            cursor = parse_stream_id(last_id)
+        except ValueError:
+            return
+        replayed, truncated = await self.broker.replay(connection.chat_id, last_id)
+        for data in replayed:
+            await self._send_frame(connection, Frame(data))
+            cursor = parse_stream_id(stream_id_of(data))
+        if truncated:
+            # Too far behind, the client should page the gap through the history endpoint
+            await self._send_frame(connection, Envelope("replay_truncated", chat=connection.chat_id, payload={ "replayed": len(replayed) }).frame())
+
+        pending = []
+        while not connection.queue.empty():
+            pending.append(connection.queue.get_nowait())
+        for frame in pending:
+            stream_id = stream_id_of(frame.text)
+            if stream_id is None or parse_stream_id(stream_id) > cursor:
+                connection.queue.put_nowait(frame)
     
+    # Starts the task that drains a connection's send queue
+    def start_writer(self, connection: ClientConnection):
+        connection.writer_task = asyncio.create_task(self._connection_writer(connection))
+
     # Handles when user disconnects
-    def disconnect(self, websocket: WebSocket, chat_id: str, user_id: int):
-        print("Client disconnecting: ", websocket)
-        if chat_id in self.active_connections:
-            try:
-                self.active_connections[chat_id].remove((user_id, websocket))
-                print(f"Client disconnected from chat {chat_id}. Remaining: {len(self.active_connections[chat_id])}")
-            except ValueError:
-                print(f"WebSocket not found in chat {chat_id} connections")
-            if not self.active_connections[chat_id]:
-                del self.active_connections[chat_id]
-                print(f"Chat {chat_id} has no more connections, removed from manager.")
+    # Safe to call for a connection that was already evicted
+    def disconnect(self, connection: ClientConnection):
+        self._remove_connection(connection)
+
+    # Drops a connection from the manager and stops its writer
+    def _remove_connection(self, connection: ClientConnection):
+        if not self.registry.remove(connection):
+            return
+        chat_id = connection.chat_id
+        # Tells the chat room this user left once their last local socket in it is gone
+        if not self.registry.is_user_in_chat(chat_id, connection.user_id):
+            self.presence.leave(chat_id, connection.user_id)
+        if connection.writer_task and connection.writer_task is not asyncio.current_task():
+            connection.writer_task.cancel()
+        self.subscriptions.release(chat_id)
+        logger.debug("Client disconnected", extra={ "chat_id": chat_id, "user_id": connection.user_id, "room_size": self.registry.room_size(chat_id) })
+
+    # Closes every socket a user has open on this worker, or only those in one chat
+    def kick_user(self, user_id: int, chat_id: str | None = None):
+        for connection in self.registry.user_connections(user_id):
+            if chat_id is None or connection.chat_id == chat_id:
+                self._evict(connection, "kicked")
+
+    # Removes a connection that can't keep up and closes its socket
+    # The endpoint's receive loop then sees the disconnect and announces user_left
+    def _evict(self, connection: ClientConnection, reason: str):
+        logger.warning("Evicting connection", extra={ "chat_id": connection.chat_id, "user_id": connection.user_id, "reason": reason })
+        self._remove_connection(connection)
+        self.spawn(self._close_websocket(connection.websocket))
+
+    async def _close_websocket(self, websocket: WebSocket):
+        try:
+            # 1013: try again later
+            await asyncio.wait_for(websocket.close(code=1013), settings.WS_SEND_TIMEOUT)
+        except Exception:
+            pass
     
+    # Runs a coroutine in the background, holding on to the task until it is done
+    # so it can't be garbage collected half way, and logging what it fails with
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._background_task_done)
+        return task
+
+    def _background_task_done(self, task: asyncio.Task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error in background task", exc_info=task.exception())
+
     async def broadcast_user_event(self, chat_id: str, user_id: int, event_type: str):
-        message = json.dumps({
-            "type": event_type,
-            "user_ids": [user_id]
-        })
+        message = Envelope(event_type, chat=chat_id, payload={ "user_ids": [user_id] }).encode()
         await self.broadcast(message, chat_id)
 
-    # Sends messages to redis server
+    # Sends a message to the chat on every worker
+    # Local connections get it straight away, the broker carries it to the others
     async def broadcast(self, message: str, chat_id: str):
-        # Ensures redis is initialized
-        if self.initialize_redis is None:
-            await self.initialize_redis()
-            
+        # Ensures the broker is started
+        await self.get_redis()
+
+        if self.broker.local_delivery:
+            await self._send_to_local_connections(message, chat_id)
+        start = time.perf_counter()
         try:
-            await self.redis_client.publish(f"chat:{chat_id}", message)
-            print(f"Published message to Redis channel chat:{chat_id}")
-        except Exception as e:
-            print(f"Error publishing to Redis: {e}")
+            await self.broker.publish(chat_id, message)
+        except Exception:
+            PUBLISH_ERRORS.labels("event").inc()
+            logger.exception("Error publishing to broker", extra={ "chat_id": chat_id })
+            return
+        PUBLISH_SECONDS.labels("event").observe(time.perf_counter() - start)
+
+    # Whether a frame the client sent on connection is within the rate limits
+    # A client over a limit gets one "rate_limited" error event per refusal, with
+    # the scope (connection, user or chat) and when to try again
+    async def admit_frame(self, connection: ClientConnection) -> bool:
+        refused = await self.rate_limiter.admit(connection)
+        if refused is None:
+            return True
+        scope, retry_after = refused
+        now = time.monotonic()
+        if now >= connection.limited_until:
+            connection.limited_until = now + retry_after
+            error = Envelope("error", chat=connection.chat_id, payload={
+                "code": "rate_limited",
+                "scope": scope,
+                "retry_after_ms": max(1, round(retry_after * 1000)),
+            })
+            try:
+                connection.queue.put_nowait(error.frame())
+            except asyncio.QueueFull:
+                pass
+        return False
+
+    # Records that a user has read a chat up to message_id, 0 meaning everything
+    # Small chats are told, so members can show read receipts
+    async def mark_read(self, chat_id: str, user_id: int, message_id: int):
+        read_id = await self.unread.mark_read(int(chat_id), user_id, message_id)
+        if read_id is None:
+            return
+        if len(await self.membership.members(int(chat_id))) <= settings.READ_RECEIPT_MAX_MEMBERS:
+            receipt = Envelope("read", chat=chat_id, payload={ "user_id": user_id, "message_id": read_id })
+            await self.broadcast(receipt.encode(), chat_id)
+
+    # Publishes a chat message and returns it with its assigned id
+    async def publish_chat_message(self, chat_id: str, user_id: int, username: str, content: str) -> dict:
+        await self.get_redis()
+
+        envelope = Envelope.chat_message(int(chat_id), user_id, username, content)
+        if coalescing_enabled(chat_id):
+            envelope.id = await self.coalescer.submit(chat_id, envelope)
+        else:
+            envelope.id = await self._publish_one(chat_id, envelope)
+        return envelope.to_dict()
+
+    async def _publish_one(self, chat_id: str, envelope: Envelope) -> int:
+        # Encoded once, the broker splices the id in front
+        body = envelope.encode()[1:]
+        start = time.perf_counter()
+        try:
+            message_id = await self.broker.publish_message(chat_id, body, self.last_message_id)
+        except Exception:
+            PUBLISH_ERRORS.labels("message").inc()
+            raise
+        PUBLISH_SECONDS.labels("message").observe(time.perf_counter() - start)
+        self.last_message_id = max(self.last_message_id, message_id)
+        self.unread.published(int(chat_id), message_id, 1)
+        if self.broker.local_delivery:
+            await self._send_to_local_connections(message_with_id(message_id, body), chat_id)
+        return message_id
+
+    # Publishes several messages of one chat as one batch, returns the first id
+    async def _publish_batch(self, chat_id: str, envelopes: list[Envelope]) -> int:
+        bodies = [envelope.encode()[1:] for envelope in envelopes]
+        start = time.perf_counter()
+        try:
+            first_id = await self.broker.publish_batch(chat_id, bodies, self.last_message_id)
+        except Exception:
+            PUBLISH_ERRORS.labels("batch").inc()
+            raise
+        PUBLISH_SECONDS.labels("batch").observe(time.perf_counter() - start)
+        self.last_message_id = max(self.last_message_id, first_id + len(envelopes) - 1)
+        self.unread.published(int(chat_id), first_id + len(envelopes) - 1, len(envelopes))
+        if self.broker.local_delivery:
+            await self._send_to_local_connections(batch_with_ids(chat_id, first_id, bodies), chat_id)
+        return first_id
+
+    # Hands a message to every local connection in the chat without waiting on any socket
+    # Every socket gets the same Frame, so each wire format is encoded once per message
+    async def _send_to_local_connections(self, message: str, chat_id: str):
+        start = time.perf_counter()
+        frame = Frame(message)
+        overflowing = []
+        fanout = 0
+        for connection in self.registry.chat_connections(chat_id):
+            fanout += 1
+            try:
+                connection.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                if settings.WS_SLOW_CONSUMER_POLICY == "drop_oldest":
+                    # Degrade: this client skips its oldest pending message
+                    connection.queue.get_nowait()
+                    connection.queue.put_nowait(frame)
+                    connection.dropped += 1
+                    SEND_FAILURES.labels("dropped").inc()
+                else:
+                    overflowing.append(connection)
+
+        for connection in overflowing:
+            SEND_FAILURES.labels("queue_full").inc()
+            self._evict(connection, "send queue full")
+        if fanout:
+            FANOUT_SECONDS.observe(time.perf_counter() - start)
+            FANOUT_CONNECTIONS.observe(fanout)
+
+    # Sends a frame in the connection's wire format, text for JSON and binary otherwise
+    async def _send_frame(self, connection: ClientConnection, frame: Frame):
+        data = frame.render(connection.wire_format)
+        if isinstance(data, str):
+            await connection.websocket.send_text(data)
+        else:
+            await connection.websocket.send_bytes(data)
 
-    # Listens for messages and sends them to all subscribed entities
-    async def _redis_listener(self):
-        print("Starting Redis listener")
+    # Sends queued messages to one client, evicting it if a send fails or times out
+    async def _connection_writer(self, connection: ClientConnection):
         try:
             while True:
-                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                if message:
-                    print(f"Raw message from Redis: {message}")
-                    if message["type"] == "message":
-                        channel = message["channel"]
-                        chat_id = channel.split(":",1)[1]
-                        data = message["data"]
-                        print(f"Received from Redis - chat: {chat_id}: {data}")
-                        await self._send_to_local_connections(data, chat_id)
-                await asyncio.sleep(0.01)
+                frame = await connection.queue.get()
+                async with asyncio.timeout(settings.WS_SEND_TIMEOUT):
+                    await self._send_frame(connection, frame)
         except asyncio.CancelledError:
-            print("Redis listener cancelled")
+            raise
+        except asyncio.TimeoutError:
+            SEND_FAILURES.labels("timeout").inc()
+            self._evict(connection, "send timed out")
         except Exception as e:
-            print(f"Error in Redis listener: {e}")
-    
-    async def _send_to_local_connections(self, message: str, chat_id: str):
-        if chat_id not in self.active_connections:
-            return
-    
-        dead_connections = []
-        for user_id, connection in self.active_connections[chat_id]:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Error sending to connection: {e}")
-                dead_connections.append((user_id, connection))
-        
-        for dead_conn in dead_connections:
-            self.disconnect(dead_conn, chat_id)
+            SEND_FAILURES.labels("error").inc()
+            logger.warning("Error sending to connection", extra={ "chat_id": connection.chat_id, "user_id": connection.user_id, "error": str(e) })
+            self._evict(connection, "send failed")
     
+    # Publishes what the coalescer still holds and waits for the tasks handing it to the writer
+    async def flush_pending(self):
+        await self.coalescer.close()
+        if self.background_tasks:
+            await asyncio.wait(list(self.background_tasks), timeout=settings.WS_SEND_TIMEOUT)
+
     async def close(self):
-        if self.listener_task:
-            self.listener_task.cancel()
-        
-        if self.pubsub:
-            await self.pubsub.unsubscribe()
-            await self.pubsub.close()
+        await self.coalescer.close()
+        await self.presence.close()
+        await self.membership.close()
+        await self.unread.close()
+
+        await self.subscriptions.close()
+
+        for connection in self.registry.connections.values():
+            if connection.writer_task:
+                connection.writer_task.cancel()
         
-        if self.redis_client:
-            await self.redis_client.close()
+        await self.broker.close()
 
-        print("Redis connections closed")
+        logger.info("Broker connections closed")
 
 manager = ConnectionManager()
\ No newline at end of file
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from app.core.config import settings
+from app.core.chat_cache import chat_version_key
+from app.crud.chat import get_chat_member_ids
+from app.db.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Chat membership cache, answers "is user U in chat C" without touching the database
+# Three tiers: a per-worker LRU of member sets, a Redis set per chat shared by
+# every worker, and ChatMembership as the source of truth. Membership changes
+# bump the chat's version, drop its Redis set and announce the chat on
+# INVALIDATION_CHANNEL so every worker forgets its local copy. Without Redis
+# (the in-memory broker) the LRU sits directly in front of the database.
+INVALIDATION_CHANNEL = "membership:invalidate"
+RETRY_DELAY = 1.0
+
+def members_key(chat_id: int) -> str:
+    return f"chat:{chat_id}:members"
+
+# Replaces a chat's member set unless the membership changed while it was being read
+# KEYS: members set, version counter
+# ARGV: version read before querying the database ('' if none), TTL, member ids...
+STORE_MEMBERS_SCRIPT = """
+local current = redis.call('GET', KEYS[2]) or ''
+if current ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+class MembershipCache:
+    def __init__(self, size: int):
+        self.size = size
+        # { ChatId: (member ids, loaded at) }, least recently used first
+        self.entries: OrderedDict[int, tuple[frozenset[int], float]] = OrderedDict()
+        # Bumped on every invalidation, a load that spans one isn't kept locally
+        self.generation = 0
+        self.redis_client = None
+        self.store_script = None
+        self.listener_task = None
+        # { ChatId: task loading its members }, concurrent misses on a chat share one load
+        self.loading: dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        if redis_client is None:
+            return
+        self.store_script = redis_client.register_script(STORE_MEMBERS_SCRIPT)
+        if self.listener_task is None or self.listener_task.done():
+            self.listener_task = asyncio.create_task(self._invalidation_listener())
+
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.members(chat_id)
+
+    # Every member of a chat, online or not
+    async def members(self, chat_id: int) -> frozenset[int]:
+        entry = self.entries.get(chat_id)
+        if entry is not None and time.monotonic() - entry[1] < settings.MEMBERSHIP_LOCAL_TTL:
+            self.entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+
+        load = self.loading.get(chat_id)
+        if load is None:
+            self.misses += 1
+            load = self.loading[chat_id] = asyncio.create_task(self._load(chat_id))
+            load.add_done_callback(lambda task: self._load_done(chat_id, task))
+        else:
+            self.coalesced += 1
+        # Shielded, a caller giving up doesn't cancel the load for the others
+        return await asyncio.shield(load)
+
+    def _load_done(self, chat_id: int, task: asyncio.Task):
+        if self.loading.get(chat_id) is task:
+            del self.loading[chat_id]
+        # Marks a failure as seen when every caller has gone
+        if not task.cancelled():
+            task.exception()
+
+    # Reads a chat's members from Redis, falling back to the database, and keeps them locally
+    async def _load(self, chat_id: int) -> frozenset[int]:
+        generation = self.generation
+        cached, version = None, None
+        if self.redis_client is not None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.smembers(members_key(chat_id))
+            pipe.get(chat_version_key(chat_id))
+            cached, version = await pipe.execute()
+        if cached:
+            member_ids = frozenset(int(m) for m in cached)
+        else:
+            async with AsyncSessionLocal() as db:
+                member_ids = frozenset(await get_chat_member_ids(chat_id, db))
+            if member_ids and self.redis_client is not None:
+                await self.store_script(
+                    keys=[members_key(chat_id), chat_version_key(chat_id)],
+                    args=[version or "", settings.MEMBERSHIP_CACHE_TTL, *member_ids],
+                )
+
+        if generation == self.generation:
+            self.entries[chat_id] = (member_ids, time.monotonic())
+            self.entries.move_to_end(chat_id)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return member_ids
+
+    # Call after committing a membership change to any of these chats
+    async def invalidate(self, chat_ids: list[int]):
+        self._forget(chat_ids)
+        if self.redis_client is None:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            pipe.incr(chat_version_key(chat_id))
+            pipe.delete(members_key(chat_id))
+            pipe.publish(INVALIDATION_CHANNEL, chat_id)
+        await pipe.execute()
+
+    def _forget(self, chat_ids):
+        self.generation += 1
+        for chat_id in chat_ids:
+            self.entries.pop(chat_id, None)
+            # Callers from now on start a new load instead of joining one that may be stale
+            self.loading.pop(chat_id, None)
+
+    # Drops local entries other workers invalidated
+    # While the subscription is down nothing can be trusted, so the cache is cleared on reconnect
+    async def _invalidation_listener(self):
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                self._forget([*self.entries, *self.loading])
+                async for message in pubsub.listen():
+                    self._forget([int(message["data"])])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error in membership invalidation listener, restarting", extra={ "error": str(e), "retry_in": RETRY_DELAY })
+                await asyncio.sleep(RETRY_DELAY)
+            finally:
+                await pubsub.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "capacity": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    async def close(self):
+        if self.listener_task:
+            self.listener_task.cancel()
@@ -0,0 +1,128 @@
+import base64
+import html
+import json
+import re
+from datetime import datetime
+from typing import Optional
+
+# Message search helpers
+# Results are ranked, best first, ties newest first; the cursor is the
+# (rank, id) of the last returned message, so pages stay stable while new
+# messages arrive. The highlight is HTML: the content is escaped and matched
+# words are wrapped in HIGHLIGHT_START / HIGHLIGHT_STOP. Both highlighters mark
+# matches with MATCH_START / MATCH_STOP, control characters stripped from the
+# content beforehand, and render_highlight() swaps them for the tags once the
+# rest is escaped, so message text can never produce markup.
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_STOP = "</mark>"
+MATCH_START = "\x02"
+MATCH_STOP = "\x03"
+# Text search configuration of messages.search_vector (migration 0007)
+# "simple" only lowercases, chats mix languages so nothing is stemmed
+SEARCH_CONFIG = "simple"
+# Characters of context shown on each side of the first match
+SNIPPET_CONTEXT = 60
+WORD = re.compile(r"\w+")
+
+def encode_cursor(rank: float, message_id: int) -> str:
+    raw = json.dumps([rank, message_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Returns (rank, id), or None for a missing or malformed cursor
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[float, int]]:
+    if not cursor:
+        return None
+    try:
+        rank, message_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(rank), int(message_id)
+    except (ValueError, TypeError):
+        return None
+
+def tokenize(text: str) -> list[str]:
+    return WORD.findall(text.lower())
+
+# In-process inverted index, used when the database has no tsvector column (SQLite, tests)
+# { word: { ChatId: [message ids] } } plus the messages themselves. Messages
+# reach the database out of id order (write-behind batches from several
+# workers), so each search loads messages above last_id - REFRESH_OVERLAP and
+# skips those already indexed.
+class MessageSearchIndex:
+    REFRESH_OVERLAP = 1000
+
+    def __init__(self):
+        self.postings: dict[str, dict[int, list[int]]] = {}
+        # { MessageId: (chat id, sender id, username, content, created at) }
+        self.messages: dict[int, tuple] = {}
+        self.last_id = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, message_id: int, chat_id: int, sender_id: int, username: Optional[str], content: str, created_at: datetime):
+        if message_id in self.messages:
+            return
+        self.messages[message_id] = (chat_id, sender_id, username, content, created_at)
+        self.last_id = max(self.last_id, message_id)
+        for word in set(tokenize(content)):
+            self.postings.setdefault(word, {}).setdefault(chat_id, []).append(message_id)
+
+    # Returns up to `limit` result rows after the cursor, every query word has to match
+    def search(self, query: str, chat_ids: list[int], limit: int, after: Optional[tuple[float, int]] = None) -> list[dict]:
+        words = set(tokenize(query))
+        if not words:
+            return []
+        matches = []
+        for chat_id in chat_ids:
+            ids = None
+            for word in words:
+                found = self.postings.get(word, {}).get(chat_id)
+                if not found:
+                    ids = None
+                    break
+                ids = set(found) if ids is None else ids & set(found)
+            for message_id in ids or ():
+                rank = self._rank(words, self.messages[message_id][3])
+                if after is None or (rank, message_id) < after:
+                    matches.append((rank, message_id))
+        matches.sort(reverse=True)
+        return [self._row(message_id, rank, words) for rank, message_id in matches[:limit]]
+
+    # Share of the message's words that are query words
+    def _rank(self, words: set[str], content: str) -> float:
+        tokens = tokenize(content)
+        return round(sum(1 for token in tokens if token in words) / len(tokens), 6)
+
+    def _row(self, message_id: int, rank: float, words: set[str]) -> dict:
+        chat_id, sender_id, username, content, created_at = self.messages[message_id]
+        return {
+            "id": message_id,
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "username": username,
+            "content": content,
+            "created_at": created_at,
+            "rank": rank,
+            "highlight": highlight(content, words),
+        }
+
+# Content without the match markers, so a message can't forge one
+def strip_markers(content: str) -> str:
+    return content.replace(MATCH_START, "").replace(MATCH_STOP, "")
+
+# HTML-escapes text marked up with MATCH_START / MATCH_STOP, then turns the markers into tags
+def render_highlight(marked: str) -> str:
+    return html.escape(marked).replace(MATCH_START, HIGHLIGHT_START).replace(MATCH_STOP, HIGHLIGHT_STOP)
+
+# The part of content around the first match, escaped for HTML with matched words marked
+def highlight(content: str, words: set[str]) -> str:
+    content = strip_markers(content)
+    first = next((m.start() for m in WORD.finditer(content) if m.group().lower() in words), 0)
+    start = max(0, first - SNIPPET_CONTEXT)
+    end = min(len(content), first + SNIPPET_CONTEXT * 2)
+    snippet = WORD.sub(
+        lambda m: MATCH_START + m.group() + MATCH_STOP if m.group().lower() in words else m.group(),
+        content[start:end],
+    )
+    return ("..." if start > 0 else "") + render_highlight(snippet) + ("..." if end < len(content) else "")
+
+message_search_index = MessageSearchIndex()
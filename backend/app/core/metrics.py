@@ -0,0 +1,69 @@
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from app.core.config import settings
+
+# Prometheus metrics of this worker, served on /metrics
+# Each worker keeps its own registry, scrape every worker (or pod) separately.
+
+# Seconds, from a local enqueue to a slow cross-worker publish
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+WS_CONNECTIONS = Gauge("chatterbox_ws_connections", "Open WebSocket connections")
+SUBSCRIBED_CHATS = Gauge("chatterbox_subscribed_chats", "Chats this worker receives from the broker")
+PUBLISH_SECONDS = Histogram(
+    "chatterbox_publish_seconds",
+    "Time to hand a message to the broker",
+    ["kind"],
+    buckets=LATENCY_BUCKETS,
+)
+PUBLISH_ERRORS = Counter("chatterbox_publish_errors_total", "Publishes the broker failed", ["kind"])
+FANOUT_SECONDS = Histogram(
+    "chatterbox_fanout_seconds",
+    "Time to queue a message for every local connection in its chat",
+    buckets=LATENCY_BUCKETS,
+)
+FANOUT_CONNECTIONS = Histogram(
+    "chatterbox_fanout_connections",
+    "Local connections a message was queued for",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+SEND_FAILURES = Counter(
+    "chatterbox_send_failures_total",
+    "Messages not delivered to a connection: queue_full, dropped, timeout, error",
+    ["reason"],
+)
+LISTENER_LAG_SECONDS = Histogram(
+    "chatterbox_listener_lag_seconds",
+    "Time from publish until this worker's listener picked the message up",
+    buckets=LATENCY_BUCKETS,
+)
+RATE_LIMITED_FRAMES = Counter(
+    "chatterbox_rate_limited_frames_total",
+    "Client frames over a rate limit, by the scope that refused them: deferred or dropped",
+    ["scope", "action"],
+)
+RATE_LIMIT_CHECKS = Counter(
+    "chatterbox_rate_limit_checks_total",
+    "Rate limit decisions made from local state or with a Redis round trip",
+    ["path"],
+)
+RATE_LIMIT = Gauge("chatterbox_rate_limit", "Configured token bucket rate (tokens per second) and burst", ["scope", "kind"])
+DB_POOL_CONNECTIONS = Gauge("chatterbox_db_pool_connections", "Database pool connections by state", ["state"])
+
+# Points the gauges that read live state at the manager and the database engine
+def bind(manager, engine):
+    WS_CONNECTIONS.set_function(lambda: len(manager.registry))
+    SUBSCRIBED_CHATS.set_function(lambda: len(manager.subscriptions.active))
+    for scope in ("connection", "user", "chat"):
+        RATE_LIMIT.labels(scope, "rate").set(getattr(settings, f"RATE_LIMIT_{scope.upper()}_RATE"))
+        RATE_LIMIT.labels(scope, "burst").set(getattr(settings, f"RATE_LIMIT_{scope.upper()}_BURST"))
+    pool = engine.pool
+    # Pools without a fixed size (NullPool, StaticPool) don't count connections
+    if hasattr(pool, "checkedout"):
+        DB_POOL_CONNECTIONS.labels("size").set_function(pool.size)
+        DB_POOL_CONNECTIONS.labels("checked_out").set_function(pool.checkedout)
+        DB_POOL_CONNECTIONS.labels("idle").set_function(pool.checkedin)
+        DB_POOL_CONNECTIONS.labels("overflow").set_function(lambda: max(0, pool.overflow()))
+
+# Body and content type of a scrape
+def render() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from sqlalchemy import insert
+from app.core.config import settings
+from app.core.chat_cache import touch_chats
+from app.crud.chat import update_last_messages
+from app.db.session import AsyncSessionLocal
+from app.models import Message
+
+logger = logging.getLogger(__name__)
+
+# Write-behind persistence for chat messages
+# Messages are put on a bounded queue and a single background task writes them
+# to the database in multi-row inserts, flushing when a batch fills up or the
+# flush interval runs out. Senders never wait on a commit. The same transaction
+# records each chat's newest message on the chat row, one UPDATE per chat in the batch.
+class MessageWriter:
+    def __init__(
+        self,
+        max_queue: int = settings.MESSAGE_QUEUE_SIZE,
+        batch_size: int = settings.MESSAGE_BATCH_SIZE,
+        flush_interval: float = settings.MESSAGE_FLUSH_INTERVAL,
+        enqueue_timeout: float = settings.MESSAGE_ENQUEUE_TIMEOUT,
+    ):
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.writer_task = None
+        # Shared Redis client for marking chat lists stale, None without Redis
+        self.redis_client = None
+        # Batch being collected and the flush currently running
+        # Both are picked up by close() so nothing is lost on shutdown
+        self._batch: list[dict] = []
+        self._inflight = None
+
+        # Counters reported through stats()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    # Starts the background writer
+    def start(self, redis_client=None):
+        self.redis_client = redis_client
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self._run())
+
+    # Queues a published chat message for the database
+    # Returns False if the message was shed because the database is falling behind
+    async def enqueue(self, message: dict) -> bool:
+        chat_id = message["chat_id"]
+        row = {
+            "id": message["message_id"],
+            "chat_id": chat_id,
+            "sender_id": message["sender_id"],
+            "content": message["content"],
+            "created_at": datetime.fromisoformat(message["created_at"]),
+        }
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        # Queue is full, hold this sender back briefly before shedding the message
+        if self.enqueue_timeout > 0:
+            try:
+                await asyncio.wait_for(self.queue.put(row), self.enqueue_timeout)
+                return True
+            except asyncio.TimeoutError:
+                pass
+
+        self.dropped += 1
+        logger.warning("Message queue full, dropped message", extra={ "chat_id": chat_id, "dropped": self.dropped })
+        return False
+
+    # Collects messages into batches and writes them
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                # Take everything already waiting before sleeping on the queue
+                try:
+                    self._batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            # Shielded so cancelling the writer never abandons a half-finished insert
+            self._inflight = asyncio.create_task(self._flush(batch))
+            await asyncio.shield(self._inflight)
+
+    # Writes one batch and records how long it took
+    async def _flush(self, batch: list[dict]):
+        start = time.perf_counter()
+        try:
+            await self._write(batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error("Error writing messages", extra={ "count": len(batch), "error": str(e) })
+        elapsed = time.perf_counter() - start
+        self.last_batch_size = len(batch)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    async def _write(self, batch: list[dict]):
+        async with AsyncSessionLocal() as db:
+            # The rows go in the statement: as executemany parameters they'd be one INSERT each on asyncpg
+            await db.execute(insert(Message).values(batch))
+            await update_last_messages(batch, db)
+            await db.commit()
+        if self.redis_client is not None:
+            try:
+                await touch_chats(self.redis_client, list({ row["chat_id"] for row in batch }))
+            except Exception as e:
+                logger.warning("Error marking chat lists stale", extra={ "count": len(batch), "error": str(e) })
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 2),
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 2),
+        }
+
+    # Stops the writer and flushes whatever is still queued
+    async def close(self):
+        if self.writer_task:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+
+        if self._inflight:
+            await self._inflight
+
+        remaining, self._batch = self._batch, []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        for i in range(0, len(remaining), self.batch_size):
+            await self._flush(remaining[i:i + self.batch_size])
+
+        logger.info("Message writer closed")
+
+message_writer = MessageWriter()
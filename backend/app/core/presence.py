@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from app.core.config import settings
+from app.core.envelope import Envelope
+
+logger = logging.getLogger(__name__)
+
+# Cluster-wide presence
+# Each chat has a sorted set presence:{chat_id} whose members are "<user_id>:<worker_id>"
+# scored by the time they expire. Workers refresh their own members on a heartbeat,
+# so users on a worker that crashes age out after PRESENCE_TTL.
+# Join and leave events are not broadcast one by one: each worker collects them
+# and publishes at most one user_joined and one user_left per chat every
+# PRESENCE_DIFF_INTERVAL, with a join and leave of the same user cancelling out.
+# Without Redis (the in-memory broker) there is only this worker, so presence
+# is read from the local registry.
+WORKERS_KEY = "presence:workers"
+
+def presence_key(chat_id: str) -> str:
+    return f"presence:{chat_id}"
+
+class PresenceService:
+    def __init__(self, worker_id: str, registry, publish):
+        self.worker_id = worker_id
+        # Local connections, used to refresh this worker's members
+        self.registry = registry
+        # async publish(message, chat_id), delivers an event to the whole chat
+        self.publish = publish
+        self.redis_client = None
+        # Workers with a live heartbeat, used to tell if a user is still online elsewhere
+        self.live_workers: set[str] = {worker_id}
+        # { ChatId: { UserId: "joined" | "left" } } waiting for the next diff
+        self.pending: dict[str, dict[int, str]] = {}
+        # Members to remove from Redis with the next diff
+        self.removals: list[tuple[str, int]] = []
+        self.heartbeat_task = None
+        self.diff_task = None
+
+    def member(self, user_id: int) -> str:
+        return f"{user_id}:{self.worker_id}"
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        if redis_client is not None and (self.heartbeat_task is None or self.heartbeat_task.done()):
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        if self.diff_task is None or self.diff_task.done():
+            self.diff_task = asyncio.create_task(self._diff_loop())
+
+    # Registers a user in a chat and returns everyone online there before they joined, in one round trip
+    # Only called for the user's first connection to the chat on this worker
+    async def join(self, chat_id: str, user_id: int) -> list[int]:
+        if self.redis_client is None:
+            self._record(chat_id, user_id, "joined")
+            # The registry already holds the new connection, the only one of this user here
+            return [u for u in self.registry.chat_user_ids(chat_id) if u != user_id]
+        now = time.time()
+        key = presence_key(chat_id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrangebyscore(key, now, "+inf")
+        pipe.zadd(key, { self.member(user_id): now + settings.PRESENCE_TTL })
+        pipe.expire(key, settings.PRESENCE_TTL)
+        members, _, _ = await pipe.execute()
+        self._record(chat_id, user_id, "joined")
+        return list({ int(m.split(":", 1)[0]) for m in members })
+
+    # Everyone online in a chat, for connections that don't change presence (extra tabs)
+    async def snapshot(self, chat_id: str) -> list[int]:
+        if self.redis_client is None:
+            return self.registry.chat_user_ids(chat_id)
+        members = await self.redis_client.zrangebyscore(presence_key(chat_id), time.time(), "+inf")
+        return list({ int(m.split(":", 1)[0]) for m in members })
+
+    # Marks a user gone from a chat on this worker, Redis is updated with the next diff
+    # Only called once the user's last connection to the chat on this worker closes
+    def leave(self, chat_id: str, user_id: int):
+        self.removals.append((chat_id, user_id))
+        self._record(chat_id, user_id, "left")
+
+    def _record(self, chat_id: str, user_id: int, event: str):
+        events = self.pending.setdefault(chat_id, {})
+        if events.get(user_id, event) != event:
+            # Joined and left (or left and rejoined) within one window, nothing changed
+            del events[user_id]
+        else:
+            events[user_id] = event
+
+    # Refreshes this worker's members and collects members whose worker stopped heartbeating
+    async def _heartbeat(self):
+        now = time.time()
+        expires = now + settings.PRESENCE_TTL
+        chats = list(self.registry.chat_users.items())
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.zadd(WORKERS_KEY, { self.worker_id: expires })
+        pipe.zremrangebyscore(WORKERS_KEY, "-inf", now)
+        pipe.zrangebyscore(WORKERS_KEY, now, "+inf")
+        for chat_id, users in chats:
+            key = presence_key(chat_id)
+            pipe.zrangebyscore(key, "-inf", now)
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zadd(key, { self.member(user_id): expires for user_id in users })
+            pipe.expire(key, settings.PRESENCE_TTL)
+        results = await pipe.execute()
+
+        self.live_workers = set(results[2]) | { self.worker_id }
+        for index, (chat_id, _) in enumerate(chats):
+            for member in results[3 + index * 4]:
+                user_id, worker_id = member.split(":", 1)
+                if worker_id != self.worker_id:
+                    self._record(chat_id, int(user_id), "left")
+
+    # Applies queued removals and publishes one coalesced diff per chat
+    async def _flush_diffs(self):
+        if not self.pending and not self.removals:
+            return
+        pending, self.pending = self.pending, {}
+        removals, self.removals = self.removals, []
+        still_online = await self._apply_removals(pending, removals) if self.redis_client else set()
+
+        for chat_id, events in pending.items():
+            joined = [u for u, e in events.items() if e == "joined"]
+            left = [u for u, e in events.items() if e == "left" and (chat_id, u) not in still_online]
+            if joined:
+                await self.publish(Envelope("user_joined", chat=chat_id, payload={ "user_ids": joined }).encode(), chat_id)
+            if left:
+                await self.publish(Envelope("user_left", chat=chat_id, payload={ "user_ids": left }).encode(), chat_id)
+
+    # Removes members who left from Redis and returns the (chat, user) pairs
+    # among pending leaves that are still online through another worker
+    async def _apply_removals(self, pending: dict[str, dict[int, str]], removals: list[tuple[str, int]]) -> set[tuple[str, int]]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        removals = [(c, u) for c, u in removals if not self.registry.is_user_in_chat(c, u)]
+        for chat_id, user_id in removals:
+            pipe.zrem(presence_key(chat_id), self.member(user_id))
+        # A user who left here may still be online through another worker
+        workers = sorted(self.live_workers)
+        checks = []
+        for chat_id, events in pending.items():
+            for user_id, event in events.items():
+                if event == "left":
+                    checks.append((chat_id, user_id))
+                    pipe.zmscore(presence_key(chat_id), [f"{user_id}:{w}" for w in workers])
+        results = await pipe.execute()
+
+        now = time.time()
+        still_online = set()
+        for (chat_id, user_id), scores in zip(checks, results[len(removals):]):
+            if any(score is not None and score > now for score in scores):
+                still_online.add((chat_id, user_id))
+        return still_online
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await self._heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error in presence heartbeat", extra={ "error": str(e) })
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+
+    async def _diff_loop(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_DIFF_INTERVAL)
+            try:
+                await self._flush_diffs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error publishing presence diffs", extra={ "error": str(e) })
+
+    # Sends the last diff and removes this worker's members right away
+    async def close(self):
+        for task in (self.heartbeat_task, self.diff_task):
+            if task:
+                task.cancel()
+        if self.redis_client is None:
+            return
+        for chat_id, users in self.registry.chat_users.items():
+            for user_id in users:
+                self.leave(chat_id, user_id)
+        try:
+            await self._flush_diffs()
+            await self.redis_client.zrem(WORKERS_KEY, self.worker_id)
+        except Exception as e:
+            logger.error("Error clearing presence", extra={ "error": str(e) })
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import time
+from app.core.config import settings
+from app.core.metrics import RATE_LIMIT_CHECKS, RATE_LIMITED_FRAMES
+
+logger = logging.getLogger(__name__)
+
+# Token buckets in front of fan-out
+# Every frame a client sends takes one token from three buckets: its
+# connection's, its user's and its chat's. A bucket holds up to
+# RATE_LIMIT_<SCOPE>_BURST tokens and refills at RATE_LIMIT_<SCOPE>_RATE per
+# second, a rate of 0 turns that scope off.
+# The connection bucket lives on the connection. User and chat buckets are
+# shared by every worker: with Redis they are hashes updated by TAKE_SCRIPT,
+# which takes from both or from neither. A worker takes up to RATE_LIMIT_LEASE
+# tokens per call and spends them locally, and after a refusal it remembers
+# when the bucket has a token again, so most frames (a flood in particular)
+# are decided without Redis. Without Redis the buckets are kept in this process.
+
+# Seconds between sweeps of idle local bucket state
+PRUNE_INTERVAL = 60.0
+
+def bucket_key(scope: str, scope_id) -> str:
+    return f"ratelimit:{scope}:{scope_id}"
+
+# Refills the user and chat buckets and takes tokens from both, or from neither
+# if either is empty. Uses the server clock so every worker agrees on the time
+# KEYS: user bucket, chat bucket
+# ARGV: rate, burst, tokens wanted (0 to leave the bucket alone) of each key
+# Returns the tokens granted from each key and, when refused, the milliseconds
+# until each key has a token again (0 for one that has)
+TAKE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tokens = {}
+local waits = {0, 0}
+local refused = false
+for i = 1, 2 do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    if tonumber(ARGV[i * 3]) > 0 then
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+        tokens[i] = burst
+        if state[1] then
+            tokens[i] = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate / 1000)
+        end
+        if tokens[i] < 1 then
+            waits[i] = math.ceil((1 - tokens[i]) * 1000 / rate)
+            refused = true
+        end
+    end
+end
+if refused then
+    return {0, 0, waits[1], waits[2]}
+end
+local granted = {0, 0}
+for i = 1, 2 do
+    local wanted = tonumber(ARGV[i * 3])
+    if wanted > 0 then
+        local rate = tonumber(ARGV[i * 3 - 2])
+        local burst = tonumber(ARGV[i * 3 - 1])
+        granted[i] = math.min(wanted, math.floor(tokens[i]))
+        redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - granted[i]), 'ts', now)
+        -- A bucket left alone this long is full again, same as a missing one
+        redis.call('PEXPIRE', KEYS[i], math.ceil(burst * 1000 / rate) + 1000)
+    end
+end
+return {granted[1], granted[2], 0, 0}
+"""
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    # Refills up to now, returns 0 if a token is available or the seconds until one is
+    def wait(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    def __init__(self):
+        self.redis_client = None
+        self.take_script = None
+        # Without Redis: { bucket key: TokenBucket }
+        self.buckets: dict[str, TokenBucket] = {}
+        # With Redis: { bucket key: [leased tokens, refused until, last used] }
+        self.leases: dict[str, list] = {}
+        self.pruned_at = time.monotonic()
+        # Counters reported through stats()
+        self.allowed = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.redis_checks = 0
+        self.errors = 0
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        if redis_client is not None:
+            self.take_script = redis_client.register_script(TAKE_SCRIPT)
+
+    # Takes a token for a frame the client sent on connection
+    # A frame refused for at most RATE_LIMIT_MAX_DELAY_MS is held back and
+    # tried once more, which also slows the client's socket down
+    # Returns None if the frame may go ahead, otherwise the scope that refused
+    # it and the seconds until it would be accepted
+    async def admit(self, connection) -> tuple[str, float] | None:
+        refused = await self._take(connection)
+        if refused is not None and refused[1] * 1000 <= settings.RATE_LIMIT_MAX_DELAY_MS:
+            self.deferred += 1
+            RATE_LIMITED_FRAMES.labels(refused[0], "deferred").inc()
+            await asyncio.sleep(refused[1])
+            refused = await self._take(connection)
+        if refused is None:
+            self.allowed += 1
+            return None
+        self.dropped += 1
+        RATE_LIMITED_FRAMES.labels(refused[0], "dropped").inc()
+        return refused
+
+    async def _take(self, connection) -> tuple[str, float] | None:
+        now = time.monotonic()
+        if now - self.pruned_at > PRUNE_INTERVAL:
+            self._prune(now)
+        bucket = None
+        if settings.RATE_LIMIT_CONNECTION_RATE > 0:
+            bucket = connection.rate_bucket
+            if bucket is None:
+                bucket = connection.rate_bucket = TokenBucket(settings.RATE_LIMIT_CONNECTION_RATE, settings.RATE_LIMIT_CONNECTION_BURST)
+            wait = bucket.wait(now)
+            if wait:
+                RATE_LIMIT_CHECKS.labels("local").inc()
+                return "connection", wait
+        scopes = [
+            (scope, bucket_key(scope, scope_id), rate, burst)
+            for scope, scope_id, rate, burst in (
+                ("user", connection.user_id, settings.RATE_LIMIT_USER_RATE, settings.RATE_LIMIT_USER_BURST),
+                ("chat", connection.chat_id, settings.RATE_LIMIT_CHAT_RATE, settings.RATE_LIMIT_CHAT_BURST),
+            )
+            if rate > 0
+        ]
+        if self.redis_client is not None:
+            refused = await self._take_shared(scopes, now)
+        else:
+            refused = self._take_local(scopes, now)
+        if refused is None and bucket is not None:
+            bucket.tokens -= 1
+        return refused
+
+    def _take_local(self, scopes: list[tuple], now: float) -> tuple[str, float] | None:
+        RATE_LIMIT_CHECKS.labels("local").inc()
+        buckets = []
+        refused = None
+        for scope, key, rate, burst in scopes:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+            wait = bucket.wait(now)
+            if wait and (refused is None or wait > refused[1]):
+                refused = (scope, wait)
+            buckets.append(bucket)
+        if refused is None:
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return refused
+
+    # Spends leased tokens, going to Redis only for buckets whose lease ran out
+    async def _take_shared(self, scopes: list[tuple], now: float) -> tuple[str, float] | None:
+        leases = []
+        for scope, key, rate, burst in scopes:
+            lease = self.leases.get(key)
+            if lease is None:
+                lease = self.leases[key] = [0, 0.0, now]
+            lease[2] = now
+            if lease[1] > now:
+                RATE_LIMIT_CHECKS.labels("local").inc()
+                return scope, lease[1] - now
+            leases.append(lease)
+
+        if any(lease[0] == 0 for lease in leases):
+            refused = await self._refill(scopes, leases, now)
+            if refused is not None:
+                return refused
+        else:
+            RATE_LIMIT_CHECKS.labels("local").inc()
+        for lease in leases:
+            lease[0] -= 1
+        return None
+
+    async def _refill(self, scopes: list[tuple], leases: list[list], now: float) -> tuple[str, float] | None:
+        keys = ["", ""]
+        args = [0, 0, 0, 0, 0, 0]
+        for (scope, key, rate, burst), lease in zip(scopes, leases):
+            slot = 0 if scope == "user" else 1
+            keys[slot] = key
+            args[slot * 3:slot * 3 + 3] = [rate, burst, min(settings.RATE_LIMIT_LEASE, burst) if lease[0] == 0 else 0]
+        self.redis_checks += 1
+        RATE_LIMIT_CHECKS.labels("redis").inc()
+        try:
+            granted_user, granted_chat, wait_user, wait_chat = await self.take_script(keys=keys, args=args)
+        except Exception as e:
+            # Letting frames through beats dropping every one while Redis is away
+            self.errors += 1
+            logger.warning("Error checking rate limits", extra={ "error": str(e) })
+            return None
+        granted = { "user": granted_user, "chat": granted_chat }
+        waits = { "user": wait_user / 1000, "chat": wait_chat / 1000 }
+        refused = None
+        for (scope, key, rate, burst), lease in zip(scopes, leases):
+            if waits[scope]:
+                lease[1] = now + waits[scope]
+                if refused is None or waits[scope] > refused[1]:
+                    refused = (scope, waits[scope])
+            else:
+                lease[0] += granted[scope]
+        return refused
+
+    # Forgets buckets nobody used for a while, a full bucket is the same as a new one
+    def _prune(self, now: float):
+        self.pruned_at = now
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if now - bucket.updated < bucket.burst / bucket.rate
+        }
+        self.leases = {
+            key: lease for key, lease in self.leases.items()
+            if now - lease[2] < PRUNE_INTERVAL
+        }
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "deferred": self.deferred,
+            "dropped": self.dropped,
+            "redis_checks": self.redis_checks,
+            "errors": self.errors,
+            "buckets": len(self.buckets) + len(self.leases),
+        }
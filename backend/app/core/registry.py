@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+from fastapi import WebSocket
+from app.core.config import settings
+
+# A client's WebSocket with its own bounded outbound queue
+# Fan-out only puts messages on the queue, the writer task does the sending, so
+# one slow client can't hold up the rest of the room or the Redis listener
+# Slotted since a busy worker holds tens of thousands of these
+class ClientConnection:
+    __slots__ = ("id", "websocket", "chat_id", "user_id", "wire_format", "queue", "writer_task", "dropped", "rate_bucket", "limited_until")
+
+    def __init__(self, connection_id: int, websocket: WebSocket, chat_id: str, user_id: int, wire_format: str = "json"):
+        self.id = connection_id
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # Encoding negotiated at the handshake, see app.core.envelope
+        self.wire_format = wire_format
+        # Holds Frames, shared with every other socket the message went to
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.writer_task = None
+        # Messages discarded under the drop_oldest policy
+        self.dropped = 0
+        # Token bucket of the frames this client sends, see app.core.rate_limit
+        self.rate_bucket = None
+        # Until when (monotonic) the client has been told it is rate limited
+        self.limited_until = 0.0
+
+# Indexes this worker's connections by chat and by user
+# Every operation is O(1) except the ones that return a whole room or user,
+# which are linear in what they return. A connection belongs to exactly one
+# chat (the chat in its WebSocket path), so the record itself is the
+# connection -> chat index.
+class ConnectionRegistry:
+    def __init__(self):
+        self._next_id = itertools.count(1)
+        # { ConnectionId: connection }
+        self.connections: dict[int, ClientConnection] = {}
+        # { ChatId: { ConnectionId: connection } }
+        self.by_chat: dict[str, dict[int, ClientConnection]] = {}
+        # { UserId: { ConnectionId: connection } }
+        self.by_user: dict[int, dict[int, ClientConnection]] = {}
+        # { ChatId: { UserId: open connections } }, distinct users per room
+        self.chat_users: dict[str, dict[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __contains__(self, connection: ClientConnection) -> bool:
+        return self.connections.get(connection.id) is connection
+
+    # Registers a new connection and returns its record
+    def add(self, websocket: WebSocket, chat_id: str, user_id: int, wire_format: str = "json") -> ClientConnection:
+        connection = ClientConnection(next(self._next_id), websocket, chat_id, user_id, wire_format)
+        self.connections[connection.id] = connection
+        self.by_chat.setdefault(chat_id, {})[connection.id] = connection
+        self.by_user.setdefault(user_id, {})[connection.id] = connection
+        users = self.chat_users.setdefault(chat_id, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        return connection
+
+    # Unregisters a connection, returns False if it was already gone
+    def remove(self, connection: ClientConnection) -> bool:
+        if self.connections.pop(connection.id, None) is None:
+            return False
+        chat_id, user_id = connection.chat_id, connection.user_id
+
+        room = self.by_chat[chat_id]
+        del room[connection.id]
+        if not room:
+            del self.by_chat[chat_id]
+
+        sockets = self.by_user[user_id]
+        del sockets[connection.id]
+        if not sockets:
+            del self.by_user[user_id]
+
+        users = self.chat_users[chat_id]
+        if users[user_id] == 1:
+            del users[user_id]
+            if not users:
+                del self.chat_users[chat_id]
+        else:
+            users[user_id] -= 1
+        return True
+
+    # Connections in a chat, safe to iterate as long as nothing is added or removed meanwhile
+    def chat_connections(self, chat_id: str):
+        room = self.by_chat.get(chat_id)
+        return room.values() if room else ()
+
+    # Every socket a user has open on this worker, across chats and tabs
+    def user_connections(self, user_id: int) -> list[ClientConnection]:
+        return list(self.by_user.get(user_id, {}).values())
+
+    # Distinct users connected to a chat through this worker
+    def chat_user_ids(self, chat_id: str) -> list[int]:
+        return list(self.chat_users.get(chat_id, ()))
+
+    def has_chat(self, chat_id: str) -> bool:
+        return chat_id in self.by_chat
+
+    def is_user_in_chat(self, chat_id: str, user_id: int) -> bool:
+        return user_id in self.chat_users.get(chat_id, ())
+
+    # Number of sockets open in a chat
+    def room_size(self, chat_id: str) -> int:
+        return len(self.by_chat.get(chat_id, ()))
+
+    # Number of distinct users in a chat
+    def room_user_count(self, chat_id: str) -> int:
+        return len(self.chat_users.get(chat_id, ()))
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, select, text
+from app.core.archive import ArchiveWriter, archive_name
+from app.core.config import settings
+from app.db.session import engine
+from app.models import Message, User
+
+logger = logging.getLogger(__name__)
+
+# Monthly message partitions and the retention job
+# On PostgreSQL `messages` is partitioned by month of created_at (see migration
+# 0006). The job keeps MESSAGE_PARTITIONS_AHEAD months of partitions created
+# ahead of time and, when MESSAGE_RETENTION_DAYS is set, exports every month
+# that ended before the retention window to the archive and drops its
+# partition, so the live indexes only cover recent months. Other databases
+# keep one table and have the archived months deleted from it instead.
+# Rows outside every month partition land in messages_default. Before a month's
+# partition is created the rows the default partition holds for it are moved
+# into it, and expired months found there are given a partition and archived
+# like any other.
+# With Redis only one worker runs the job at a time.
+LOCK_KEY = "retention:lock"
+PARTITION_NAME = re.compile(r"^messages_(\d{4})_(\d{2})$")
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(start: datetime) -> datetime:
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+class RetentionJob:
+    def __init__(self):
+        self.task = None
+        self.redis_client = None
+        # Counters reported through stats()
+        self.archived_months = 0
+        self.archived_messages = 0
+        self.last_run = None
+
+    # Creates the upcoming partitions now, then runs every MESSAGE_RETENTION_INTERVAL
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error in message retention job", extra={ "error": str(e) })
+            await asyncio.sleep(settings.MESSAGE_RETENTION_INTERVAL)
+
+    async def run_once(self):
+        if self.redis_client is not None:
+            # Held until it expires, so workers take turns at most once per interval
+            if not await self.redis_client.set(LOCK_KEY, "1", nx=True, ex=max(1, int(settings.MESSAGE_RETENTION_INTERVAL))):
+                return
+        partitioned = await self._partitioned()
+        now = datetime.now(timezone.utc)
+        if partitioned:
+            await self._create_partitions(month_start(now))
+        if settings.MESSAGE_RETENTION_DAYS > 0:
+            cutoff = now - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+            for start in await self._expired_months(partitioned, cutoff):
+                await self._archive_month(start, partitioned)
+        self.last_run = now.isoformat()
+
+    async def _partitioned(self) -> bool:
+        if engine.dialect.name != "postgresql":
+            return False
+        async with engine.connect() as conn:
+            kind = await conn.scalar(text("SELECT relkind FROM pg_class WHERE relname = 'messages'"))
+        return kind == "p"
+
+    # This month's partition, the next MESSAGE_PARTITIONS_AHEAD and a default one for anything else
+    async def _create_partitions(self, start: datetime):
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT"))
+            for _ in range(settings.MESSAGE_PARTITIONS_AHEAD + 1):
+                await self._create_partition(conn, start)
+                start = next_month(start)
+
+    # PostgreSQL refuses a partition whose range has rows in the default
+    # partition, so those are moved into a plain table that is then attached
+    async def _create_partition(self, conn, start: datetime):
+        name = archive_name(start.year, start.month)
+        if await conn.scalar(text("SELECT to_regclass(:name)"), { "name": name }) is not None:
+            return
+        bounds = { "start": start, "end": next_month(start) }
+        values = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{bounds['end'].isoformat()}')"
+        await conn.execute(text("LOCK TABLE messages_default IN ACCESS EXCLUSIVE MODE"))
+        stray = await conn.scalar(text(
+            "SELECT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= :start AND created_at < :end)"
+        ), bounds)
+        if not stray:
+            await conn.execute(text(f"CREATE TABLE {name} PARTITION OF messages {values}"))
+            return
+        columns = ", ".join(column.name for column in Message.__table__.columns)
+        await conn.execute(text(
+            f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)"
+        ))
+        await conn.execute(text(
+            f"WITH moved AS (DELETE FROM messages_default WHERE created_at >= :start AND created_at < :end "
+            f"RETURNING {columns}) INSERT INTO {name} ({columns}) SELECT {columns} FROM moved"
+        ), bounds)
+        await conn.execute(text(f"ALTER TABLE messages ATTACH PARTITION {name} {values}"))
+        logger.info("Moved messages out of the default partition", extra={ "partition": name })
+
+    # Start of every stored month that ended before the cutoff, oldest first
+    async def _expired_months(self, partitioned: bool, cutoff: datetime) -> list[datetime]:
+        async with engine.connect() as conn:
+            if partitioned:
+                names = (await conn.execute(text(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "JOIN pg_class p ON p.oid = i.inhparent "
+                    "WHERE p.relname = 'messages'"
+                ))).scalars().all()
+                months = {
+                    datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=timezone.utc)
+                    for m in map(PARTITION_NAME.match, names) if m
+                }
+                # Months only the default partition has rows for
+                if "messages_default" in names:
+                    months.update((await conn.execute(text(
+                        "SELECT DISTINCT date_trunc('month', created_at, 'UTC') FROM messages_default "
+                        "WHERE created_at < :cutoff"
+                    ), { "cutoff": cutoff })).scalars().all())
+                months = sorted(months)
+            else:
+                oldest = await conn.scalar(select(func.min(Message.created_at)))
+                months = []
+                if oldest is not None:
+                    start = month_start(oldest if oldest.tzinfo else oldest.replace(tzinfo=timezone.utc))
+                    while next_month(start) <= cutoff:
+                        months.append(start)
+                        start = next_month(start)
+        return [start for start in months if next_month(start) <= cutoff]
+
+    # Exports one month to the archive, then removes it from the database
+    async def _archive_month(self, start: datetime, partitioned: bool):
+        end = next_month(start)
+        if partitioned:
+            async with engine.begin() as conn:
+                await self._create_partition(conn, start)
+        writer = ArchiveWriter(settings.MESSAGE_ARCHIVE_DIR, archive_name(start.year, start.month))
+        query = (
+            select(Message.id, Message.chat_id, Message.sender_id, User.username, Message.content, Message.created_at)
+            .outerjoin(User, User.id == Message.sender_id)
+            .where(Message.created_at >= start, Message.created_at < end)
+            .order_by(Message.chat_id, Message.id)
+            .execution_options(yield_per=settings.MESSAGE_ARCHIVE_BLOCK_SIZE)
+        )
+        await writer.open()
+        try:
+            async with engine.connect() as conn:
+                result = await conn.stream(query)
+                async for rows in result.partitions():
+                    await writer.write([row._asdict() for row in rows])
+            count = await writer.close()
+        except BaseException:
+            await writer.abort()
+            raise
+
+        async with engine.begin() as conn:
+            if partitioned:
+                name = archive_name(start.year, start.month)
+                await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+                await conn.execute(text(f"DROP TABLE {name}"))
+            else:
+                await conn.execute(Message.__table__.delete().where(Message.created_at >= start, Message.created_at < end))
+        self.archived_months += 1
+        self.archived_messages += count
+        logger.info("Archived messages", extra={ "month": start.strftime("%Y-%m"), "messages": count })
+
+    def stats(self) -> dict:
+        return {
+            "archived_months": self.archived_months,
+            "archived_messages": self.archived_messages,
+            "last_run": self.last_run,
+        }
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+
+retention_job = RetentionJob()
@@ -1,6 +1,16 @@
+import asyncio
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException, status
+from jose import JWTError, jwt
 from passlib.context import CryptContext
+from app.core.config import settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes made with other rounds still verify, and verify_and_update reports them for rehashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
 
 # Hashes passwords
 def hash_password(password: str) -> str:
@@ -8,4 +18,144 @@ def hash_password(password: str) -> str:
 
 # Verify hashes
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return pwd_context.verify(plain_password, hashed_password)
+
+# Verifies a password, returns (valid, new hash when the stored one uses outdated rounds)
+def verify_and_update(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+# Runs bcrypt in a small process pool instead of the event loop or Starlette's threadpool
+# At most PASSWORD_HASH_MAX_PENDING hashes may be running or queued per worker,
+# past that requests fail right away with 503 instead of piling up behind a
+# login burst, and one username can't hold more than PASSWORD_HASH_MAX_PER_USER
+# of those slots (429).
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int, max_per_user: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.pool = None
+        self.pending = 0
+        # { Username: hashes running or queued }
+        self.pending_by_user: dict[str, int] = {}
+        self.completed = 0
+        self.rejected = 0
+
+    # Spawned rather than forked, forking a process with a running event loop and threads is unsafe
+    def start(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def hash(self, username: str, password: str) -> str:
+        return await self._run(username, hash_password, password)
+
+    async def verify(self, username: str, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        return await self._run(username, verify_and_update, plain_password, hashed_password)
+
+    async def _run(self, username: str, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again.",
+                headers={ "Retry-After": str(settings.PASSWORD_HASH_RETRY_AFTER) },
+            )
+        if self.pending_by_user.get(username, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many attempts, please try again.",
+                headers={ "Retry-After": str(settings.PASSWORD_HASH_RETRY_AFTER) },
+            )
+
+        self.start()
+        self.pending += 1
+        self.pending_by_user[username] = self.pending_by_user.get(username, 0) + 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            if self.pending_by_user[username] == 1:
+                del self.pending_by_user[username]
+            else:
+                self.pending_by_user[username] -= 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+password_hasher = PasswordHasher(
+    settings.PASSWORD_HASH_WORKERS,
+    settings.PASSWORD_HASH_MAX_PENDING,
+    settings.PASSWORD_HASH_MAX_PER_USER,
+)
+
+# Issues a signed access token for a logged in user
+def create_access_token(user_id: int, username: str) -> str:
+    expires = datetime.now(timezone.utc) + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    claims = { "sub": str(user_id), "username": username, "exp": expires }
+    return jwt.encode(claims, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+
+# Decoded claims of recently seen tokens, least recently used evicted first
+# A token's signature only needs checking once, until it expires its claims
+# can't change, so reconnects and repeated requests skip the HMAC and JSON work
+class TokenCache:
+    def __init__(self, size: int):
+        self.size = size
+        # { Token: claims }
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> dict | None:
+        claims = self.entries.get(token)
+        if claims is None:
+            self.misses += 1
+            return None
+        if claims["exp"] <= time.time():
+            del self.entries[token]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, claims: dict):
+        self.entries[token] = claims
+        self.entries.move_to_end(token)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return { "size": len(self.entries), "capacity": self.size, "hits": self.hits, "misses": self.misses }
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE)
+
+# Verifies an access token in-process and returns its claims as { id, username, exp }
+# Raises 401 for tokens that are malformed, badly signed or expired
+def decode_access_token(token: str) -> dict:
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        claims = { "id": int(payload["sub"]), "username": payload["username"], "exp": payload["exp"] }
+    except (JWTError, KeyError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={ "WWW-Authenticate": "Bearer" },
+        )
+    token_cache.put(token, claims)
+    return claims
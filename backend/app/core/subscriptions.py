@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Backoff in seconds between listener restarts after a Redis error
+LISTENER_RETRY_MIN = 0.5
+LISTENER_RETRY_MAX = 10.0
+# Messages handled between yields to the event loop while draining a burst
+LISTENER_YIELD_EVERY = 32
+
+# Reference counts a worker's interest in chats
+# open_chat runs when the first local connection to a chat arrives. close_chat
+# runs once the last one has been gone for the whole grace period, so clients
+# that drop and reconnect (page reloads, flaky networks) don't churn
+# subscriptions.
+class SubscriptionManager:
+    def __init__(self, open_chat, close_chat, grace: float):
+        # async open_chat(chat_id) / async close_chat(chat_id)
+        self.open_chat = open_chat
+        self.close_chat = close_chat
+        self.grace = grace
+        # { ChatId: local connections }
+        self.refcounts: dict[str, int] = {}
+        # Chats currently opened
+        self.active: set[str] = set()
+        # { ChatId: task closing the chat once the grace period ends }
+        self.closing: dict[str, asyncio.Task] = {}
+
+    async def acquire(self, chat_id: str):
+        self.refcounts[chat_id] = self.refcounts.get(chat_id, 0) + 1
+        task = self.closing.pop(chat_id, None)
+        if task:
+            task.cancel()
+        if chat_id not in self.active:
+            self.active.add(chat_id)
+            try:
+                await self.open_chat(chat_id)
+            except BaseException:
+                self.active.discard(chat_id)
+                self.release(chat_id)
+                raise
+
+    def release(self, chat_id: str):
+        count = self.refcounts.get(chat_id, 0) - 1
+        if count > 0:
+            self.refcounts[chat_id] = count
+            return
+        self.refcounts.pop(chat_id, None)
+        if chat_id in self.active and chat_id not in self.closing:
+            self.closing[chat_id] = asyncio.create_task(self._close_later(chat_id))
+
+    async def _close_later(self, chat_id: str):
+        await asyncio.sleep(self.grace)
+        del self.closing[chat_id]
+        if self.refcounts.get(chat_id) or chat_id not in self.active:
+            return
+        self.active.discard(chat_id)
+        try:
+            await self.close_chat(chat_id)
+        except Exception as e:
+            logger.error("Error unsubscribing from chat", extra={ "chat_id": chat_id, "error": str(e) })
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.active),
+            "closing": len(self.closing),
+            "connections": sum(self.refcounts.values()),
+        }
+
+    async def close(self):
+        for task in self.closing.values():
+            task.cancel()
+        self.closing.clear()
+
+# One pub/sub connection with its own listener task
+# Sleeps on the socket until Redis pushes something, then drains every message
+# already buffered before waiting again. Connection errors restart the listener
+# with backoff and resubscribe this shard's channels.
+class PubSubShard:
+    def __init__(self, index: int, redis_client, handle_message):
+        self.index = index
+        self.redis_client = redis_client
+        # async handle_message(message), called for every pub/sub message
+        self.handle_message = handle_message
+        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self.channels: set[str] = set()
+        self.listener_task = None
+        self.received = 0
+
+    async def subscribe(self, channel: str):
+        await self.pubsub.subscribe(channel)
+        self.channels.add(channel)
+        if self.listener_task is None or self.listener_task.done():
+            self.listener_task = asyncio.create_task(self._listen())
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+        await self.pubsub.unsubscribe(channel)
+
+    async def _listen(self):
+        logger.info("Starting Redis listener", extra={ "shard": self.index })
+        retry_delay = LISTENER_RETRY_MIN
+        needs_reset = False
+        while True:
+            try:
+                if needs_reset:
+                    await self._reset()
+                    needs_reset = False
+                    logger.info("Redis listener reconnected", extra={ "shard": self.index })
+                async for message in self.pubsub.listen():
+                    retry_delay = LISTENER_RETRY_MIN
+                    await self.handle_message(message)
+                    drained = 1
+                    while True:
+                        message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+                        if message is None:
+                            break
+                        await self.handle_message(message)
+                        drained += 1
+                        # Let connection writers empty their queues during long bursts
+                        if drained % LISTENER_YIELD_EVERY == 0:
+                            await asyncio.sleep(0)
+                    self.received += drained
+                # listen() ends once nothing is subscribed, subscribe() starts a new listener
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error in Redis listener, restarting", extra={ "shard": self.index, "error": str(e), "retry_in": retry_delay })
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, LISTENER_RETRY_MAX)
+                needs_reset = True
+
+    # Replaces a broken pub/sub connection and resubscribes to this shard's channels
+    async def _reset(self):
+        old_pubsub = self.pubsub
+        self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await old_pubsub.aclose()
+        except Exception:
+            pass
+        if self.channels:
+            await self.pubsub.subscribe(*self.channels)
+
+    async def close(self):
+        if self.listener_task:
+            self.listener_task.cancel()
+        try:
+            await self.pubsub.aclose()
+        except Exception:
+            pass
+
+# Spreads chat channels over several pub/sub connections
+# Each shard parses its own socket in its own task, so one busy connection's
+# parsing doesn't delay every other chat on the worker. A chat always maps to
+# the same shard.
+class ShardedPubSub:
+    def __init__(self, redis_client, handle_message, shards: int):
+        self.shards = [PubSubShard(index, redis_client, handle_message) for index in range(max(1, shards))]
+
+    def shard_for(self, channel: str) -> PubSubShard:
+        return self.shards[zlib.crc32(channel.encode()) % len(self.shards)]
+
+    async def subscribe(self, channel: str):
+        await self.shard_for(channel).subscribe(channel)
+
+    async def unsubscribe(self, channel: str):
+        await self.shard_for(channel).unsubscribe(channel)
+
+    def stats(self) -> list[dict]:
+        return [
+            { "shard": shard.index, "channels": len(shard.channels), "received": shard.received }
+            for shard in self.shards
+        ]
+
+    async def close(self):
+        for shard in self.shards:
+            await shard.close()
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+from app.core.config import settings
+from app.core.history import tail_key
+from app.crud.chat import get_read_positions, store_read_positions
+from app.crud.message import count_messages_after
+from app.db.session import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Unread counters and read positions per user and chat
+# Every chat has a Redis hash (read_state_key) with how many messages it has had
+# ("total"), its newest message id ("last_id") and, per member who has read it,
+# "<total when they read>:<last message id they read>". The publish scripts bump
+# total once per message however many members the chat has, and a member's
+# unread count is total minus their read total. Acknowledged positions are
+# queued in DIRTY_KEY and written to ChatMembership.last_read_message_id in
+# batches, counts lost with Redis are rebuilt from there. Without Redis (the
+# in-memory broker) the same state is kept in this process.
+DIRTY_KEY = "reads:dirty"
+
+def read_state_key(chat_id) -> str:
+    return f"chat:{chat_id}:reads"
+
+# Moves a member's read position forward and queues it for the database
+# Messages after the acknowledged one stay unread, they are counted from the
+# chat's tail cache so a position older than the tail undercounts
+# KEYS: read state hash, tail list, dirty set
+# ARGV: user id, message id (0 for the newest), dirty set member, TTL
+# Returns the new position, 0 if it didn't move
+MARK_READ_SCRIPT = """
+local last_id = tonumber(redis.call('HGET', KEYS[1], 'last_id') or '0')
+local read_id = tonumber(ARGV[2])
+if last_id > 0 and (read_id <= 0 or read_id > last_id) then
+    read_id = last_id
+end
+if read_id <= 0 then
+    return 0
+end
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if previous and tonumber(string.match(previous, ':(%d+)$')) >= read_id then
+    return 0
+end
+local newer = 0
+if read_id < last_id then
+    local tail = redis.call('LRANGE', KEYS[2], 0, -1)
+    for i = #tail, 1, -1 do
+        if tonumber(string.match(tail[i], '^{"message_id":(%d+)')) <= read_id then
+            break
+        end
+        newer = newer + 1
+    end
+end
+local total = tonumber(redis.call('HGET', KEYS[1], 'total') or '0')
+redis.call('HSET', KEYS[1], ARGV[1], (total - newer) .. ':' .. read_id)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('SADD', KEYS[3], ARGV[3])
+return read_id
+"""
+
+class UnreadTracker:
+    # read_tail(chat_id) returns the chat's newest messages, oldest first
+    def __init__(self, read_tail):
+        self.read_tail = read_tail
+        self.redis_client = None
+        self.mark_script = None
+        self.flush_task = None
+        # Without Redis: { ChatId: [total, last id] }, { (ChatId, UserId): (read total, message id) }
+        self.chats: dict[int, list[int]] = {}
+        self.reads: dict[tuple[int, int], tuple[int, int]] = {}
+        self.dirty: set[tuple[int, int]] = set()
+        # Counters reported through stats()
+        self.marked = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def start(self, redis_client):
+        self.redis_client = redis_client
+        if redis_client is not None:
+            self.mark_script = redis_client.register_script(MARK_READ_SCRIPT)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    # Counts published messages when there is no Redis, the publish scripts do it otherwise
+    def published(self, chat_id: int, last_id: int, count: int):
+        if self.redis_client is not None:
+            return
+        state = self.chats.setdefault(chat_id, [0, 0])
+        state[0] += count
+        state[1] = max(state[1], last_id)
+
+    # Records that a user has read a chat up to message_id, 0 meaning its newest message
+    # Returns the new read position, None if it didn't move
+    async def mark_read(self, chat_id: int, user_id: int, message_id: int) -> int | None:
+        if self.redis_client is not None:
+            read_id = await self.mark_script(
+                keys=[read_state_key(chat_id), tail_key(str(chat_id)), DIRTY_KEY],
+                args=[user_id, message_id, f"{chat_id}:{user_id}", settings.UNREAD_STATE_TTL],
+            )
+        else:
+            read_id = await self._mark_read_local(chat_id, user_id, message_id)
+        if not read_id:
+            return None
+        self.marked += 1
+        return read_id
+
+    async def _mark_read_local(self, chat_id: int, user_id: int, message_id: int) -> int:
+        last_id = self.chats.get(chat_id, (0, 0))[1]
+        if last_id and (message_id <= 0 or message_id > last_id):
+            message_id = last_id
+        previous = self.reads.get((chat_id, user_id))
+        if message_id <= 0 or (previous and previous[1] >= message_id):
+            return 0
+        newer = 0
+        if message_id < last_id:
+            newer = sum(1 for m in await self.read_tail(str(chat_id)) if m["message_id"] > message_id)
+        total = self.chats.get(chat_id, (0, 0))[0]
+        self.reads[(chat_id, user_id)] = (total - newer, message_id)
+        self.dirty.add((chat_id, user_id))
+        return message_id
+
+    # Unread count and last read message id of each of the user's chats
+    # Chats the user isn't a member of are left out
+    async def counts(self, user_id: int, chat_ids: list[int]) -> dict[int, tuple[int, int | None]]:
+        if self.redis_client is not None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for chat_id in chat_ids:
+                pipe.hmget(read_state_key(chat_id), "total", str(user_id))
+            states = [
+                (int(total or 0), read and tuple(int(part) for part in read.split(":")))
+                for total, read in await pipe.execute()
+            ]
+        else:
+            states = [(self.chats.get(chat_id, (0, 0))[0], self.reads.get((chat_id, user_id))) for chat_id in chat_ids]
+
+        counts = {}
+        missing = {}
+        for chat_id, (total, read) in zip(chat_ids, states):
+            if read is None:
+                missing[chat_id] = total
+                continue
+            counts[chat_id] = (max(0, total - read[0]), read[1] or None)
+        if missing:
+            counts.update(await self._rebuild(user_id, missing))
+        return counts
+
+    # Recounts unread messages from the database and keeps the result as the read state
+    # The newest messages may not be written yet, they are counted from the tail cache
+    # missing: { ChatId: the chat's total, read before counting }
+    async def _rebuild(self, user_id: int, missing: dict[int, int]) -> dict[int, tuple[int, int | None]]:
+        counts = {}
+        async with AsyncSessionLocal() as db:
+            positions = await get_read_positions(user_id, list(missing), db)
+            for chat_id, read_id in positions.items():
+                cached = [m["message_id"] for m in await self.read_tail(str(chat_id)) if m["message_id"] > (read_id or 0)]
+                before_id = cached[0] if cached else None
+                unread = len(cached) + await count_messages_after(db, chat_id, read_id, before_id, settings.UNREAD_MAX_COUNT)
+                counts[chat_id] = (min(unread, settings.UNREAD_MAX_COUNT), read_id)
+
+        if self.redis_client is not None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for chat_id, (unread, read_id) in counts.items():
+                pipe.hsetnx(read_state_key(chat_id), str(user_id), f"{missing[chat_id] - unread}:{read_id or 0}")
+                pipe.expire(read_state_key(chat_id), settings.UNREAD_STATE_TTL)
+            await pipe.execute()
+        else:
+            for chat_id, (unread, read_id) in counts.items():
+                self.reads.setdefault((chat_id, user_id), (missing[chat_id] - unread, read_id or 0))
+        return counts
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.UNREAD_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error writing read positions", extra={ "error": str(e) })
+
+    # Writes acknowledged read positions to the database, UNREAD_FLUSH_BATCH_SIZE per UPDATE
+    # Positions that fail to write are queued again
+    async def flush(self):
+        while True:
+            taken, positions = await self._take_dirty()
+            if not taken:
+                return
+            try:
+                if positions:
+                    async with AsyncSessionLocal() as db:
+                        await store_read_positions(positions, db)
+            except Exception:
+                self.failed += len(positions)
+                await self._requeue(taken)
+                raise
+            self.flushed += len(positions)
+            if len(taken) < settings.UNREAD_FLUSH_BATCH_SIZE:
+                return
+
+    # Takes a batch off the dirty set, returns what was taken and the positions to write
+    async def _take_dirty(self) -> tuple[list, list[dict]]:
+        batch = settings.UNREAD_FLUSH_BATCH_SIZE
+        if self.redis_client is None:
+            taken = [self.dirty.pop() for _ in range(min(batch, len(self.dirty)))]
+            pairs = taken
+            reads = [self.reads.get(pair) for pair in pairs]
+        else:
+            taken = await self.redis_client.spop(DIRTY_KEY, batch) or []
+            pairs = [tuple(int(part) for part in member.split(":")) for member in taken]
+            pipe = self.redis_client.pipeline(transaction=False)
+            for chat_id, user_id in pairs:
+                pipe.hget(read_state_key(chat_id), str(user_id))
+            reads = [read and tuple(int(part) for part in read.split(":")) for read in await pipe.execute()]
+        positions = [
+            { "b_chat_id": chat_id, "b_user_id": user_id, "b_message_id": read[1] }
+            for (chat_id, user_id), read in zip(pairs, reads)
+            if read and read[1]
+        ]
+        return taken, positions
+
+    async def _requeue(self, taken: list):
+        if self.redis_client is None:
+            self.dirty.update(taken)
+        else:
+            await self.redis_client.sadd(DIRTY_KEY, *taken)
+
+    def stats(self) -> dict:
+        return { "marked": self.marked, "flushed": self.flushed, "failed": self.failed }
+
+    # Stops the flush loop and writes what is still pending
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error("Error writing read positions", extra={ "error": str(e) })
@@ -0,0 +1,110 @@
+import base64
+import bisect
+import json
+from typing import Optional
+from app.core.config import settings
+
+# User search helpers
+# Results are ordered by (bucket, lowercase username, id) where bucket 0 holds
+# usernames starting with the query and bucket 1 the other substring matches.
+# The cursor is the last returned key, so pages are stable while users sign up.
+
+def encode_cursor(bucket: int, name: str, user_id: int) -> str:
+    raw = json.dumps([bucket, name, user_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Returns (bucket, name, id), or None for a missing or malformed cursor
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[int, str, int]]:
+    if not cursor:
+        return None
+    try:
+        bucket, name, user_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(bucket), str(name), int(user_id)
+    except (ValueError, TypeError):
+        return None
+
+# In-process search index, used when the database has no trigram index (SQLite, tests)
+# Prefix matches come from a sorted list of lowercase names via bisect. Substring
+# matches come from trigram posting lists: every name is filed, in result order,
+# under each run of TRIGRAM characters it contains, and a search checks the names
+# under the query's rarest trigram from the cursor on, stopping once the page is
+# full. Queries shorter than a trigram walk the sorted names the same way. Users
+# are never renamed or deleted, so the index only grows: each search first loads
+# users with an id above the highest one seen, which also picks up signups on
+# other workers.
+TRIGRAM = 3
+
+def trigrams(name: str) -> set[str]:
+    return { name[i:i + TRIGRAM] for i in range(len(name) - TRIGRAM + 1) }
+
+class UserSearchIndex:
+    def __init__(self):
+        # [(lowercase username, id)], sorted
+        self.names: list[tuple[str, int]] = []
+        # { UserId: username }
+        self.usernames: dict[int, str] = {}
+        # { trigram: [(lowercase username, id)] }, each list sorted
+        self.postings: dict[str, list[tuple[str, int]]] = {}
+        self.last_id = 0
+
+    def __len__(self) -> int:
+        return len(self.usernames)
+
+    def add(self, user_id: int, username: str):
+        if user_id in self.usernames:
+            return
+        self.usernames[user_id] = username
+        self.last_id = max(self.last_id, user_id)
+        key = (username.lower(), user_id)
+        bisect.insort(self.names, key)
+        for trigram in trigrams(key[0]):
+            bisect.insort(self.postings.setdefault(trigram, []), key)
+
+    def _prefix_matches(self, query: str) -> list[tuple[str, int]]:
+        start = bisect.bisect_left(self.names, (query, 0))
+        end = bisect.bisect_left(self.names, (query + "\uffff", 0))
+        return self.names[start:end]
+
+    # Sorted names that may contain the query, a superset of those that do
+    def _candidates(self, query: str) -> list[tuple[str, int]]:
+        if len(query) < TRIGRAM:
+            return self.names
+        return min((self.postings.get(trigram, []) for trigram in trigrams(query)), key=len)
+
+    # Returns up to `limit` (bucket, lowercase name, id) keys after the cursor
+    def search(self, query: str, limit: int, after: Optional[tuple[int, str, int]] = None) -> list[tuple[int, str, int]]:
+        query = query.lower()
+        results = []
+        if after is None or after[0] == 0:
+            prefix = self._prefix_matches(query)
+            if after is not None:
+                prefix = prefix[bisect.bisect_right(prefix, (after[1], after[2])):]
+            results = [(0, name, user_id) for name, user_id in prefix[:limit]]
+            if len(results) == limit:
+                return results
+            after = None
+        # Every name starts with the empty query
+        if not query:
+            return results
+
+        candidates = self._candidates(query)
+        i = 0 if after is None else bisect.bisect_right(candidates, (after[1], after[2]))
+        while len(results) < limit and i < len(candidates):
+            name, user_id = candidates[i]
+            if query in name and not name.startswith(query):
+                results.append((1, name, user_id))
+            i += 1
+        return results
+
+user_search_index = UserSearchIndex()
+
+# Short-lived cache of result pages, typing a name sends the same prefixes over and over
+def cache_key(query: str, cursor: Optional[str], limit: int) -> str:
+    return f"user_search:{limit}:{cursor or ''}:{query.lower()}"
+
+async def get_cached_page(redis_client, query: str, cursor: Optional[str], limit: int) -> Optional[dict]:
+    raw = await redis_client.get(cache_key(query, cursor, limit))
+    return json.loads(raw) if raw else None
+
+async def store_page(redis_client, query: str, cursor: Optional[str], limit: int, page: dict):
+    await redis_client.set(cache_key(query, cursor, limit), json.dumps(page), ex=settings.USER_SEARCH_CACHE_TTL)
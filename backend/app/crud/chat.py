@@ -1,53 +1,183 @@
-from sqlalchemy.orm import Session
+from itertools import islice
+from sqlalchemy import and_, bindparam, func, literal_column, or_, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException, status
+from app.core.config import settings
 from app.models import Chats, ChatMembership
 from app.schemas.chats import ChatCreate
-from typing import List
+from typing import Iterable, List, Optional
 
 # Writes a new chat in database
-def create_chat(db: Session, chat_in: ChatCreate) -> Chats:
+async def create_chat(db: AsyncSession, chat_in: ChatCreate) -> Chats:
     db_chat = Chats(name=chat_in.name, is_group=chat_in.is_group)
     db.add(db_chat)
-    db.flush()
-    memberships = [
-        ChatMembership(user_id=user_id, chat_id=db_chat.id)
-        for user_id in chat_in.user_ids
-    ]
-    db.add_all(memberships)
     try:
-        db.commit()
-        db.refresh(db_chat)
+        await db.flush()
+        await insert_memberships(((user_id, db_chat.id) for user_id in chat_in.user_ids), db)
+        await db.commit()
+        await db.refresh(db_chat, attribute_names=["memberships"])
         return db_chat
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Error creating new chat"
         )
 
-# Retrieves chats from database
-def get_user_chats(user_id: int, db: Session) -> List[Chats]:
-    return (
-        db.query(Chats)
-        .join(ChatMembership, ChatMembership.chat_id == Chats.id)
-        .filter(ChatMembership.user_id == user_id)
-        .all()
+# Retrieves a page of a user's chats with every chat's member ids, in a single query
+# Most recently active first: ordered by (newest message id, chat id) descending,
+# chats without messages last. Pass the last returned chat's chat_cursor() as
+# after to get the next page. The page is picked first, walking ix_chats_activity
+# and the user's memberships, then members are aggregated (array_agg on
+# Postgres, group_concat elsewhere) for the chats on the page only.
+async def get_user_chats(user_id: int, db: AsyncSession, limit: int, after: Optional[tuple[int, int]] = None) -> List[dict]:
+    postgres = db.get_bind().dialect.name == "postgresql"
+    # A literal 0, the expression has to match the index's to use it
+    activity = func.coalesce(Chats.last_message_id, literal_column("0"))
+    page = (
+        select(
+            Chats.id,
+            Chats.name,
+            Chats.is_group,
+            activity.label("activity"),
+            Chats.last_message_id,
+            Chats.last_message_at,
+            Chats.last_message_sender_id,
+            Chats.last_message_preview,
+        )
+        .join(ChatMembership, and_(ChatMembership.chat_id == Chats.id, ChatMembership.user_id == user_id))
     )
+    if after is not None:
+        page = page.where(tuple_(activity, Chats.id) < tuple_(after[0], after[1]))
+    page = page.order_by(activity.desc(), Chats.id.desc()).limit(limit).subquery()
 
-# Updates chats in database
-def add_to_chat(user_ids: List[int], chat_id: int, db: Session) -> str:
-    memberships = [
-        ChatMembership(user_id=user_id, chat_id=chat_id)
-        for user_id in user_ids
-    ]
-    db.add_all(memberships)
+    aggregate = func.array_agg if postgres else func.group_concat
+    members = (
+        select(aggregate(ChatMembership.user_id))
+        .where(ChatMembership.chat_id == page.c.id)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        select(page, members.label("members")).order_by(page.c.activity.desc(), page.c.id.desc())
+    )
+    chats = []
+    for row in result:
+        member_ids = row.members if postgres else [int(m) for m in row.members.split(",")]
+        chats.append({
+            "id": row.id,
+            "name": row.name,
+            "is_group": row.is_group,
+            "members": member_ids,
+            "last_message_id": row.last_message_id,
+            "last_message_at": row.last_message_at.isoformat() if row.last_message_at else None,
+            "last_message_sender_id": row.last_message_sender_id,
+            "last_message_preview": row.last_message_preview,
+        })
+    return chats
+
+# Position of a chat in get_user_chats order
+def chat_cursor(chat: dict) -> tuple[int, int]:
+    return chat["last_message_id"] or 0, chat["id"]
+
+# Ids of every chat a user is in
+async def get_user_chat_ids(user_id: int, db: AsyncSession) -> List[int]:
+    result = await db.execute(select(ChatMembership.chat_id).where(ChatMembership.user_id == user_id))
+    return result.scalars().all()
+
+# Records the newest message of each chat, a chat's newest message only ever moves forward
+# messages: rows as the message writer inserts them, several per chat are fine
+async def update_last_messages(messages: List[dict], db: AsyncSession):
+    newest = {}
+    for message in messages:
+        current = newest.get(message["chat_id"])
+        if current is None or message["id"] > current["id"]:
+            newest[message["chat_id"]] = message
+    chats = Chats.__table__
+    statement = (
+        update(chats)
+        .where(
+            chats.c.id == bindparam("b_chat_id"),
+            or_(chats.c.last_message_id.is_(None), chats.c.last_message_id < bindparam("b_id")),
+        )
+        .values(
+            last_message_id=bindparam("b_id"),
+            last_message_at=bindparam("b_created_at"),
+            last_message_sender_id=bindparam("b_sender_id"),
+            last_message_preview=bindparam("b_preview"),
+        )
+    )
+    await db.execute(statement, [
+        {
+            "b_chat_id": chat_id,
+            "b_id": message["id"],
+            "b_created_at": message["created_at"],
+            "b_sender_id": message["sender_id"],
+            "b_preview": message["content"][:settings.CHAT_PREVIEW_LENGTH],
+        }
+        for chat_id, message in newest.items()
+    ])
+
+# Retrieves the member ids of a chat
+async def get_chat_member_ids(chat_id: int, db: AsyncSession) -> List[int]:
+    result = await db.execute(select(ChatMembership.user_id).where(ChatMembership.chat_id == chat_id))
+    return result.scalars().all()
+
+# Queues INSERTs of (user_id, chat_id) pairs, skipping pairs that already exist
+# One multi-row INSERT ... VALUES ... ON CONFLICT DO NOTHING per MEMBERSHIP_BATCH_SIZE
+# rows. The rows go in the statement itself: passed as executemany parameters
+# they would be one INSERT per row on asyncpg. Doesn't commit.
+async def insert_memberships(memberships: Iterable[tuple[int, int]], db: AsyncSession):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    rows = ({ "user_id": user_id, "chat_id": chat_id } for user_id, chat_id in memberships)
+    while batch := list(islice(rows, settings.MEMBERSHIP_BATCH_SIZE)):
+        await db.execute(
+            dialect.insert(ChatMembership).values(batch).on_conflict_do_nothing(index_elements=["user_id", "chat_id"])
+        )
+
+# Adds every user to every chat in one commit, retries and repeats are no-ops
+async def add_memberships(user_ids: Iterable[int], chat_ids: Iterable[int], db: AsyncSession):
+    chat_ids = list(chat_ids)
     try:
-        db.commit()
-        return "Successfully added to chat!"
+        await insert_memberships(((u, c) for u in user_ids for c in chat_ids), db)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error adding user to chat"
-        )
\ No newline at end of file
+        )
+
+# Updates chats in database
+async def add_to_chat(user_ids: List[int], chat_id: int, db: AsyncSession) -> str:
+    await add_memberships(user_ids, [chat_id], db)
+    return "Successfully added to chat!"
+
+# Last message id the user has read in each of these chats, None if they haven't read it
+# Chats the user isn't a member of are left out
+async def get_read_positions(user_id: int, chat_ids: List[int], db: AsyncSession) -> dict[int, Optional[int]]:
+    result = await db.execute(
+        select(ChatMembership.chat_id, ChatMembership.last_read_message_id)
+        .where(ChatMembership.user_id == user_id, ChatMembership.chat_id.in_(chat_ids))
+    )
+    return { row.chat_id: row.last_read_message_id for row in result }
+
+# Stores read positions, each only ever moves forward
+# positions: { "b_chat_id", "b_user_id", "b_message_id" } dicts, sent as one executemany UPDATE
+async def store_read_positions(positions: List[dict], db: AsyncSession):
+    memberships = ChatMembership.__table__
+    statement = (
+        update(memberships)
+        .where(
+            memberships.c.chat_id == bindparam("b_chat_id"),
+            memberships.c.user_id == bindparam("b_user_id"),
+            or_(
+                memberships.c.last_read_message_id.is_(None),
+                memberships.c.last_read_message_id < bindparam("b_message_id"),
+            ),
+        )
+        .values(last_read_message_id=bindparam("b_message_id"))
+    )
+    await db.execute(statement, positions)
+    await db.commit()
@@ -0,0 +1,92 @@
+from sqlalchemy import Float, and_, cast, func, literal_column, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import Message, User
+from app.core.message_search import (
+    MATCH_START,
+    MATCH_STOP,
+    SEARCH_CONFIG,
+    message_search_index,
+    render_highlight,
+)
+from typing import List, Optional
+
+# Returns up to `limit` messages of a chat older than before_id, newest first
+# Keyset pagination over the (chat_id, id) index, so deep pages cost the same as the first
+async def get_chat_messages(db: AsyncSession, chat_id: int, before_id: Optional[int], limit: int) -> List[dict]:
+    query = (
+        select(
+            Message.id,
+            Message.chat_id,
+            Message.sender_id,
+            User.username,
+            Message.content,
+            Message.created_at,
+        )
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(Message.chat_id == chat_id)
+    )
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    result = await db.execute(query.order_by(Message.id.desc()).limit(limit))
+    return [row._asdict() for row in result]
+
+# Highest message id written so far
+async def get_last_message_id(db: AsyncSession) -> int:
+    return await db.scalar(select(func.max(Message.id))) or 0
+
+# Messages of a chat newer than after_id (all of them for None) and older than
+# before_id (if given), counting no further than limit
+async def count_messages_after(db: AsyncSession, chat_id: int, after_id: Optional[int], before_id: Optional[int], limit: int) -> int:
+    query = select(Message.id).where(Message.chat_id == chat_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    return await db.scalar(select(func.count()).select_from(query.limit(limit).subquery()))
+
+# Searches the messages of these chats, best match first, ties newest first
+# Returns up to `limit` rows (message columns, username, rank, highlight) after the (rank, id) cursor
+# Postgres answers from the GIN index on messages.search_vector (migration 0007),
+# other databases from the in-process index. Archived months aren't searched.
+async def search_messages(db: AsyncSession, query: str, chat_ids: List[int], limit: int, after: Optional[tuple[float, int]] = None) -> List[dict]:
+    if db.get_bind().dialect.name != "postgresql":
+        await refresh_search_index(db)
+        return message_search_index.search(query, chat_ids, limit, after)
+
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    # Generated from content by the database, so it isn't a model column
+    search_vector = literal_column("messages.search_vector")
+    rank = cast(func.ts_rank_cd(search_vector, tsquery), Float)
+    page = (
+        select(Message.id, Message.chat_id, Message.sender_id, Message.content, Message.created_at, rank.label("rank"))
+        .where(Message.chat_id.in_(chat_ids), search_vector.op("@@")(tsquery))
+    )
+    if after is not None:
+        page = page.where(or_(rank < after[0], and_(rank == after[0], Message.id < after[1])))
+    page = page.order_by(rank.desc(), Message.id.desc()).limit(limit).subquery()
+    # Highlighting is the expensive part, it only runs for the page
+    # ts_headline doesn't escape, it marks matches with the sentinels and
+    # render_highlight() escapes the rest
+    headline = func.ts_headline(
+        SEARCH_CONFIG,
+        func.translate(page.c.content, MATCH_START + MATCH_STOP, ""),
+        tsquery,
+        f'StartSel="{MATCH_START}", StopSel="{MATCH_STOP}", MaxWords=30, MinWords=10, MaxFragments=2',
+    )
+    result = await db.execute(
+        select(page, User.username, headline.label("highlight"))
+        .outerjoin(User, User.id == page.c.sender_id)
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+    return [{ **row._asdict(), "highlight": render_highlight(row.highlight) } for row in result]
+
+# Loads messages written since the last search into the in-process index
+async def refresh_search_index(db: AsyncSession):
+    result = await db.execute(
+        select(Message.id, Message.chat_id, Message.sender_id, User.username, Message.content, Message.created_at)
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(Message.id > message_search_index.last_id - message_search_index.REFRESH_OVERLAP)
+        .order_by(Message.id)
+    )
+    for row in result:
+        message_search_index.add(*row)
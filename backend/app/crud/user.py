@@ -1,40 +1,81 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, case, func, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException, status
 from app.models import User
 from app.schemas.user import UserCreate
-from app.core.security import hash_password
-from typing import List
+from app.core.security import password_hasher
+from app.core.user_search import user_search_index
+from app.crud.chat import insert_memberships
+from typing import Iterable, List, Optional
 
-# Writes new user in database
-def create_user(db: Session, user_in: UserCreate) -> User:
-    hashed_pw = hash_password(user_in.password)
+# Writes new user in database, member of chat_ids from the same commit
+# A failed signup leaves neither the user nor any of its memberships behind
+async def create_user(db: AsyncSession, user_in: UserCreate, chat_ids: Iterable[int] = ()) -> User:
+    hashed_pw = await password_hasher.hash(user_in.username, user_in.password)
     db_user = User(username=user_in.username, email=user_in.email, hashed_password=hashed_pw)
     db.add(db_user)
     try:
-        db.commit()
-        db.refresh(db_user)
+        await db.flush()
+        await insert_memberships(((db_user.id, chat_id) for chat_id in chat_ids), db)
+        await db.commit()
+        await db.refresh(db_user)
         return db_user
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Username or email already registered."
         )
 
-# Retrieves users from database
-def search_users(db: Session, query: str, limit: int = 20) -> List[User]:
-    return (
-        db.query(User)
-        .filter(
-            (User.username.ilike(f"%{query}%"))
-        ).limit(limit).all()
+# Retrieves a user by username
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[User]:
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
+
+def escape_like(query: str) -> str:
+    return query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# Searches usernames containing the query, prefix matches first
+# Returns up to `limit` (bucket, lowercase name, id, username) rows after the cursor key
+# Postgres answers from the trigram index on users.username (migration 0002),
+# other databases from the in-process index
+async def search_users(db: AsyncSession, query: str, limit: int = 20, after: Optional[tuple] = None) -> List[tuple]:
+    if db.get_bind().dialect.name != "postgresql":
+        await refresh_search_index(db)
+        keys = user_search_index.search(query, limit, after)
+        return [(bucket, name, user_id, user_search_index.usernames[user_id]) for bucket, name, user_id in keys]
+
+    pattern = escape_like(query)
+    bucket = case((User.username.ilike(f"{pattern}%", escape="\\"), 0), else_=1)
+    name = func.lower(User.username)
+    statement = select(bucket, name, User.id, User.username).where(User.username.ilike(f"%{pattern}%", escape="\\"))
+    if after is not None:
+        after_bucket, after_name, after_id = after
+        statement = statement.where(or_(
+            bucket > after_bucket,
+            and_(bucket == after_bucket, tuple_(name, User.id) > tuple_(after_name, after_id)),
+        ))
+    result = await db.execute(statement.order_by(bucket, name, User.id).limit(limit))
+    return [tuple(row) for row in result]
+
+# Loads users created since the last search into the in-process index
+async def refresh_search_index(db: AsyncSession):
+    result = await db.execute(
+        select(User.id, User.username).where(User.id > user_search_index.last_id).order_by(User.id)
     )
+    for user_id, username in result:
+        user_search_index.add(user_id, username)
+
+# Replaces a user's password hash, used to upgrade hashes after BCRYPT_ROUNDS changes
+async def update_password_hash(db: AsyncSession, user: User, hashed_password: str):
+    user.hashed_password = hashed_password
+    await db.commit()
 
 # Retrieves users from database
-def get_users_by_id(db: Session, user_ids: List[int]) -> List[User]:
-    return(
-        db.query(User)
+async def get_users_by_id(db: AsyncSession, user_ids: List[int]) -> List[User]:
+    result = await db.execute(
+        select(User)
         .where(User.id.in_(user_ids))
     )
-    
\ No newline at end of file
+    return result.scalars().all()
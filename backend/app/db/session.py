@@ -1,19 +1,38 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from app.core.config import settings
 
-engine = create_engine(
-    settings.DATABASE_URL,
+# Picks an async driver for the configured URL
+# Plain postgresql:// URLs (psycopg2, which Alembic still uses) get asyncpg, sqlite gets aiosqlite
+def async_database_url(url: str) -> str:
+    database_url = make_url(url)
+    if database_url.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        database_url = database_url.set(drivername="postgresql+asyncpg")
+    elif database_url.drivername == "sqlite":
+        database_url = database_url.set(drivername="sqlite+aiosqlite")
+    return database_url.render_as_string(hide_password=False)
+
+DATABASE_URL = async_database_url(settings.DATABASE_URL)
+
+# Every gunicorn worker gets its own pool, size it per worker
+pool_options = {}
+if not DATABASE_URL.startswith("sqlite"):
+    pool_options = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+
+engine = create_async_engine(
+    DATABASE_URL,
     pool_pre_ping=True,
     pool_recycle=3600,
-    pool_size=5,
-    max_overflow=10,
-    connect_args={
-        "keepalives": 1,
-        "keepalives_idle": 30,
-        "keepalives_interval": 10,
-        "keepalives_count": 5,
-    }
+    **pool_options,
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Request-scoped session dependency shared by every router
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,13 +1,26 @@
-from fastapi import FastAPI, Request
+import logging
+from fastapi import Depends, FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from contextlib import asynccontextmanager
 from app.api import chat
 from app.api import auth
 from app.api import users
+from app.api.deps import require_monitoring
+from app.core.log import configure_logging
 from app.core.manager import manager
+from app.core import metrics
+from app.core.persistence import message_writer
+from app.core.retention import retention_job
+from app.core.archive import message_archive
+from app.core.security import password_hasher, token_cache
+from app.crud.message import get_last_message_id
+from app.db.session import AsyncSessionLocal, engine
 import os
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 class ForwardedProtoMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         forwarded_proto = request.headers.get("X-Forwarded-Proto")
@@ -16,20 +29,38 @@ class ForwardedProtoMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
         return response
 
+# Message ids are assigned in Redis, seeded from the highest id already stored
+async def load_last_message_id() -> int:
+    async with AsyncSessionLocal() as db:
+        return await get_last_message_id(db)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await manager.initialize_redis()
-    print("Application Startup Complete")
+    await manager.initialize_broker()
+    manager.last_message_id = await load_last_message_id()
+    message_writer.start(manager.redis_client)
+    retention_job.start(manager.redis_client)
+    password_hasher.start()
+    metrics.bind(manager, engine)
+    logger.info("Application startup complete")
 
     yield
 
+    await retention_job.close()
+    # Coalesced messages reach the writer first, then its last flush runs while
+    # Redis (chat list versions) is still open, manager.close() shuts it
+    await manager.flush_pending()
+    await message_writer.close()
     await manager.close()
-    print("Application shutdown complete")
+    password_hasher.close()
+    await engine.dispose()
+    logger.info("Application shutdown complete")
 
 app = FastAPI(
     title="ChatterBox API",
     version="1.0.0",
-    description="Backend for real-time chat app with FastAPI"
+    description="Backend for real-time chat app with FastAPI",
+    lifespan=lifespan
 )
 
 origins = [
@@ -52,6 +83,28 @@ app.add_middleware(ForwardedProtoMiddleware)
 def root():
     return { "message" : "Welcome to Chatterbox API" }
 
+# Reports queue depth and flush latency of the message writer for this worker
+@app.get("/stats", dependencies=[Depends(require_monitoring)])
+def stats():
+    return {
+        "message_writer": message_writer.stats(),
+        "password_hasher": password_hasher.stats(),
+        "token_cache": token_cache.stats(),
+        "membership_cache": manager.membership.stats(),
+        "unread": manager.unread.stats(),
+        "rate_limiter": manager.rate_limiter.stats(),
+        "subscriptions": manager.subscriptions.stats(),
+        "broker": manager.broker.stats(),
+        "retention": retention_job.stats(),
+        "archive": message_archive.stats(),
+    }
+
+# Prometheus metrics of this worker
+@app.get("/metrics", dependencies=[Depends(require_monitoring)])
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 app.include_router(auth.router)
 app.include_router(chat.router)
 app.include_router(users.router)
\ No newline at end of file
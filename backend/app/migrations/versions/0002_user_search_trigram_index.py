@@ -0,0 +1,41 @@
+"""trigram index on usernames for substring search
+
+Revision ID: 0002_user_search_trigram_index
+Revises: 0001_message_history_index
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002_user_search_trigram_index'
+down_revision: Union[str, Sequence[str], None] = '0001_message_history_index'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Only Postgres has pg_trgm, other databases search through the in-process index
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index(
+        'ix_users_username_trgm',
+        'users',
+        ['username'],
+        unique=False,
+        postgresql_using='gin',
+        postgresql_ops={'username': 'gin_trgm_ops'},
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_users_username_trgm', table_name='users')
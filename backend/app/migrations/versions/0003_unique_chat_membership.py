@@ -0,0 +1,39 @@
+"""one membership row per user and chat
+
+Revision ID: 0003_unique_chat_membership
+Revises: 0002_user_search_trigram_index
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003_unique_chat_membership'
+down_revision: Union[str, Sequence[str], None] = '0002_user_search_trigram_index'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Retried add_to_chat calls left duplicates behind, keep the oldest row of each pair
+    op.execute(
+        'DELETE FROM chat_memberships WHERE id NOT IN '
+        '(SELECT MIN(id) FROM chat_memberships GROUP BY user_id, chat_id)'
+    )
+    # A unique index rather than a constraint so SQLite can add it in place too
+    op.create_index(
+        'uq_chat_memberships_user_id_chat_id',
+        'chat_memberships',
+        ['user_id', 'chat_id'],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_chat_memberships_user_id_chat_id', table_name='chat_memberships')
@@ -0,0 +1,29 @@
+"""last read message per chat membership
+
+Revision ID: 0004_chat_membership_last_read
+Revises: 0003_unique_chat_membership
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004_chat_membership_last_read'
+down_revision: Union[str, Sequence[str], None] = '0003_unique_chat_membership'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable, so adding it doesn't rewrite the table
+    op.add_column('chat_memberships', sa.Column('last_read_message_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_memberships', 'last_read_message_id')
@@ -0,0 +1,49 @@
+"""newest message on each chat
+
+Revision ID: 0005_chat_last_message
+Revises: 0004_chat_membership_last_read
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.core.config import settings
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005_chat_last_message'
+down_revision: Union[str, Sequence[str], None] = '0004_chat_membership_last_read'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('chats', sa.Column('last_message_sender_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_preview', sa.String(length=200), nullable=True))
+    # Backfill from existing history, one lookup per chat on ix_messages_chat_id_id
+    op.execute(
+        'UPDATE chats SET last_message_id = '
+        '(SELECT MAX(id) FROM messages WHERE messages.chat_id = chats.id)'
+    )
+    # Previews are cut the same way the message writer cuts them
+    op.execute(sa.text(
+        'UPDATE chats SET '
+        'last_message_at = (SELECT created_at FROM messages WHERE messages.id = chats.last_message_id), '
+        'last_message_sender_id = (SELECT sender_id FROM messages WHERE messages.id = chats.last_message_id), '
+        'last_message_preview = (SELECT SUBSTR(content, 1, :preview_length) FROM messages WHERE messages.id = chats.last_message_id) '
+        'WHERE last_message_id IS NOT NULL'
+    ).bindparams(preview_length=settings.CHAT_PREVIEW_LENGTH))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chats', 'last_message_preview')
+    op.drop_column('chats', 'last_message_sender_id')
+    op.drop_column('chats', 'last_message_at')
+    op.drop_column('chats', 'last_message_id')
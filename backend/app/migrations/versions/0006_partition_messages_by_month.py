@@ -0,0 +1,103 @@
+"""partition messages by month of created_at
+
+Revision ID: 0006_partition_messages_by_month
+Revises: 0005_chat_last_message
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006_partition_messages_by_month'
+down_revision: Union[str, Sequence[str], None] = '0005_chat_last_message'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Months of partitions created past the current one, the retention job keeps it up after
+PARTITIONS_AHEAD = 2
+
+
+def next_month(start: datetime) -> datetime:
+    return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Only PostgreSQL partitions, elsewhere the retention job deletes archived months
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE messages RENAME TO messages_unpartitioned')
+    op.execute('ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey')
+    op.execute('ALTER INDEX IF EXISTS ix_messages_id RENAME TO ix_messages_unpartitioned_id')
+    op.execute('ALTER INDEX ix_messages_chat_id_id RENAME TO ix_messages_unpartitioned_chat_id_id')
+
+    # The partition key has to be part of the primary key
+    op.execute(
+        'CREATE TABLE messages ('
+        " id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),"
+        ' chat_id INTEGER REFERENCES chats (id) ON DELETE CASCADE,'
+        ' sender_id INTEGER REFERENCES users (id) ON DELETE CASCADE,'
+        ' content TEXT NOT NULL,'
+        ' created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),'
+        ' PRIMARY KEY (id, created_at)'
+        ') PARTITION BY RANGE (created_at)'
+    )
+    # Keeps the id sequence alive when the old table is dropped
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.create_index('ix_messages_id', 'messages', ['id'])
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'])
+
+    bind = op.get_bind()
+    oldest = bind.execute(sa.text('SELECT MIN(created_at) FROM messages_unpartitioned')).scalar()
+    now = datetime.now(timezone.utc)
+    start = (oldest or now).astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    last = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(PARTITIONS_AHEAD):
+        last = next_month(last)
+    while start <= last:
+        end = next_month(start)
+        op.execute(
+            f'CREATE TABLE messages_{start.year:04d}_{start.month:02d} PARTITION OF messages '
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        start = end
+    op.execute('CREATE TABLE messages_default PARTITION OF messages DEFAULT')
+
+    op.execute(
+        'INSERT INTO messages (id, chat_id, sender_id, content, created_at) '
+        'SELECT id, chat_id, sender_id, content, COALESCE(created_at, now()) FROM messages_unpartitioned'
+    )
+    op.execute('DROP TABLE messages_unpartitioned')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE messages RENAME TO messages_partitioned')
+    op.execute('ALTER INDEX ix_messages_id RENAME TO ix_messages_partitioned_id')
+    op.execute('ALTER INDEX ix_messages_chat_id_id RENAME TO ix_messages_partitioned_chat_id_id')
+    op.execute('ALTER INDEX messages_pkey RENAME TO messages_partitioned_pkey')
+    op.execute(
+        'CREATE TABLE messages ('
+        " id INTEGER NOT NULL DEFAULT nextval('messages_id_seq') PRIMARY KEY,"
+        ' chat_id INTEGER REFERENCES chats (id) ON DELETE CASCADE,'
+        ' sender_id INTEGER REFERENCES users (id) ON DELETE CASCADE,'
+        ' content TEXT NOT NULL,'
+        ' created_at TIMESTAMP WITH TIME ZONE DEFAULT now()'
+        ')'
+    )
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.create_index('ix_messages_id', 'messages', ['id'])
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'])
+    # Archived months stay in the archive files
+    op.execute(
+        'INSERT INTO messages (id, chat_id, sender_id, content, created_at) '
+        'SELECT id, chat_id, sender_id, content, created_at FROM messages_partitioned'
+    )
+    op.execute('DROP TABLE messages_partitioned')
@@ -0,0 +1,47 @@
+"""full-text search vector on messages
+
+Revision ID: 0007_message_search_vector
+Revises: 0006_partition_messages_by_month
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007_message_search_vector'
+down_revision: Union[str, Sequence[str], None] = '0006_partition_messages_by_month'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Only Postgres, other databases search through the in-process index
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # Generated, so every insert keeps it current without a trigger
+    # 'simple' has to match SEARCH_CONFIG in app/core/message_search.py
+    op.execute(
+        'ALTER TABLE messages ADD COLUMN search_vector tsvector '
+        "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED"
+    )
+    # Created on the partitioned table, every monthly partition gets its own
+    op.create_index(
+        'ix_messages_search_vector',
+        'messages',
+        ['search_vector'],
+        unique=False,
+        postgresql_using='gin',
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_messages_search_vector', table_name='messages')
+    op.drop_column('messages', 'search_vector')
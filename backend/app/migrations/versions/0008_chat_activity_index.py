@@ -0,0 +1,34 @@
+"""index chats by activity for chat lists
+
+Revision ID: 0008_chat_activity_index
+Revises: 0007_message_search_vector
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008_chat_activity_index'
+down_revision: Union[str, Sequence[str], None] = '0007_message_search_vector'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Same expression get_user_chats orders and pages by
+    op.create_index(
+        'ix_chats_activity',
+        'chats',
+        [sa.text('coalesce(last_message_id, 0)'), 'id'],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chats_activity', table_name='chats')
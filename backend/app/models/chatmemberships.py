@@ -1,14 +1,20 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.db.base import Base
 
 class ChatMembership(Base):
     __tablename__ = "chat_memberships"
+    # One row per user and chat, bulk inserts skip pairs that already exist
+    __table_args__ = (
+        Index("uq_chat_memberships_user_id_chat_id", "user_id", "chat_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     chat_id =  Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"))
     role = Column(String(20), default="member")
+    # Newest message the user has read here, written in batches from the unread tracker
+    last_read_message_id = Column(Integer, nullable=True)
 
     user = relationship("User", back_populates="memberships")
     chat  = relationship("Chats", back_populates="memberships")
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.base import Base
@@ -10,6 +10,17 @@ class Chats(Base):
     name = Column(String(100))
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Newest message, kept up to date by the message writer so chat lists
+    # can be sorted and previewed without reading messages
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    last_message_sender_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
+
+    __table_args__ = (
+        # Chat lists walk chats in this order, most recently active first
+        Index("ix_chats_activity", func.coalesce(last_message_id, 0), id),
+    )
 
     memberships = relationship("ChatMembership", back_populates="chat", cascade="all, delete")
     messages =  relationship("Message", back_populates="chat", cascade="all, delete")
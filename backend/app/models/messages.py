@@ -1,16 +1,23 @@
-from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.base import Base
 
 class Message(Base):
     __tablename__ = "messages"
+    # History is read per chat in id order (keyset pagination)
+    # On PostgreSQL the table is partitioned by month of created_at, which has to
+    # be part of the primary key there (see app.core.retention)
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        { "postgresql_partition_by": "RANGE (created_at)" },
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"))
     sender_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime(timezone=True),  server_default=func.now())
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
 
     chat = relationship("Chats", back_populates="messages")
     sender = relationship("User", back_populates="messages")
\ No newline at end of file
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
 class ChatCreate(BaseModel):
     name: str
@@ -10,11 +11,20 @@ class UpdateChat(BaseModel):
     id: int
     members: List[int]
 
+class UnreadCount(BaseModel):
+    chat_id: int
+    unread: int
+    last_read_message_id: Optional[int]
+
 class ChatResponse(BaseModel):
     id:  int
     name: str
     is_group: bool
     members: List[int]
+    last_message_id: Optional[int] = None
+    last_message_at: Optional[datetime] = None
+    last_message_sender_id: Optional[int] = None
+    last_message_preview: Optional[str] = None
 
     class Config:
         from_attributes = True
\ No newline at end of file
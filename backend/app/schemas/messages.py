@@ -0,0 +1,24 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
+
+class MessageResponse(BaseModel):
+    id: int
+    chat_id: int
+    sender_id: Optional[int]
+    username: Optional[str]
+    content: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class MessageHistory(BaseModel):
+    messages: List[MessageResponse]
+    # Pass as before_id to fetch the next older page, None when there are no more
+    next_before_id: Optional[int]
+
+class MessageSearchResult(MessageResponse):
+    rank: float
+    # Content around the match as HTML: escaped, with matched words in <mark></mark>
+    highlight: str
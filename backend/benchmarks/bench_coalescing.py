@@ -0,0 +1,106 @@
+# Frames and socket writes saved by chat message coalescing
+#
+# Publishes chat messages at a steady rate into one room of in-process
+# sockets, once per coalescing window (0 = off), and counts the Redis
+# publishes, listener wakeups and socket writes (one syscall each) needed to
+# deliver them, plus how long delivery took to finish. Needs a running Redis
+# (REDIS_URL, default redis://localhost:6379) and the usual .env settings,
+# or --broker memory to run without Redis (no listener wakeups then).
+#
+#   cd backend
+#   python -m benchmarks.bench_coalescing --rate 1000 --room 2000 --windows 0 5 10 20
+
+import argparse
+import asyncio
+import json
+import time
+from app.core.config import settings
+from app.core.manager import ConnectionManager
+from app.core.broker import RedisBroker
+
+CHAT_ID = "900001"
+
+# Stands in for a WebSocket, counts writes and the chat messages they carried
+class CountingSocket:
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    async def send_text(self, data: str):
+        self.stats["socket_writes"] += 1
+        if self.stats["sample"] is self:
+            message = json.loads(data)
+            self.stats["delivered"] += len(message["messages"]) if message["type"] == "batch" else 1
+
+    async def send_bytes(self, data: bytes):
+        self.stats["socket_writes"] += 1
+
+async def run(window_ms: float, rate: int, room: int, seconds: float) -> dict:
+    settings.COALESCE_WINDOW_MS = window_ms
+    settings.WS_SEND_QUEUE_SIZE = max(settings.WS_SEND_QUEUE_SIZE, rate * int(seconds) + 1)
+    manager = ConnectionManager()
+    await manager.initialize_broker()
+
+    stats = { "socket_writes": 0, "delivered": 0, "wakeups": 0, "sample": None }
+    for user_id in range(room):
+        socket = CountingSocket(stats)
+        stats["sample"] = stats["sample"] or socket
+        manager.start_writer(manager.registry.add(socket, CHAT_ID, user_id))
+
+    if isinstance(manager.broker, RedisBroker):
+        handle = manager.broker._handle_pubsub_message
+        async def counting_handle(message: dict):
+            stats["wakeups"] += 1
+            await handle(message)
+        for shard in manager.broker.pubsub.shards:
+            shard.handle_message = counting_handle
+    await manager.subscriptions.acquire(CHAT_ID)
+
+    total = int(rate * seconds)
+    interval = 1 / rate
+    start = time.perf_counter()
+    publishes = []
+    for index in range(total):
+        publishes.append(asyncio.create_task(manager.publish_chat_message(CHAT_ID, 1, "bench", f"message {index}")))
+        # Sleep in ticks of at least 1ms, sending the messages due meanwhile
+        due = start + (index + 1) * interval
+        delay = due - time.perf_counter()
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*publishes)
+    while stats["delivered"] < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    coalescer = manager.coalescer.stats()
+    await manager.close()
+    return {
+        "window_ms": window_ms,
+        "messages": total,
+        "room": room,
+        "redis_publishes": coalescer["immediate"] + coalescer["batches"] if window_ms > 0 else total,
+        "listener_wakeups": stats["wakeups"],
+        "socket_writes": stats["socket_writes"],
+        "socket_writes_per_sec": round(stats["socket_writes"] / elapsed),
+        "delivered_msgs_per_sec": round(total / elapsed),
+        "seconds": round(elapsed, 2),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=int, default=1000, help="chat messages per second")
+    parser.add_argument("--room", type=int, default=2000, help="sockets in the room")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 5, 10, 20])
+    parser.add_argument("--broker", choices=["redis", "memory"], default="redis")
+    args = parser.parse_args()
+    settings.BROKER = args.broker
+
+    baseline = None
+    for window_ms in args.windows:
+        result = await run(window_ms, args.rate, args.room, args.seconds)
+        baseline = baseline or result
+        result["socket_writes_saved"] = f"{1 - result['socket_writes'] / baseline['socket_writes']:.1%}"
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,396 @@
+# Load test of the real-time path: connects, fan-out latency, throughput, memory
+#
+# Seeds a database with one user per simulated client, pairs some of them into
+# DMs and puts the rest in the public rooms (PUBLIC_CHAT_IDS), then starts app.main:app
+# with uvicorn and opens a WebSocket per client. Once everyone is connected it
+# sends chat messages into DMs and rooms at the given rates for --duration
+# seconds and times each one from send until it reaches every member of its
+# chat. Reports the connect rate, end-to-end p50/p95/p99 latency, messages per
+# second and memory per connection for each worker as one JSON document
+# (--output to also write it to a file) so runs can be compared over time.
+#
+# One worker runs on the in-memory broker, no Redis needed. Several workers
+# (--workers, one uvicorn process per port) need a Redis or Redis-compatible
+# server on --redis-url. The database defaults to a fresh SQLite file; a
+# Postgres --database-url should point at a scratch database, since the run
+# adds its users and chats to it. Tokens are signed here with a per-run
+# SECRET_KEY handed to the servers, /stats is read with a per-run
+# MONITORING_TOKEN. Memory is read from /proc (Linux only).
+# With thousands of clients the client side shares this machine's CPU, keep an
+# eye on the harness itself when latencies look off.
+#
+#   cd backend
+#   python -m benchmarks.bench_load --clients 2000 --dm-fraction 0.5 --dm-rate 200 --room-rate 5 --duration 30
+#   python -m benchmarks.bench_load --workers 4 --redis-url redis://localhost:6379 --output load.json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import secrets
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+import websockets
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+CONTENT_PREFIX = "load:"
+
+# Creates the schema, the public rooms if missing and the simulated users
+# Returns the DM chats as (chat id, user id, user id), the room user ids and the room ids
+async def seed(clients: int, dm_fraction: float) -> tuple[list[tuple[int, int, int]], list[int], list[int]]:
+    # Imported here, the app reads DATABASE_URL and SECRET_KEY when first imported
+    from app.core.config import settings
+    from app.crud.chat import insert_memberships
+    from app.db.base import Base
+    from app.db.session import engine, AsyncSessionLocal
+    from app.models import User, Chats
+
+    room_ids = settings.PUBLIC_CHAT_IDS
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    prefix = f"load{int(time.time())}_"
+    async with AsyncSessionLocal() as db:
+        for room_id in room_ids:
+            if await db.get(Chats, room_id) is None:
+                db.add(Chats(id=room_id, name=f"Public room {room_id}", is_group=True))
+        # Nobody logs in, tokens are signed locally, so any hash will do
+        users = [User(username=f"{prefix}{i}", email=f"{prefix}{i}@load.test", hashed_password="!") for i in range(clients)]
+        db.add_all(users)
+        await db.flush()
+        user_ids = [user.id for user in users]
+
+        dm_users = user_ids[:int(clients * dm_fraction) // 2 * 2]
+        room_users = user_ids[len(dm_users):]
+        dm_chats = [Chats(name=f"{prefix}dm{i}", is_group=False) for i in range(len(dm_users) // 2)]
+        db.add_all(dm_chats)
+        await db.flush()
+
+        memberships = [(u, r) for u in user_ids for r in room_ids]
+        dms = []
+        for index, chat in enumerate(dm_chats):
+            pair = dm_users[index * 2:index * 2 + 2]
+            memberships += [(u, chat.id) for u in pair]
+            dms.append((chat.id, *pair))
+        await insert_memberships(memberships, db)
+        await db.commit()
+    await engine.dispose()
+    return dms, room_users, room_ids
+
+def start_worker(port: int, env: dict, log) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+# Authorization for /stats, the token is the one handed to the workers
+def monitoring_headers() -> dict:
+    return { "Authorization": f"Bearer {os.environ['MONITORING_TOKEN']}" }
+
+async def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, headers=monitoring_headers()) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Worker at {base_url} exited with {process.returncode}")
+            try:
+                if (await client.get("/stats")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Worker at {base_url} did not start")
+
+# Resident memory of a process in bytes, None off Linux
+def rss_bytes(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def percentiles(samples: list[float]) -> dict:
+    if len(samples) < 2:
+        return { "samples": len(samples) }
+    # Inclusive interpolates between samples, the default extrapolates past the largest one
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "samples": len(samples),
+        "p50_ms": round(cuts[49] * 1000, 2),
+        "p95_ms": round(cuts[94] * 1000, 2),
+        "p99_ms": round(cuts[98] * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2),
+    }
+
+# Shared state of one run
+class Run:
+    def __init__(self):
+        # { Seq: perf_counter when sent }
+        self.sent_at: dict[int, float] = {}
+        # { Seq: "dm" | "room" }
+        self.kinds: dict[int, str] = {}
+        self.latencies = { "dm": [], "room": [] }
+        self.connect_latencies: list[float] = []
+        self.connect_errors = 0
+        self.next_seq = 0
+
+    def record(self, content: str, received_at: float):
+        if not content.startswith(CONTENT_PREFIX):
+            return
+        seq = int(content[len(CONTENT_PREFIX):])
+        self.latencies[self.kinds[seq]].append(received_at - self.sent_at[seq])
+
+# One simulated user with a single socket
+class Client:
+    def __init__(self, run: Run, worker: dict, chat_id: int, user_id: int, kind: str):
+        self.run = run
+        self.worker = worker
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.kind = kind
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.task = None
+
+    async def connect(self, limit: asyncio.Semaphore, token: str):
+        url = f"{self.worker['ws_url']}/chat/ws/{self.chat_id}/{self.user_id}?token={token}"
+        async with limit:
+            start = time.perf_counter()
+            try:
+                self.ws = await websockets.connect(url, ping_interval=None, max_queue=None)
+                # Connected once the server's connected_users frame arrives
+                await self.ws.recv()
+            except Exception:
+                self.run.connect_errors += 1
+                return
+            self.run.connect_latencies.append(time.perf_counter() - start)
+        self.worker["clients"] += 1
+        self.connected.set()
+        self.task = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        try:
+            async for raw in self.ws:
+                received_at = time.perf_counter()
+                # Presence diffs and other events are skipped without parsing
+                if CONTENT_PREFIX not in raw:
+                    continue
+                message = json.loads(raw)
+                if message.get("type") == "batch":
+                    messages = message["messages"]
+                else:
+                    messages = [message]
+                for entry in messages:
+                    self.run.record(entry.get("content", ""), received_at)
+                self.worker["delivered"] += len(messages)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self):
+        seq = self.run.next_seq
+        self.run.next_seq += 1
+        self.run.kinds[seq] = self.kind
+        self.run.sent_at[seq] = time.perf_counter()
+        self.worker["sent"] += 1
+        await self.ws.send(json.dumps({ "type": "chat_message", "content": f"{CONTENT_PREFIX}{seq}" }))
+
+# Sends from random clients at a steady rate until the deadline
+async def drive(senders: list[Client], rate: float, deadline: float, expected: dict, members: dict):
+    if rate <= 0 or not senders:
+        return
+    interval = 1 / rate
+    start = time.perf_counter()
+    index = 0
+    while time.perf_counter() < deadline:
+        client = random.choice(senders)
+        try:
+            await client.send()
+            expected[client.kind] += members[client.chat_id]
+        except websockets.ConnectionClosed:
+            pass
+        index += 1
+        # Sleep in ticks of at least 1ms, sending the messages due meanwhile
+        delay = start + index * interval - time.perf_counter()
+        if delay > 0.001:
+            await asyncio.sleep(delay)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000, help="simulated users, one socket each")
+    parser.add_argument("--dm-fraction", type=float, default=0.5, help="share of clients paired into DMs, the rest join the public rooms")
+    parser.add_argument("--dm-rate", type=float, default=100, help="DM messages per second, all DMs together")
+    parser.add_argument("--room-rate", type=float, default=2, help="room messages per second, both rooms together")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8100, help="first worker's port")
+    parser.add_argument("--redis-url", help="needed with more than one worker")
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="handshakes in flight")
+    parser.add_argument("--server-log", default=os.devnull, help="where worker output goes")
+    parser.add_argument("--output", help="also write the JSON result here")
+    args = parser.parse_args()
+    if args.workers > 1 and not args.redis_url:
+        parser.error("--workers above 1 needs --redis-url, the in-memory broker only spans one process")
+
+    workdir = tempfile.mkdtemp(prefix="chatterbox-load-")
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{workdir}/load.db",
+        "SECRET_KEY": secrets.token_hex(32),
+        "MONITORING_TOKEN": secrets.token_hex(16),
+        "BROKER": "redis" if args.redis_url else "memory",
+    })
+    if args.redis_url:
+        env["REDIS_URL"] = args.redis_url
+    os.environ.update(env)
+    from app.core.security import create_access_token
+
+    # Every client is a file descriptor here and on the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    dms, room_users, room_ids = await seed(args.clients, args.dm_fraction)
+
+    log = open(args.server_log, "a")
+    workers = []
+    for index in range(args.workers):
+        port = args.port + index
+        process = start_worker(port, env, log)
+        workers.append({
+            "port": port,
+            "process": process,
+            "base_url": f"http://127.0.0.1:{port}",
+            "ws_url": f"ws://127.0.0.1:{port}",
+            "clients": 0,
+            "sent": 0,
+            "delivered": 0,
+        })
+    try:
+        for worker in workers:
+            await wait_ready(worker["base_url"], worker["process"])
+        for worker in workers:
+            worker["idle_rss"] = rss_bytes(worker["process"].pid)
+
+        run = Run()
+        clients = []
+        for chat_id, *pair in dms:
+            for user_id in pair:
+                clients.append(Client(run, workers[len(clients) % len(workers)], chat_id, user_id, "dm"))
+        for index, user_id in enumerate(room_users):
+            room_id = room_ids[index % len(room_ids)]
+            clients.append(Client(run, workers[len(clients) % len(workers)], room_id, user_id, "room"))
+
+        # Connect phase
+        limit = asyncio.Semaphore(args.connect_concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            client.connect(limit, create_access_token(client.user_id, f"load-{client.user_id}"))
+            for client in clients
+        ])
+        connect_seconds = time.perf_counter() - start
+        connected = [client for client in clients if client.connected.is_set()]
+        # Let the join presence diffs go out before timing anything
+        await asyncio.sleep(2)
+        for worker in workers:
+            worker["connected_rss"] = rss_bytes(worker["process"].pid)
+
+        # Send phase
+        members: dict[int, int] = {}
+        for client in connected:
+            members[client.chat_id] = members.get(client.chat_id, 0) + 1
+        expected = { "dm": 0, "room": 0 }
+        deadline = time.perf_counter() + args.duration
+        start = time.perf_counter()
+        await asyncio.gather(
+            drive([c for c in connected if c.kind == "dm"], args.dm_rate, deadline, expected, members),
+            drive([c for c in connected if c.kind == "room"], args.room_rate, deadline, expected, members),
+        )
+        send_seconds = time.perf_counter() - start
+        await asyncio.sleep(args.drain)
+
+        server_stats = []
+        async with httpx.AsyncClient(headers=monitoring_headers()) as http:
+            for worker in workers:
+                server_stats.append((await http.get(f"{worker['base_url']}/stats")).json())
+
+        for client in connected:
+            if client.task:
+                client.task.cancel()
+            await client.ws.close()
+    finally:
+        for worker in workers:
+            worker["process"].terminate()
+        for worker in workers:
+            worker["process"].wait(timeout=30)
+        log.close()
+
+    per_worker = []
+    for worker, stats in zip(workers, server_stats):
+        idle, loaded = worker["idle_rss"], worker["connected_rss"]
+        per_worker.append({
+            "port": worker["port"],
+            "connections": worker["clients"],
+            "sent_per_sec": round(worker["sent"] / send_seconds, 1),
+            "delivered_per_sec": round(worker["delivered"] / send_seconds, 1),
+            "idle_rss_mb": round(idle / 2**20, 1) if idle else None,
+            "connected_rss_mb": round(loaded / 2**20, 1) if loaded else None,
+            "memory_per_connection_kb": round((loaded - idle) / worker["clients"] / 1024, 1) if idle and loaded and worker["clients"] else None,
+            "server_stats": stats,
+        })
+
+    all_latencies = run.latencies["dm"] + run.latencies["room"]
+    delivered = len(all_latencies)
+    result = {
+        "run": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None,
+            "broker": env["BROKER"],
+            "database": "sqlite" if env["DATABASE_URL"].startswith("sqlite") else "postgres",
+            **{ key: value for key, value in vars(args).items() if key not in ("redis_url", "database_url", "server_log", "output") },
+        },
+        "connect": {
+            "clients": len(clients),
+            "connected": len(connected),
+            "errors": run.connect_errors,
+            "seconds": round(connect_seconds, 2),
+            "per_sec": round(len(connected) / connect_seconds, 1),
+            **percentiles(run.connect_latencies),
+        },
+        "messages": {
+            "sent": run.next_seq,
+            "sent_per_sec": round(run.next_seq / send_seconds, 1),
+            "deliveries_expected": expected["dm"] + expected["room"],
+            "deliveries": delivered,
+            "delivered_per_sec": round(delivered / send_seconds, 1),
+        },
+        "latency": {
+            "all": percentiles(all_latencies),
+            "dm": percentiles(run.latencies["dm"]),
+            "room": percentiles(run.latencies["room"]),
+        },
+        "workers": per_worker,
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+if __name__ == "__main__":
+    asyncio.run(main())
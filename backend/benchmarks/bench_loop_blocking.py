@@ -0,0 +1,119 @@
+# Checks that REST traffic doesn't stall WebSocket delivery on the same worker
+#
+# Connects a room of WebSocket clients, sends timed chat messages through it
+# and measures how long each takes to reach every client: first with the
+# server idle, then while other tasks hammer the database-backed REST
+# endpoints. With the async database layer the two runs should match; when
+# queries block the event loop, the loaded run's latency climbs with the
+# REST load.
+#
+# Tokens are signed locally, so run it with the server's SECRET_KEY.
+# Start a single worker first so everything shares one event loop:
+#   cd backend
+#   uvicorn app.main:app --port 8000
+#   python -m benchmarks.bench_loop_blocking --clients 50 --rest-concurrency 50
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import httpx
+import websockets
+from app.core.security import create_access_token
+
+# One room member, records when each timed message arrives
+async def receiver(url: str, arrivals: dict[int, list[float]], ready: asyncio.Event, expected: int, counter: list[int]):
+    async with websockets.connect(url) as ws:
+        counter[0] += 1
+        if counter[0] == expected:
+            ready.set()
+        async for raw in ws:
+            message = json.loads(raw)
+            content = message.get("content", "")
+            if message.get("type") == "chat_message" and content.startswith("bench:"):
+                arrivals.setdefault(int(content.split(":")[1]), []).append(time.perf_counter())
+
+# Sends timed messages and returns how long each took to reach every receiver
+async def measure(url: str, arrivals: dict[int, list[float]], receivers: int, messages: int, interval: float, first_seq: int) -> list[float]:
+    sent_at = {}
+    async with websockets.connect(url) as ws:
+        for seq in range(first_seq, first_seq + messages):
+            sent_at[seq] = time.perf_counter()
+            await ws.send(json.dumps({ "type": "chat_message", "username": "bench", "content": f"bench:{seq}" }))
+            await asyncio.sleep(interval)
+        await asyncio.sleep(1)
+    return [
+        max(arrivals[seq]) - sent_at[seq]
+        for seq in sent_at
+        if len(arrivals.get(seq, [])) >= receivers
+    ]
+
+# Keeps one REST request in flight until stopped, returns how many completed
+async def rest_load(client: httpx.AsyncClient, user_id: int, stop: asyncio.Event) -> int:
+    done = 0
+    while not stop.is_set():
+        await client.get(f"/users/chats/{user_id}")
+        await client.get("/users/search_users/", params={ "q": "us" })
+        done += 2
+    return done
+
+def ws_url(room_url: str, user_id: int) -> str:
+    return f"{room_url}/{user_id}?token={create_access_token(user_id, f'bench-{user_id}')}"
+
+def summarize(latencies: list[float]) -> dict:
+    if not latencies:
+        return { "delivered": 0 }
+    latencies = sorted(latencies)
+    return {
+        "delivered": len(latencies),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    # Non-numeric chats skip membership checks, so the bench users don't need to exist
+    parser.add_argument("--chat-id", default="bench")
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between timed messages")
+    parser.add_argument("--rest-concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    ws_base = args.base_url.replace("http", "ws", 1)
+    room_url = f"{ws_base}/chat/ws/{args.chat_id}"
+    arrivals: dict[int, list[float]] = {}
+    ready = asyncio.Event()
+    counter = [0]
+    receivers = [
+        asyncio.create_task(receiver(ws_url(room_url, 10_000 + i), arrivals, ready, args.clients, counter))
+        for i in range(args.clients)
+    ]
+    await asyncio.wait_for(ready.wait(), timeout=30)
+    sender_url = ws_url(room_url, args.user_id)
+
+    idle = await measure(sender_url, arrivals, args.clients, args.messages, args.interval, 0)
+    print(json.dumps({ "phase": "idle", **summarize(idle) }))
+
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.rest_concurrency)
+    headers = { "Authorization": f"Bearer {create_access_token(args.user_id, 'bench')}" }
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=30, headers=headers) as client:
+        load = [asyncio.create_task(rest_load(client, args.user_id, stop)) for _ in range(args.rest_concurrency)]
+        start = time.perf_counter()
+        loaded = await measure(sender_url, arrivals, args.clients, args.messages, args.interval, args.messages)
+        stop.set()
+        requests = sum(await asyncio.gather(*load))
+        elapsed = time.perf_counter() - start
+    print(json.dumps({ "phase": "rest_load", "rest_requests_per_sec": round(requests / elapsed), **summarize(loaded) }))
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+# Login throughput of the password hashing pool, per core
+#
+# Verifies one bcrypt hash as fast as possible through PasswordHasher with
+# 1..N pool processes and reports verifications per second and per process,
+# then floods a pool past PASSWORD_HASH_MAX_PENDING to show how many requests
+# are refused and how quickly. No Redis or database needed.
+#
+# Cost comes from BCRYPT_ROUNDS like in the app:
+#   cd backend
+#   BCRYPT_ROUNDS=12 python -m benchmarks.bench_password_hashing --workers 1 2 4
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from fastapi import HTTPException
+from app.core.config import settings
+from app.core.security import PasswordHasher, hash_password
+
+# Keeps `concurrency` verifications in flight for `seconds`
+async def run_logins(hasher: PasswordHasher, hashed: str, concurrency: int, seconds: float) -> dict:
+    deadline = time.perf_counter() + seconds
+    latencies = []
+    rejected = 0
+
+    async def client(index: int):
+        nonlocal rejected
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                await hasher.verify(f"user-{index}", "password", hashed)
+                latencies.append(time.perf_counter() - start)
+            except HTTPException:
+                rejected += 1
+                await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "logins_per_sec": round(len(latencies) / elapsed, 1),
+        "rejected": rejected,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, os.cpu_count() or 1])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--overload-clients", type=int, default=200)
+    args = parser.parse_args()
+
+    hashed = hash_password("password")
+
+    for workers in args.workers:
+        # Enough in flight to keep every process busy, never enough to be refused
+        hasher = PasswordHasher(workers, max_pending=workers * 2, max_per_user=1)
+        hasher.start()
+        await hasher.verify("warmup", "password", hashed)
+        result = await run_logins(hasher, hashed, workers * 2, args.seconds)
+        hasher.close()
+        print(json.dumps({
+            "phase": "throughput",
+            "rounds": settings.BCRYPT_ROUNDS,
+            "workers": workers,
+            "per_worker_per_sec": round(result["logins_per_sec"] / workers, 1),
+            **result,
+        }))
+
+    workers = args.workers[-1]
+    hasher = PasswordHasher(workers, max_pending=workers * 4, max_per_user=1)
+    hasher.start()
+    result = await run_logins(hasher, hashed, args.overload_clients, args.seconds)
+    hasher.close()
+    print(json.dumps({ "phase": "overload", "rounds": settings.BCRYPT_ROUNDS, "workers": workers, "clients": args.overload_clients, **result }))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+# Compares the old polling Redis listener with the event-driven one
+#
+# Publishes timestamped messages to one chat channel and measures, for each
+# listener, how fast a burst is drained and the publish-to-delivery latency at
+# a steady rate. Needs a running Redis (REDIS_URL, default redis://localhost:6379)
+# and the usual .env settings.
+#
+#   cd backend
+#   python -m benchmarks.bench_redis_listener --messages 5000 --rate 500
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from app.core.manager import ConnectionManager
+from app.core.broker import RedisBroker
+from app.core.subscriptions import PubSubShard
+
+CHAT_ID = "bench-listener"
+
+# Stands in for a WebSocket, records when each message arrives
+class TimingSocket:
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.latencies: list[float] = []
+        self.last_received_at = 0.0
+        self.done = asyncio.Event()
+
+    async def send_text(self, data: str):
+        now = time.perf_counter()
+        self.latencies.append(now - json.loads(data)["sent_at"])
+        self.last_received_at = now
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+# The listener as it was: 1s get_message timeout followed by a 10ms sleep
+class PollingShard(PubSubShard):
+    async def _listen(self):
+        try:
+            while True:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message:
+                    await self.handle_message(message)
+                await asyncio.sleep(0.01)
+        except asyncio.CancelledError:
+            pass
+
+# Registers the socket as the only local connection in the benchmark chat
+def attach(manager: ConnectionManager, socket: TimingSocket):
+    for connection in list(manager.registry.chat_connections(CHAT_ID)):
+        manager.disconnect(connection)
+    manager.start_writer(manager.registry.add(socket, CHAT_ID, 0))
+
+async def run(shard_class, messages: int, rate: float) -> dict:
+    manager = ConnectionManager(RedisBroker())
+    await manager.initialize_broker()
+    # One pub/sub connection using the listener under test
+    broker = manager.broker
+    broker.pubsub.shards = [shard_class(0, broker.redis_client, broker._handle_pubsub_message)]
+
+    # Burst: publish everything as fast as possible and time the drain
+    socket = TimingSocket(messages)
+    attach(manager, socket)
+    await manager.subscriptions.acquire(CHAT_ID)
+    start = time.perf_counter()
+    for _ in range(messages):
+        await manager.redis_client.publish(f"chat:{CHAT_ID}", json.dumps({ "sent_at": time.perf_counter() }))
+    await asyncio.wait_for(socket.done.wait(), timeout=600)
+    burst_seconds = socket.last_received_at - start
+
+    # Steady rate: latency of each message when the listener is keeping up
+    paced = max(1, min(messages, int(rate * 5)))
+    socket = TimingSocket(paced)
+    attach(manager, socket)
+    interval = 1 / rate
+    for _ in range(paced):
+        await manager.redis_client.publish(f"chat:{CHAT_ID}", json.dumps({ "sent_at": time.perf_counter() }))
+        await asyncio.sleep(interval)
+    await asyncio.wait_for(socket.done.wait(), timeout=600)
+    latencies = sorted(socket.latencies)
+
+    await manager.close()
+    return {
+        "burst_msgs_per_sec": round(messages / burst_seconds),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=500, help="messages/sec for the latency run")
+    args = parser.parse_args()
+
+    for name, shard_class in (("polling", PollingShard), ("event-driven", PubSubShard)):
+        result = await run(shard_class, args.messages, args.rate)
+        print(json.dumps({ "listener": name, **result }))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+# Micro-benchmark of the connection registry against the old list-per-chat layout
+#
+# Simulates a reconnect storm on one worker: N connections join (a few big
+# public rooms plus many small chats), every join reads the room's connected
+# users, a user's sockets are looked up, then every connection leaves in
+# random order. No Redis or database needed.
+#
+#   cd backend
+#   python -m benchmarks.bench_registry --connections 10000 20000 50000
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from app.core.registry import ConnectionRegistry
+
+PUBLIC_ROOMS = ["7", "8"]
+
+# The layout ConnectionManager used before: { ChatId: [(user_id, websocket)] }
+class ListRegistry:
+    def __init__(self):
+        self.active_connections: dict[str, list[tuple[int, object]]] = {}
+
+    def add(self, websocket, chat_id: str, user_id: int):
+        room = self.active_connections.setdefault(chat_id, [])
+        room.append((user_id, websocket))
+        return (user_id, websocket, chat_id)
+
+    def remove(self, connection):
+        user_id, websocket, chat_id = connection
+        room = self.active_connections[chat_id]
+        room.remove((user_id, websocket))
+        if not room:
+            del self.active_connections[chat_id]
+
+    def chat_user_ids(self, chat_id: str) -> list[int]:
+        return [uid for uid, _ in self.active_connections.get(chat_id, [])]
+
+    def user_connections(self, user_id: int) -> list:
+        return [
+            (uid, ws, chat_id)
+            for chat_id, room in self.active_connections.items()
+            for uid, ws in room
+            if uid == user_id
+        ]
+
+# Half the connections land in the public rooms, the rest in 2-person chats
+def workload(connections: int) -> list[tuple[str, int]]:
+    joins = []
+    for i in range(connections):
+        user_id = i // 2
+        if i % 2 == 0:
+            joins.append((PUBLIC_ROOMS[i % 4 // 2], user_id))
+        else:
+            joins.append((f"dm-{user_id // 2}", user_id))
+    return joins
+
+def measure(registry, joins: list[tuple[str, int]], seed: int) -> dict:
+    sockets = [object() for _ in joins]
+
+    start = time.perf_counter()
+    records = []
+    for websocket, (chat_id, user_id) in zip(sockets, joins):
+        registry.chat_user_ids(chat_id)
+        records.append(registry.add(websocket, chat_id, user_id))
+    connect_seconds = time.perf_counter() - start
+
+    lookups = joins[:: max(1, len(joins) // 200)]
+    start = time.perf_counter()
+    for _, user_id in lookups:
+        registry.user_connections(user_id)
+    lookup_seconds = (time.perf_counter() - start) / len(lookups)
+
+    random.Random(seed).shuffle(records)
+    start = time.perf_counter()
+    for record in records:
+        registry.remove(record)
+    disconnect_seconds = time.perf_counter() - start
+
+    return {
+        "connect_per_sec": round(len(joins) / connect_seconds),
+        "disconnect_per_sec": round(len(joins) / disconnect_seconds),
+        "user_lookup_us": round(lookup_seconds * 1_000_000, 2),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, nargs="+", default=[10000, 20000])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for connections in args.connections:
+        joins = workload(connections)
+        for name, registry in (("list", ListRegistry()), ("registry", ConnectionRegistry())):
+            result = measure(registry, joins, args.seed)
+            print(json.dumps({ "layout": name, "connections": connections, **result }))
+
+# ClientConnection creates an asyncio.Queue, so run inside a loop
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+# Bytes on the wire and CPU per fan-out for each wire format
+#
+# Builds chat messages of a few sizes and fans each one out to a room of
+# sockets two ways: encoding once into a shared Frame (what the manager does)
+# and encoding per socket (what per-socket serialization or permessage-deflate
+# costs). Reports the frame size per format and CPU microseconds per fan-out.
+# No Redis, database or server needed.
+#
+#   cd backend
+#   python -m benchmarks.bench_wire_format --room 2000 --sizes 40 400 4000
+
+import argparse
+import json
+import random
+import string
+import time
+from app.core.envelope import Envelope, Frame, WIRE_FORMATS
+
+def sample_message(size: int, seed: int) -> str:
+    rng = random.Random(seed)
+    # Words rather than random bytes, so compression sees realistic text
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(200)]
+    content = ""
+    while len(content) < size:
+        content += rng.choice(words) + " "
+    envelope = Envelope.chat_message(7, 42, "benchmark_user", content[:size])
+    envelope.id = 123456
+    return envelope.encode()
+
+# CPU seconds to hand one message to every socket in the room
+def fan_out(text: str, wire_format: str, room: int, shared: bool) -> float:
+    start = time.process_time()
+    if shared:
+        frame = Frame(text)
+        for _ in range(room):
+            frame.render(wire_format)
+    else:
+        for _ in range(room):
+            Frame(text).render(wire_format)
+    return time.process_time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--room", type=int, default=2000, help="sockets per fan-out")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 400, 4000], help="message content lengths")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        text = sample_message(size, size)
+        for wire_format in WIRE_FORMATS:
+            data = Frame(text).render(wire_format)
+            wire_bytes = len(data.encode() if isinstance(data, str) else data)
+            shared = min(fan_out(text, wire_format, args.room, True) for _ in range(args.repeat))
+            per_socket = min(fan_out(text, wire_format, args.room, False) for _ in range(max(1, args.repeat // 4)))
+            print(json.dumps({
+                "content_bytes": size,
+                "format": wire_format,
+                "wire_bytes": wire_bytes,
+                "json_bytes": len(text.encode()),
+                "room": args.room,
+                "shared_frame_us": round(shared * 1_000_000, 1),
+                "per_socket_encode_us": round(per_socket * 1_000_000, 1),
+            }))
+
+if __name__ == "__main__":
+    main()
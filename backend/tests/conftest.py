@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+# Settings are read when the app is imported, so the test environment comes first
+# Tests run on a throwaway SQLite database with the in-memory broker, no servers needed
+data_dir = tempfile.mkdtemp(prefix="chatterbox-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{data_dir}/test.db"
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["BROKER"] = "memory"
+os.environ["PUBLIC_CHAT_IDS"] = "[]"
+os.environ["MESSAGE_ARCHIVE_DIR"] = os.path.join(data_dir, "archive")
+
+import itertools
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert
+from app.db.base import Base
+from app.models import User
+from app.core.security import create_access_token
+
+user_numbers = itertools.count(1)
+
+# One app for the whole run, tests keep apart by creating their own users and chats
+@pytest.fixture(scope="session")
+def client():
+    engine = create_engine(os.environ["DATABASE_URL"])
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+
+# Creates users straight in the database (skipping bcrypt) and signs their tokens
+# Returns { "id", "username", "token", "headers" }
+@pytest.fixture
+def make_user(client):
+    engine = create_engine(os.environ["DATABASE_URL"])
+
+    def make_user() -> dict:
+        username = f"user{next(user_numbers)}"
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                insert(User).values(username=username, email=f"{username}@example.com", hashed_password="-").returning(User.id)
+            ).scalar_one()
+        token = create_access_token(user_id, username)
+        return { "id": user_id, "username": username, "token": token, "headers": { "Authorization": f"Bearer {token}" } }
+
+    yield make_user
+    engine.dispose()
+
+# Creates a group chat with the given users through the API and returns its id
+@pytest.fixture
+def make_chat(client):
+    def make_chat(*users: dict) -> int:
+        response = client.post(
+            "/chat/create-chat",
+            json={ "name": "test", "is_group": True, "user_ids": [user["id"] for user in users] },
+            headers=users[0]["headers"],
+        )
+        assert response.status_code == 200
+        return response.json()["id"]
+
+    return make_chat
+
+# Async tests are marked @pytest.mark.anyio and run on asyncio
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+# Points RedisBroker at an in-process fake Redis shared by every broker the test starts
+@pytest.fixture
+def fake_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+
+    def from_url(url, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=server, **kwargs)
+
+    monkeypatch.setattr("app.core.broker.redis.from_url", from_url)
+    return server
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import pytest
+from app.core.broker import Broker, MemoryBroker, MemoryHub
+from app.core.manager import ConnectionManager
+
+pytestmark = pytest.mark.anyio
+
+# Records what a worker's broker hands it
+class Inbox:
+    def __init__(self):
+        self.messages = []
+
+    async def __call__(self, data: str, chat_id: str):
+        self.messages.append((chat_id, data))
+
+# Just enough of a WebSocket for ConnectionManager.connect
+class FakeWebSocket:
+    def __init__(self):
+        self.scope = { "subprotocols": [] }
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        pass
+
+async def started_broker(hub: MemoryHub, worker_id: str) -> tuple[MemoryBroker, Inbox]:
+    broker = MemoryBroker(hub)
+    inbox = Inbox()
+    await broker.start(worker_id, inbox)
+    return broker, inbox
+
+def test_broker_needs_every_method():
+    class Incomplete(Broker):
+        async def start(self, worker_id, handle_message):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+async def test_publish_reaches_other_subscribed_workers_only():
+    hub = MemoryHub()
+    a, a_inbox = await started_broker(hub, "a")
+    b, b_inbox = await started_broker(hub, "b")
+    c, c_inbox = await started_broker(hub, "c")
+    for broker in (a, b):
+        await broker.subscribe("1")
+
+    await a.publish("1", "event")
+
+    # The publisher delivers to its own sockets itself, the broker skips it
+    assert a_inbox.messages == []
+    assert b_inbox.messages == [("1", "event")]
+    assert c_inbox.messages == []
+
+    await b.unsubscribe("1")
+    await a.publish("1", "again")
+    assert b_inbox.messages == [("1", "event")]
+
+async def test_message_ids_are_shared_and_kept_in_the_tail():
+    hub = MemoryHub()
+    a, _ = await started_broker(hub, "a")
+    b, b_inbox = await started_broker(hub, "b")
+    await b.subscribe("1")
+
+    first = await a.publish_message("1", '"type":"chat_message","content":"one"}', 0)
+    second = await b.publish_message("1", '"type":"chat_message","content":"two"}', 0)
+    # A floor above the counter (ids already in the database) is respected
+    third = await a.publish_message("1", '"type":"chat_message","content":"three"}', 100)
+    batch_first = await a.publish_batch("1", ['"type":"chat_message","content":"four"}', '"type":"chat_message","content":"five"}'], 0)
+
+    assert (first, second, third, batch_first) == (1, 2, 101, 102)
+    tail = await b.read_tail("1")
+    assert [(m["message_id"], m["content"]) for m in tail] == [(1, "one"), (2, "two"), (101, "three"), (102, "four"), (103, "five")]
+    batch = json.loads(b_inbox.messages[-1][1])
+    assert batch["type"] == "batch" and [m["message_id"] for m in batch["messages"]] == [102, 103]
+
+async def test_chat_message_reaches_every_socket_once():
+    hub = MemoryHub()
+    managers = [ConnectionManager(MemoryBroker(hub)) for _ in range(2)]
+    sockets = [FakeWebSocket() for _ in range(3)]
+    try:
+        # Two sockets on the first worker, one on the second
+        connections = [
+            await managers[0].connect(sockets[0], "900", 1),
+            await managers[0].connect(sockets[1], "900", 2),
+            await managers[1].connect(sockets[2], "900", 3),
+        ]
+        message = await managers[0].publish_chat_message("900", 1, "user1", "hello")
+        await asyncio.sleep(0.05)
+
+        for websocket in sockets:
+            delivered = [m for m in websocket.sent if m["type"] == "chat_message"]
+            assert [(m["message_id"], m["content"]) for m in delivered] == [(message["message_id"], "hello")]
+
+        for manager, connection in zip([managers[0], managers[0], managers[1]], connections):
+            manager.disconnect(connection)
+        assert len(managers[0].registry) == 0
+    finally:
+        for manager in managers:
+            await manager.close()
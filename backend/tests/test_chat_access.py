@@ -0,0 +1,31 @@
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+def ws_url(chat_id, user: dict) -> str:
+    return f"/chat/ws/{chat_id}/{user['id']}?token={user['token']}"
+
+@pytest.mark.parametrize("chat_id", ["lobby", "12abc", "١٢"])
+def test_chat_ids_that_are_not_numbers_are_refused(client, make_user, chat_id):
+    user = make_user()
+
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with client.websocket_connect(ws_url(chat_id, user)):
+            pass
+    assert refused.value.code == 1008
+
+def test_only_members_can_connect(client, make_user, make_chat):
+    member, outsider = make_user(), make_user()
+    chat_id = make_chat(member)
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(ws_url(chat_id, outsider)):
+            pass
+    with client.websocket_connect(ws_url(chat_id, member)) as ws:
+        assert ws.receive_json()["type"]
+
+def test_only_members_can_read_history(client, make_user, make_chat):
+    member, outsider = make_user(), make_user()
+    chat_id = make_chat(member)
+
+    assert client.get(f"/chat/{chat_id}/messages", headers=member["headers"]).status_code == 200
+    assert client.get(f"/chat/{chat_id}/messages", headers=outsider["headers"]).status_code == 403
@@ -0,0 +1,29 @@
+import pytest
+from app.core.chat_cache import decode_chat_cursor, encode_chat_cursor
+
+def test_cursor_round_trips():
+    cursor = encode_chat_cursor(1234, 7)
+    assert "=" not in cursor
+    assert decode_chat_cursor(cursor) == (1234, 7)
+
+@pytest.mark.parametrize("cursor", [None, "", "not base64!", "W10", "eyJhIjoxfQ"])
+def test_malformed_cursors_decode_to_none(cursor):
+    assert decode_chat_cursor(cursor) is None
+
+# Pages of GET /users/chats follow X-Next-Cursor, most recently active first
+def test_chat_list_pages(client, make_user, make_chat):
+    user = make_user()
+    chats = [make_chat(user) for _ in range(5)]
+
+    seen = []
+    cursor = None
+    while True:
+        params = { "limit": 2, **({ "cursor": cursor } if cursor else {}) }
+        response = client.get(f"/users/chats/{user['id']}", params=params, headers=user["headers"])
+        assert response.status_code == 200
+        seen += [chat["id"] for chat in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+
+    assert seen == sorted(chats, reverse=True)
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from app.core.coalescer import MessageCoalescer
+
+pytestmark = pytest.mark.anyio
+
+# Stands in for the broker, ids count up from 1 like a chat's message ids
+class Publisher:
+    def __init__(self):
+        self.next_id = 1
+        self.calls = []
+
+    async def publish_one(self, chat_id, envelope):
+        self.calls.append((chat_id, [envelope]))
+        self.next_id += 1
+        return self.next_id - 1
+
+    async def publish_batch(self, chat_id, envelopes):
+        self.calls.append((chat_id, list(envelopes)))
+        first_id = self.next_id
+        self.next_id += len(envelopes)
+        return first_id
+
+def make_coalescer(publisher: Publisher, window: float, max_batch: int) -> MessageCoalescer:
+    return MessageCoalescer(publisher.publish_one, publisher.publish_batch, window, max_batch)
+
+async def test_quiet_chat_publishes_right_away():
+    publisher = Publisher()
+    coalescer = make_coalescer(publisher, 10.0, 10)
+
+    assert await asyncio.wait_for(coalescer.submit("1", "a"), 1) == 1
+    assert publisher.calls == [("1", ["a"])]
+    assert coalescer.stats()["immediate"] == 1
+
+async def test_full_batch_flushes_before_the_window_closes():
+    publisher = Publisher()
+    coalescer = make_coalescer(publisher, 10.0, 3)
+    await coalescer.submit("1", "a")
+
+    ids = await asyncio.wait_for(asyncio.gather(*(coalescer.submit("1", m) for m in "bcd")), 1)
+
+    assert ids == [2, 3, 4]
+    assert publisher.calls[1] == ("1", ["b", "c", "d"])
+    assert coalescer.stats()["batches"] == 1
+    await coalescer.close()
+
+async def test_window_flushes_a_partial_batch():
+    publisher = Publisher()
+    window = 0.05
+    coalescer = make_coalescer(publisher, window, 100)
+    await coalescer.submit("1", "a")
+    start = asyncio.get_running_loop().time()
+
+    ids = await asyncio.wait_for(asyncio.gather(coalescer.submit("1", "b"), coalescer.submit("1", "c")), 1)
+
+    assert ids == [2, 3]
+    assert publisher.calls[1] == ("1", ["b", "c"])
+    assert asyncio.get_running_loop().time() - start >= window * 0.9
+
+async def test_close_publishes_what_is_waiting():
+    publisher = Publisher()
+    coalescer = make_coalescer(publisher, 10.0, 100)
+    await coalescer.submit("1", "a")
+    waiting = asyncio.create_task(coalescer.submit("1", "b"))
+    await asyncio.sleep(0)
+
+    await coalescer.close()
+
+    assert await waiting == 2
+    assert publisher.calls[1] == ("1", ["b"])
+
+async def test_chats_are_batched_separately():
+    publisher = Publisher()
+    coalescer = make_coalescer(publisher, 10.0, 2)
+    await coalescer.submit("1", "a")
+    await coalescer.submit("2", "x")
+
+    await asyncio.wait_for(asyncio.gather(*(coalescer.submit(chat, m) for chat, m in (("1", "b"), ("2", "y"), ("1", "c"), ("2", "z")))), 1)
+
+    assert sorted(publisher.calls[2:]) == [("1", ["b", "c"]), ("2", ["y", "z"])]
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import zlib
+import msgpack
+import pytest
+from app.core import envelope
+from app.core.broker import MemoryBroker, MemoryHub
+from app.core.config import settings
+from app.core.envelope import (
+    DEFLATED_FLAG,
+    RAW_FLAG,
+    Envelope,
+    Frame,
+    decode_client_frame,
+    negotiate_wire_format,
+)
+from app.core.manager import ConnectionManager
+
+@pytest.fixture(autouse=True)
+def compression(monkeypatch):
+    monkeypatch.setattr(settings, "WS_COMPRESSION_MIN_BYTES", 64)
+
+def test_first_supported_subprotocol_wins():
+    assert negotiate_wire_format(["v2.chat", "msgpack+deflate", "json"]) == "msgpack+deflate"
+    assert negotiate_wire_format(["json+deflate", "msgpack"]) == "json+deflate"
+
+def test_unknown_or_disabled_subprotocols_fall_back_to_json(monkeypatch):
+    assert negotiate_wire_format([]) is None
+    assert negotiate_wire_format(["xml", "protobuf"]) is None
+    monkeypatch.setattr(settings, "WS_WIRE_FORMATS", ["json"])
+    assert negotiate_wire_format(["msgpack"]) is None
+
+def test_envelope_is_one_flat_object():
+    message = Envelope("chat_message", chat="12", sender=3, id=40, ts="now", payload={ "content": "hi" })
+
+    assert json.loads(message.encode()) == {
+        "type": "chat_message", "message_id": 40, "chat_id": 12, "sender_id": 3, "created_at": "now", "content": "hi",
+    }
+
+def test_msgpack_round_trip():
+    frame = Envelope("chat_message", chat=1, payload={ "content": "hi" }).frame()
+
+    assert msgpack.unpackb(frame.render("msgpack")) == json.loads(frame.text)
+
+def test_deflate_only_above_the_size_cutoff():
+    small = Frame(json.dumps({ "type": "x", "content": "a" }))
+    large = Frame(json.dumps({ "type": "x", "content": "a" * 200 }))
+
+    assert small.render("json+deflate") == RAW_FLAG + small.text.encode()
+    data = large.render("json+deflate")
+    assert data[:1] == DEFLATED_FLAG
+    assert zlib.decompress(data[1:]).decode() == large.text
+    data = large.render("msgpack+deflate")
+    assert data[:1] == DEFLATED_FLAG
+    assert msgpack.unpackb(zlib.decompress(data[1:])) == json.loads(large.text)
+
+def test_each_format_is_encoded_once(monkeypatch):
+    frame = Frame(json.dumps({ "type": "x", "content": "a" * 200 }))
+    calls = []
+    encode = Frame._encode
+    monkeypatch.setattr(Frame, "_encode", lambda self, wire_format: calls.append(wire_format) or encode(self, wire_format))
+
+    first = frame.render("msgpack+deflate")
+
+    assert frame.render("msgpack+deflate") is first
+    assert frame.render("msgpack") is frame.render("msgpack")
+    assert calls == ["msgpack+deflate", "msgpack"]
+
+def test_client_frames_decode_for_every_format():
+    body = { "type": "chat_message", "content": "b" * 200 }
+    text = json.dumps(body)
+    packed = msgpack.packb(body)
+
+    assert json.loads(decode_client_frame({ "text": text }, "json")) == body
+    assert json.loads(decode_client_frame({ "bytes": packed }, "msgpack")) == body
+    assert json.loads(decode_client_frame({ "bytes": RAW_FLAG + text.encode() }, "json+deflate")) == body
+    assert json.loads(decode_client_frame({ "bytes": DEFLATED_FLAG + zlib.compress(packed) }, "msgpack+deflate")) == body
+    assert decode_client_frame({}, "json") is None
+
+def test_bad_client_frames_are_rejected(monkeypatch):
+    assert decode_client_frame({ "bytes": DEFLATED_FLAG + b"not zlib" }, "json+deflate") is None
+    assert decode_client_frame({ "bytes": b"\xc1" }, "msgpack") is None
+    assert decode_client_frame({ "bytes": msgpack.packb(1) + b"extra" }, "msgpack") is None
+
+    # A small frame that inflates past the limit is dropped, not inflated
+    monkeypatch.setattr(envelope, "MAX_INFLATED_BYTES", 1024)
+    bomb = DEFLATED_FLAG + zlib.compress(b" " * 100_000)
+    assert len(bomb) < 1024
+    assert decode_client_frame({ "bytes": bomb }, "json+deflate") is None
+
+# Records what a socket is sent without decoding it
+class RawWebSocket:
+    def __init__(self, subprotocols: list[str]):
+        self.scope = { "subprotocols": subprotocols }
+        self.subprotocol = None
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, data: str):
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        pass
+
+@pytest.mark.anyio
+async def test_fan_out_shares_one_encoding_across_sockets():
+    manager = ConnectionManager(MemoryBroker(MemoryHub()))
+    sockets = [RawWebSocket(["msgpack+deflate"]) for _ in range(3)] + [RawWebSocket([])]
+    try:
+        connections = [await manager.connect(websocket, "901", user_id) for user_id, websocket in enumerate(sockets, 1)]
+        await manager.publish_chat_message("901", 1, "user1", "c" * 300)
+        await asyncio.sleep(0.05)
+
+        assert [websocket.subprotocol for websocket in sockets] == ["msgpack+deflate"] * 3 + [None]
+        delivered = [websocket.sent[-1] for websocket in sockets]
+        # The same bytes object went to every msgpack+deflate socket
+        assert delivered[0] is delivered[1] is delivered[2]
+        assert delivered[0][:1] == DEFLATED_FLAG
+        assert msgpack.unpackb(zlib.decompress(delivered[0][1:])) == json.loads(delivered[3])
+
+        for connection in connections:
+            manager.disconnect(connection)
+    finally:
+        await manager.close()
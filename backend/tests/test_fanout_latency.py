@@ -0,0 +1,74 @@
+import json
+import statistics
+import threading
+import time
+import pytest
+from app.core.config import settings
+
+# WebSocket fan-out has to stay fast while the REST endpoints are busy
+# Both run on the same event loop, a blocking database call in a request
+# would hold up every delivery behind it
+RECEIVERS = 5
+MESSAGES = 20
+REST_THREADS = 4
+
+@pytest.fixture(autouse=True)
+def no_rate_limits(monkeypatch):
+    for scope in ("CONNECTION", "USER", "CHAT"):
+        monkeypatch.setattr(settings, f"RATE_LIMIT_{scope}_RATE", 0.0)
+
+# Sends timed chat messages, returns how long each took to reach every receiver
+def measure(sender, receivers, tag: str) -> list[float]:
+    latencies = []
+    for seq in range(MESSAGES):
+        content = f"{tag}:{seq}"
+        start = time.perf_counter()
+        sender.send_text(json.dumps({ "type": "chat_message", "content": content }))
+        for ws in [sender, *receivers]:
+            while True:
+                message = ws.receive_json()
+                if message["type"] == "chat_message" and message["content"] == content:
+                    break
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Keeps REST requests going until stopped, counting the ones that succeeded
+def rest_load(client, user: dict, stop: threading.Event, done: list[int]):
+    while not stop.is_set():
+        assert client.get(f"/users/chats/{user['id']}", headers=user["headers"]).status_code == 200
+        assert client.get("/users/search_users/", params={ "q": "user" }, headers=user["headers"]).status_code == 200
+        done[0] += 2
+
+def test_fanout_latency_flat_under_rest_load(client, make_user, make_chat):
+    users = [make_user() for _ in range(RECEIVERS + 1)]
+    chat_id = make_chat(*users)
+    sockets = [client.websocket_connect(f"/chat/ws/{chat_id}/{user['id']}?token={user['token']}") for user in users]
+    try:
+        for ws in sockets:
+            ws.__enter__()
+            assert ws.receive_json()["type"] == "connected_users"
+        sender, receivers = sockets[0], sockets[1:]
+
+        idle = measure(sender, receivers, "idle")
+
+        stop = threading.Event()
+        done = [0]
+        threads = [threading.Thread(target=rest_load, args=(client, users[0], stop, done)) for _ in range(REST_THREADS)]
+        for thread in threads:
+            thread.start()
+        try:
+            time.sleep(0.2)
+            loaded = measure(sender, receivers, "loaded")
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+    finally:
+        for ws in sockets:
+            ws.__exit__(None, None, None)
+
+    assert done[0] > 0
+    # A blocked loop shows in the slowest deliveries rather than the typical one
+    # The bound is loose since the REST threads also compete with this one for the GIL
+    slow = statistics.quantiles(loaded, n=10)[-1]
+    assert slow < max(statistics.median(idle) * 10, 0.05), (idle, loaded)
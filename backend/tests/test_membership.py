@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from app.core import membership
+from app.core.membership import MembershipCache
+
+pytestmark = pytest.mark.anyio
+
+# Counts database loads, each taking long enough for callers to pile up
+@pytest.fixture
+def loads(monkeypatch):
+    calls = []
+
+    async def get_chat_member_ids(chat_id, db):
+        calls.append(chat_id)
+        await asyncio.sleep(0.01)
+        return [1, 2, 3]
+
+    monkeypatch.setattr(membership, "get_chat_member_ids", get_chat_member_ids)
+    return calls
+
+async def test_concurrent_misses_share_one_load(loads):
+    cache = MembershipCache(16)
+    cache.start(None)
+
+    results = await asyncio.gather(*(cache.is_member(5, user_id) for user_id in range(20)))
+
+    assert results == [user_id in (1, 2, 3) for user_id in range(20)]
+    assert loads == [5]
+    assert cache.stats()["coalesced"] == 19
+    # Cached afterwards
+    assert await cache.members(5) == frozenset({1, 2, 3})
+    assert loads == [5]
+
+async def test_invalidation_starts_a_new_load(loads):
+    cache = MembershipCache(16)
+    cache.start(None)
+
+    first = asyncio.create_task(cache.members(5))
+    await asyncio.sleep(0)
+    await cache.invalidate([5])
+    second = asyncio.create_task(cache.members(5))
+    await asyncio.gather(first, second)
+
+    assert loads == [5, 5]
+    # The load that spanned the invalidation isn't kept, the second one is
+    assert 5 in cache.entries
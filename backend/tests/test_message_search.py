@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+import pytest
+from app.core.message_search import MessageSearchIndex, decode_cursor, encode_cursor, highlight
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+def message_index(*messages: tuple[int, int, str]) -> MessageSearchIndex:
+    index = MessageSearchIndex()
+    for message_id, chat_id, content in messages:
+        index.add(message_id, chat_id, 1, "alice", content, NOW)
+    return index
+
+def test_messages_rank_by_share_of_matching_words_then_newest():
+    index = message_index(
+        (1, 1, "cat"),
+        (2, 1, "the cat sat"),
+        (3, 1, "Cat!"),
+        (4, 1, "dog"),
+        (5, 2, "cat"),
+    )
+
+    rows = index.search("cat", [1], 10)
+
+    assert [(row["id"], row["rank"]) for row in rows] == [(3, 1.0), (1, 1.0), (2, 0.333333)]
+
+def test_every_query_word_has_to_match():
+    index = message_index((1, 1, "cat and dog"), (2, 1, "cat"), (3, 1, "dog"))
+
+    assert [row["id"] for row in index.search("dog cat", [1], 10)] == [1]
+    assert index.search("", [1], 10) == []
+
+def test_pages_continue_after_the_cursor():
+    index = message_index(*((message_id, 1, "cat") for message_id in range(1, 6)))
+
+    first = index.search("cat", [1], 2)
+    last = first[-1]
+    second = index.search("cat", [1], 2, decode_cursor(encode_cursor(last["rank"], last["id"])))
+
+    assert [row["id"] for row in first + second] == [5, 4, 3, 2]
+
+def test_highlight_marks_matched_words():
+    assert highlight("Cat and catalog, cat.", {"cat"}) == "<mark>Cat</mark> and catalog, <mark>cat</mark>."
+
+def test_highlight_escapes_message_content():
+    content = '<script>alert("cat")</script> <img src=x onerror=alert(1)> cat & dog'
+
+    snippet = highlight(content, {"cat"})
+
+    assert snippet == (
+        '&lt;script&gt;alert(&quot;<mark>cat</mark>&quot;)&lt;/script&gt; '
+        '&lt;img src=x onerror=alert(1)&gt; <mark>cat</mark> &amp; dog'
+    )
+
+def test_content_cannot_forge_match_markers():
+    assert highlight("\x02dog\x03 cat", {"cat"}) == "dog <mark>cat</mark>"
+
+def test_search_results_are_escaped():
+    index = message_index((1, 1, "<script>steal()</script> cat"))
+
+    assert index.search("cat", [1], 10)[0]["highlight"] == "&lt;script&gt;steal()&lt;/script&gt; <mark>cat</mark>"
+
+def test_highlight_trims_around_the_first_match():
+    content = "x " * 100 + "cat" + " y" * 100
+    snippet = highlight(content, {"cat"})
+
+    assert snippet.startswith("...") and snippet.endswith("...")
+    assert "<mark>cat</mark>" in snippet
+    assert len(snippet) < len(content)
+
+def test_cursor_round_trips():
+    for message_id in (1, 12, 123, 1234, 12345):
+        cursor = encode_cursor(0.333333, message_id)
+        assert "=" not in cursor
+        assert decode_cursor(cursor) == (0.333333, message_id)
+
+@pytest.mark.parametrize("cursor", [None, "", "not base64!", "W10", "eyJhIjoxfQ"])
+def test_malformed_cursors_decode_to_none(cursor):
+    assert decode_cursor(cursor) is None
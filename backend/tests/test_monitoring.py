@@ -0,0 +1,24 @@
+import pytest
+from app.core.config import settings
+
+ENDPOINTS = ["/stats", "/metrics"]
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_endpoints_are_off_without_a_token(client, monkeypatch, path):
+    monkeypatch.setattr(settings, "MONITORING_TOKEN", "")
+
+    assert client.get(path).status_code == 404
+    assert client.get(path, headers={ "Authorization": "Bearer anything" }).status_code == 404
+
+@pytest.mark.parametrize("path", ENDPOINTS)
+def test_endpoints_need_the_token(client, monkeypatch, path):
+    monkeypatch.setattr(settings, "MONITORING_TOKEN", "s3cret")
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={ "Authorization": "Bearer wrong" }).status_code == 401
+    assert client.get(path, headers={ "Authorization": "Bearer s3cret" }).status_code == 200
+
+def test_user_tokens_do_not_open_monitoring(client, make_user, monkeypatch):
+    monkeypatch.setattr(settings, "MONITORING_TOKEN", "s3cret")
+
+    assert client.get("/stats", headers=make_user()["headers"]).status_code == 401
@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+import pytest
+from sqlalchemy import event, func, select
+from app.core.persistence import MessageWriter
+from app.db.session import AsyncSessionLocal, engine
+from app.models import Chats, Message
+
+pytestmark = pytest.mark.anyio
+
+# Statements run against the messages table, with whether each was an executemany
+@pytest.fixture
+def message_inserts():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO messages"):
+            statements.append(executemany)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+async def test_batch_is_one_multi_row_insert(client, make_user, make_chat, message_inserts):
+    user = make_user()
+    chat_id = make_chat(user)
+    writer = MessageWriter(batch_size=10)
+    first_id = 10_000 + chat_id * 100
+    messages = [
+        {
+            "message_id": first_id + n,
+            "chat_id": chat_id,
+            "sender_id": user["id"],
+            "content": f"message {n}",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        for n in range(5)
+    ]
+    for message in messages:
+        assert await writer.enqueue(message)
+
+    await writer.close()
+
+    assert message_inserts == [False]
+    async with AsyncSessionLocal() as db:
+        assert await db.scalar(select(func.count()).where(Message.chat_id == chat_id)) == 5
+        assert await db.scalar(select(Chats.last_message_id).where(Chats.id == chat_id)) == first_id + 4
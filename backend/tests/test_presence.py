@@ -0,0 +1,52 @@
+import asyncio
+import json
+import pytest
+from app.core.broker import MemoryBroker, MemoryHub, RedisBroker
+from app.core.manager import ConnectionManager
+
+pytestmark = pytest.mark.anyio
+
+class FakeWebSocket:
+    def __init__(self):
+        self.scope = { "subprotocols": [] }
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        pass
+
+    def connected_users(self) -> list[int]:
+        return next(m["user_ids"] for m in self.sent if m["type"] == "connected_users")
+
+# Both brokers have to report presence the same way
+# The in-memory broker is one worker by design, with Redis the users are on two
+@pytest.fixture(params=["memory", "redis"])
+async def managers(request):
+    if request.param == "memory":
+        manager = ConnectionManager(MemoryBroker(MemoryHub()))
+        managers = [manager, manager]
+    else:
+        request.getfixturevalue("fake_redis")
+        managers = [ConnectionManager(RedisBroker()) for _ in range(2)]
+    yield managers
+    for manager in set(managers):
+        await manager.close()
+
+async def test_joining_user_sees_everyone_else_online(managers):
+    first, second, tab = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+
+    await managers[0].connect(first, "902", 1)
+    await managers[1].connect(second, "902", 2)
+    # Another tab of a user already online lists them too
+    await managers[0].connect(tab, "902", 1)
+    # Let the socket writers run
+    await asyncio.sleep(0.05)
+
+    assert first.connected_users() == []
+    assert second.connected_users() == [1]
+    assert sorted(tab.connected_users()) == [1, 2]
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+import fakeredis
+import pytest
+from app.core.config import settings
+from app.core.rate_limit import RateLimiter, TokenBucket, bucket_key
+
+pytestmark = pytest.mark.anyio
+
+# Only the user bucket is on, and refused frames are dropped rather than held back
+@pytest.fixture(autouse=True)
+def user_limit_only(monkeypatch):
+    monkeypatch.setattr(settings, "RATE_LIMIT_CONNECTION_RATE", 0.0)
+    monkeypatch.setattr(settings, "RATE_LIMIT_CHAT_RATE", 0.0)
+    monkeypatch.setattr(settings, "RATE_LIMIT_USER_RATE", 1.0)
+    monkeypatch.setattr(settings, "RATE_LIMIT_USER_BURST", 10)
+    monkeypatch.setattr(settings, "RATE_LIMIT_LEASE", 5)
+    monkeypatch.setattr(settings, "RATE_LIMIT_MAX_DELAY_MS", 0.0)
+
+def connection(user_id: int = 1, chat_id: str = "1"):
+    return SimpleNamespace(user_id=user_id, chat_id=chat_id, rate_bucket=None)
+
+def test_bucket_refills_at_its_rate_up_to_its_burst():
+    bucket = TokenBucket(10.0, 2)
+    bucket.updated = 0.0
+
+    assert bucket.wait(0.0) == 0.0
+    bucket.tokens -= 2
+    assert bucket.wait(0.0) == pytest.approx(0.1)
+    assert bucket.wait(0.05) == pytest.approx(0.05)
+    assert bucket.wait(0.1) == 0.0
+    assert bucket.wait(100.0) == 0.0
+    assert bucket.tokens == 2
+
+async def test_local_buckets_refuse_once_the_burst_is_spent():
+    limiter = RateLimiter()
+    limiter.start(None)
+    client = connection()
+
+    for _ in range(10):
+        assert await limiter.admit(client) is None
+    scope, wait = await limiter.admit(client)
+
+    assert scope == "user"
+    assert 0 < wait <= 1.0
+    # Another user has a bucket of their own
+    assert await limiter.admit(connection(user_id=2)) is None
+    assert limiter.stats()["dropped"] == 1
+
+async def test_shared_buckets_are_leased_from_redis():
+    redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    limiter = RateLimiter()
+    limiter.start(redis_client)
+    client = connection()
+
+    # Each Redis call leases RATE_LIMIT_LEASE tokens, spent without Redis
+    for _ in range(5):
+        assert await limiter.admit(client) is None
+    assert limiter.stats()["redis_checks"] == 1
+    for _ in range(5):
+        assert await limiter.admit(client) is None
+    assert limiter.stats()["redis_checks"] == 2
+    assert float(await redis_client.hget(bucket_key("user", 1), "tokens")) < 1
+
+    # The refusal is remembered, the next frame is refused without Redis
+    assert (await limiter.admit(client))[0] == "user"
+    assert (await limiter.admit(client))[0] == "user"
+    assert limiter.stats()["redis_checks"] == 3
+    await redis_client.aclose()
+
+async def test_workers_share_one_bucket():
+    redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    workers = [RateLimiter(), RateLimiter()]
+    for limiter in workers:
+        limiter.start(redis_client)
+
+    admitted = 0
+    for _ in range(10):
+        for limiter in workers:
+            if await limiter.admit(connection()) is None:
+                admitted += 1
+
+    assert admitted == 10
+    await redis_client.aclose()
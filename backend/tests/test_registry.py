@@ -0,0 +1,51 @@
+from app.core.registry import ConnectionRegistry
+
+def test_add_indexes_by_chat_and_user():
+    registry = ConnectionRegistry()
+    first = registry.add(object(), "1", 10)
+    second = registry.add(object(), "1", 10)
+    other = registry.add(object(), "2", 20)
+
+    assert len(registry) == 3
+    assert first in registry and other in registry
+    assert first.id != second.id
+    assert set(registry.chat_connections("1")) == {first, second}
+    assert registry.user_connections(10) == [first, second]
+    assert registry.chat_user_ids("1") == [10]
+    assert registry.room_size("1") == 2
+    assert registry.room_user_count("1") == 1
+    assert registry.is_user_in_chat("2", 20)
+    assert not registry.is_user_in_chat("2", 10)
+
+def test_remove_keeps_the_user_until_their_last_socket_goes():
+    registry = ConnectionRegistry()
+    first = registry.add(object(), "1", 10)
+    second = registry.add(object(), "1", 10)
+
+    assert registry.remove(first)
+    assert registry.is_user_in_chat("1", 10)
+    assert registry.user_connections(10) == [second]
+
+    assert registry.remove(second)
+    assert not registry.is_user_in_chat("1", 10)
+    assert not registry.has_chat("1")
+    assert registry.user_connections(10) == []
+    assert len(registry) == 0
+
+def test_remove_twice_is_a_no_op():
+    registry = ConnectionRegistry()
+    connection = registry.add(object(), "1", 10)
+    kept = registry.add(object(), "1", 11)
+
+    assert registry.remove(connection)
+    assert not registry.remove(connection)
+    assert connection not in registry
+    assert list(registry.chat_connections("1")) == [kept]
+
+def test_lookups_of_unknown_chats_and_users_are_empty():
+    registry = ConnectionRegistry()
+
+    assert list(registry.chat_connections("404")) == []
+    assert registry.user_connections(404) == []
+    assert registry.chat_user_ids("404") == []
+    assert registry.room_size("404") == 0
@@ -0,0 +1,46 @@
+import itertools
+import pytest
+from sqlalchemy import create_engine, select
+from app.core.config import settings
+from app.crud import chat as chat_crud
+from app.models import ChatMembership, User
+
+signup_numbers = itertools.count(1)
+
+@pytest.fixture
+def public_room(client, make_user, make_chat, monkeypatch):
+    chat_id = make_chat(make_user())
+    monkeypatch.setattr(settings, "PUBLIC_CHAT_IDS", [chat_id])
+    monkeypatch.setattr(settings, "BCRYPT_ROUNDS", 4)
+    return chat_id
+
+def register(client, username: str):
+    return client.post("/auth/register", json={ "username": username, "email": f"{username}@example.com", "password": "pw" })
+
+def stored(username: str) -> tuple[int | None, list[int]]:
+    engine = create_engine(settings.DATABASE_URL)
+    with engine.connect() as conn:
+        user_id = conn.scalar(select(User.id).where(User.username == username))
+        chats = conn.scalars(select(ChatMembership.chat_id).where(ChatMembership.user_id == user_id)).all()
+    engine.dispose()
+    return user_id, chats
+
+def test_new_users_join_the_public_rooms(client, public_room):
+    username = f"signup{next(signup_numbers)}"
+    response = register(client, username)
+
+    assert response.status_code == 200
+    assert stored(username) == (response.json()["id"], [public_room])
+
+def test_failed_room_join_leaves_no_user_behind(client, public_room, monkeypatch):
+    async def fail(memberships, db):
+        list(memberships)
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr("app.crud.user.insert_memberships", fail)
+    username = f"signup{next(signup_numbers)}"
+    # TestClient re-raises what the app didn't handle
+    with pytest.raises(RuntimeError):
+        register(client, username)
+
+    assert stored(username) == (None, [])
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import pytest
+from app.core.broker import RedisBroker
+from app.core.config import settings
+from app.core.manager import ConnectionManager
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def streams_mode(fake_redis, monkeypatch):
+    monkeypatch.setattr(settings, "DELIVERY_MODE", "streams")
+
+class FakeWebSocket:
+    def __init__(self):
+        self.scope = { "subprotocols": [] }
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        pass
+
+    def messages(self) -> list[dict]:
+        return [m for m in self.sent if m["type"] == "chat_message"]
+
+@pytest.fixture
+async def managers():
+    managers = [ConnectionManager(RedisBroker()) for _ in range(2)]
+    for manager in managers:
+        await manager.get_redis()
+    yield managers
+    for manager in managers:
+        await manager.close()
+
+# Publishes from one worker and waits until the socket on the other has it
+async def publish(manager, chat_id: str, content: str, websocket: FakeWebSocket):
+    await manager.publish_chat_message(chat_id, 1, "user1", content)
+    for _ in range(100):
+        if any(m["content"] == content for m in websocket.messages()):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"{content!r} never arrived")
+
+async def test_one_listener_picks_up_new_streams(managers):
+    reader, writer = managers
+    first, second = FakeWebSocket(), FakeWebSocket()
+    await reader.connect(first, "910", 1)
+    listener = reader.broker.listener_task
+    await asyncio.sleep(0.05)
+
+    # Subscribing while the XREAD is blocked restarts the read, not the task
+    await reader.connect(second, "911", 1)
+    await publish(writer, "911", "to the new stream", second)
+    await publish(writer, "910", "to the old stream", first)
+
+    assert reader.broker.listener_task is listener
+    assert [m["content"] for m in first.messages()] == ["to the old stream"]
+
+async def test_reconnect_replays_what_was_missed(managers):
+    reader, writer = managers
+    watcher = FakeWebSocket()
+    await reader.connect(watcher, "912", 1)
+    for n in range(4):
+        await publish(writer, "912", f"m{n}", watcher)
+    last_seen = watcher.messages()[1]["stream_id"]
+
+    returning = FakeWebSocket()
+    await reader.connect(returning, "912", 2, last_seen)
+    await asyncio.sleep(0.05)
+
+    assert [m["content"] for m in returning.messages()] == ["m2", "m3"]
+
+async def test_replay_and_live_frames_are_not_sent_twice(managers, monkeypatch):
+    reader, writer = managers
+    watcher = FakeWebSocket()
+    await reader.connect(watcher, "913", 1)
+    await publish(writer, "913", "before", watcher)
+    last_seen = watcher.messages()[0]["stream_id"]
+
+    # A message that goes live while the replay runs is both queued and replayed
+    replay = reader.broker.replay
+
+    async def replay_during_traffic(chat_id, last_id):
+        await publish(writer, "913", "during", watcher)
+        return await replay(chat_id, last_id)
+
+    monkeypatch.setattr(reader.broker, "replay", replay_during_traffic)
+    returning = FakeWebSocket()
+    await reader.connect(returning, "913", 2, last_seen)
+    await publish(writer, "913", "after", returning)
+
+    assert [m["content"] for m in returning.messages()] == ["during", "after"]
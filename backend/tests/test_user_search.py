@@ -0,0 +1,52 @@
+import pytest
+from app.core.user_search import UserSearchIndex, decode_cursor, encode_cursor
+
+def user_index(*names: str) -> UserSearchIndex:
+    index = UserSearchIndex()
+    for user_id, name in enumerate(names, 1):
+        index.add(user_id, name)
+    return index
+
+def test_prefix_matches_come_before_other_matches():
+    index = user_index("sal", "Alice", "malia", "alfred", "bob", "al_x")
+
+    assert index.search("al", 10) == [
+        (0, "al_x", 6),
+        (0, "alfred", 4),
+        (0, "alice", 2),
+        (1, "malia", 3),
+        (1, "sal", 1),
+    ]
+
+def test_pages_continue_after_the_cursor():
+    names = [f"{prefix}name{n}" for n in range(5) for prefix in ("", "x")]
+    index = user_index(*names)
+
+    everything = index.search("name", 100)
+    pages = []
+    after = None
+    while True:
+        page = index.search("name", 3, after)
+        pages += page
+        if len(page) < 3:
+            break
+        after = page[-1]
+
+    assert pages == everything
+    assert len(everything) == 10
+    assert [key[0] for key in everything] == [0] * 5 + [1] * 5
+
+def test_queries_shorter_than_a_trigram_match_substrings():
+    index = user_index("bob", "abba", "cab")
+
+    assert index.search("b", 10) == [(0, "bob", 1), (1, "abba", 2), (1, "cab", 3)]
+    assert index.search("zz", 10) == []
+
+def test_cursor_round_trips():
+    cursor = encode_cursor(1, "ünïcode_name", 9)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (1, "ünïcode_name", 9)
+
+@pytest.mark.parametrize("cursor", [None, "", "not base64!", "W10", "eyJhIjoxfQ"])
+def test_malformed_cursors_decode_to_none(cursor):
+    assert decode_cursor(cursor) is None
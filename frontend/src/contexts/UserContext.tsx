@@ -21,6 +21,8 @@ export function UserProvider({ children }: { children: ReactNode }) {
                 }
             );
             if (response) {
+                // Every later request is authenticated with the access token from login
+                axios.defaults.headers.common["Authorization"] = `Bearer ${response.data.access_token}`;
                 // Get all chatrooms user belongs to
                 const chatData = await getChats(response?.data?.id);
                 setChats(chatData);
@@ -43,7 +45,10 @@ export function UserProvider({ children }: { children: ReactNode }) {
     }
 
     // Reset user data
-    const logout = () => setUser(null);
+    const logout = () => {
+        delete axios.defaults.headers.common["Authorization"];
+        setUser(null);
+    };
 
     return (
         <UserContext.Provider value={{ user, login, logout, chats, resetChats }}>
@@ -2,7 +2,7 @@ import { useState, useEffect, useRef } from "react";
 import { useUser } from "../contexts/UserContext";
 import { useNavigate } from "react-router-dom";
 import Modal from "../components/Modal";
-import { type ChatPayload, type ChatMessage, type Chat, type User, type UserStatusMessage } from "../types";
+import { type BatchMessage, type ChatPayload, type ChatMessage, type Chat, type User, type UserStatusMessage } from "../types";
 import { getUsersById } from "../functions/fetchFunctions";
 
 export default function HomePage() {
@@ -34,12 +34,27 @@ export default function HomePage() {
 
         let socket: WebSocket | null = null;
         let isMounted = true;
+        // Read acknowledgements go out at most once a second, for the newest message seen
+        let readTimer: ReturnType<typeof setTimeout> | null = null;
+        let newestMessageId = 0;
+
+        const acknowledgeRead = (messageId?: number) => {
+            if (!messageId) return;
+            newestMessageId = Math.max(newestMessageId, messageId);
+            if (readTimer) return;
+            readTimer = setTimeout(() => {
+                readTimer = null;
+                if (socket?.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ type: "read", message_id: newestMessageId }));
+                }
+            }, 1000);
+        };
 
         // WebSocket connection logic. Is called whenever user switches chats
         const connectNewSocket = () => {
             if (!isMounted) return;
 
-            socket = new WebSocket(`${WEBSOCKET_URL}/chat/ws/${chatId}/${user?.id}`);
+            socket = new WebSocket(`${WEBSOCKET_URL}/chat/ws/${chatId}/${user?.id}?token=${user?.access_token}`);
             webSocketRef.current = socket;
 
             // Sends a message to channel that user is connected
@@ -56,7 +71,7 @@ export default function HomePage() {
 
             // Message handler
             socket.onmessage = async (e) => {
-                type MessagePayload = ChatPayload | UserStatusMessage;
+                type MessagePayload = ChatPayload | UserStatusMessage | BatchMessage;
                 const parsed: MessagePayload = JSON.parse(e.data);
                 // Handles differently based on connection type
                 // connected_users, user_joined, user_left will all update the connected users list -> chatMembers
@@ -93,6 +108,15 @@ export default function HomePage() {
                         ...prevMessages,
                         { id: Date.now(), user: username, content: content },
                     ]);
+                    acknowledgeRead(parsed.message_id);
+                } else if (parsed.type === "batch") {
+                    setMessages((prevMessages) => [
+                        ...prevMessages,
+                        ...parsed.messages.map((message, index) => (
+                            { id: Date.now() + index, user: message.username, content: message.content }
+                        )),
+                    ]);
+                    acknowledgeRead(parsed.messages[parsed.messages.length - 1]?.message_id);
                 }
             };
 
@@ -117,6 +141,7 @@ export default function HomePage() {
 
         return () => {
             isMounted = false;
+            if (readTimer) clearTimeout(readTimer);
             if (socket && socket.readyState !== WebSocket.CLOSED) {
                 socket.close();
             }
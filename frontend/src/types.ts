@@ -3,6 +3,14 @@ export interface ChatPayload {
     type: 'chat_message',
     username: string,
     content: string,
+    // Assigned by the server
+    message_id?: number,
+}
+
+// Several chat messages delivered in one frame when the server coalesces a busy chat
+export interface BatchMessage {
+    type: 'batch',
+    messages: ChatPayload[]
 }
 
 export interface UserStatusMessage {
@@ -21,6 +29,11 @@ export interface Chat {
     name: string;
     is_group: boolean;
     members: string[];
+    // Newest message, chats come most recently active first
+    last_message_id: number | null;
+    last_message_at: string | null;
+    last_message_sender_id: number | null;
+    last_message_preview: string | null;
 }
 
 export interface CreateChat {
@@ -37,6 +50,7 @@ export interface UpdateChat {
 export interface User {
     id: number;
     username: string;
+    access_token?: string;
 }
 
 export interface UserCredentials {